@@ -0,0 +1,358 @@
+"""
+批处理任务
+
+一批请求（JSONL 或列表）提交后写入 SQLite，由后台按有限并发逐条执行：
+  - 每条请求独立执行，失败时按指数退避重试（请求本身有误时不重试）
+  - 进度、状态随时可查；结果按提交顺序以 JSONL 输出
+  - 服务重启后 resume() 继续执行未完成的任务（执行中被中断的条目重新执行）
+
+执行函数由调用方提供（server.py 中按 batch 优先级排队获取账号槽位后请求上游），
+所以批处理不会挤占交互请求，吞吐随账号并发上限增长。批次记录提交者的 API Key，
+每条请求都按该 Key 排队和限流，与提交者直接发送的请求一样计入额度。
+"""
+
+import asyncio
+import json
+import sqlite3
+import threading
+import time
+import uuid
+from typing import Any, Awaitable, Callable, Dict, Iterator, List, Optional, Tuple
+
+from metrics import metrics
+
+# 批次状态（与 OpenAI Batch API 相同）
+IN_PROGRESS = "in_progress"
+CANCELLING = "cancelling"
+CANCELLED = "cancelled"
+COMPLETED = "completed"
+FAILED = "failed"
+
+FINAL_STATUSES = (CANCELLED, COMPLETED, FAILED)
+
+# 执行函数: (kind, model, request, api_key) -> 响应体
+Executor = Callable[[str, str, Dict[str, Any], str], Awaitable[Dict[str, Any]]]
+
+
+class BatchItemError(Exception):
+    """不可重试的条目错误（请求格式错误、参数不合法等）"""
+
+    def __init__(self, message: str, status_code: int = 400):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+def parse_jsonl(text: str) -> List[Dict[str, Any]]:
+    """解析 JSONL，跳过空行；格式错误时抛出 ValueError（带行号）"""
+    items = []
+    for lineno, line in enumerate(text.splitlines(), 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            item = json.loads(line)
+        except json.JSONDecodeError as e:
+            raise ValueError(f"第 {lineno} 行不是合法的 JSON: {e}")
+        if not isinstance(item, dict):
+            raise ValueError(f"第 {lineno} 行必须是 JSON 对象")
+        items.append(item)
+    return items
+
+
+class BatchStore:
+    """批次与条目的持久化存储（SQLite）"""
+
+    def __init__(self, db_path: str = "batches.db"):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, timeout=5.0, isolation_level=None, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS batches ("
+            "id TEXT PRIMARY KEY, kind TEXT NOT NULL, endpoint TEXT NOT NULL, model TEXT NOT NULL, "
+            "status TEXT NOT NULL, created_at REAL NOT NULL, completed_at REAL, "
+            "metadata TEXT NOT NULL, error TEXT, api_key TEXT NOT NULL DEFAULT '')"
+        )
+        # 旧版本创建的数据库没有 api_key 列
+        columns = [row[1] for row in self._conn.execute("PRAGMA table_info(batches)").fetchall()]
+        if "api_key" not in columns:
+            self._conn.execute("ALTER TABLE batches ADD COLUMN api_key TEXT NOT NULL DEFAULT ''")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS batch_items ("
+            "batch_id TEXT NOT NULL, idx INTEGER NOT NULL, custom_id TEXT NOT NULL, request TEXT NOT NULL, "
+            "status TEXT NOT NULL, attempts INTEGER NOT NULL DEFAULT 0, status_code INTEGER, "
+            "response TEXT, error TEXT, PRIMARY KEY (batch_id, idx))"
+        )
+
+    def create(
+        self,
+        kind: str,
+        endpoint: str,
+        model: str,
+        items: List[Tuple[str, Dict[str, Any]]],
+        metadata: Optional[Dict[str, Any]] = None,
+        api_key: str = "",
+    ) -> str:
+        """登记一个批次，items 为 (custom_id, 请求体) 列表，api_key 为提交者的 API Key，返回批次 ID"""
+        batch_id = f"batch_{uuid.uuid4().hex[:24]}"
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                self._conn.execute(
+                    "INSERT INTO batches (id, kind, endpoint, model, status, created_at, metadata, api_key) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    (batch_id, kind, endpoint, model, IN_PROGRESS, time.time(),
+                     json.dumps(metadata or {}, ensure_ascii=False), api_key),
+                )
+                self._conn.executemany(
+                    "INSERT INTO batch_items (batch_id, idx, custom_id, request, status) VALUES (?, ?, ?, ?, 'pending')",
+                    [
+                        (batch_id, idx, custom_id, json.dumps(request, ensure_ascii=False))
+                        for idx, (custom_id, request) in enumerate(items)
+                    ],
+                )
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+        return batch_id
+
+    def get(self, batch_id: str) -> Optional[Dict[str, Any]]:
+        """批次信息，包含各状态的条目数 counts"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT id, kind, endpoint, model, status, created_at, completed_at, metadata, error, api_key "
+                "FROM batches WHERE id = ?",
+                (batch_id,),
+            ).fetchone()
+            if row is None:
+                return None
+            counts = dict(self._conn.execute(
+                "SELECT status, COUNT(*) FROM batch_items WHERE batch_id = ? GROUP BY status", (batch_id,)
+            ).fetchall())
+        return {
+            "id": row[0],
+            "kind": row[1],
+            "endpoint": row[2],
+            "model": row[3],
+            "status": row[4],
+            "created_at": row[5],
+            "completed_at": row[6],
+            "metadata": json.loads(row[7]),
+            "error": row[8],
+            "api_key": row[9],
+            "counts": counts,
+        }
+
+    def list(self, limit: int = 20) -> List[Dict[str, Any]]:
+        """最近提交的批次（新的在前）"""
+        with self._lock:
+            ids = [row[0] for row in self._conn.execute(
+                "SELECT id FROM batches ORDER BY created_at DESC LIMIT ?", (limit,)
+            ).fetchall()]
+        return [batch for batch in (self.get(batch_id) for batch_id in ids) if batch is not None]
+
+    def set_status(self, batch_id: str, status: str, error: Optional[str] = None):
+        completed_at = time.time() if status in FINAL_STATUSES else None
+        with self._lock:
+            self._conn.execute(
+                "UPDATE batches SET status = ?, completed_at = ?, error = COALESCE(?, error) WHERE id = ?",
+                (status, completed_at, error, batch_id),
+            )
+
+    def unfinished(self) -> List[str]:
+        """未结束的批次 ID（重启后继续执行）"""
+        with self._lock:
+            return [row[0] for row in self._conn.execute(
+                "SELECT id FROM batches WHERE status IN (?, ?) ORDER BY created_at", (IN_PROGRESS, CANCELLING)
+            ).fetchall()]
+
+    def pending_items(self, batch_id: str) -> List[Tuple[int, str, Dict[str, Any], int]]:
+        """尚未完成的条目 (idx, custom_id, 请求体, 已尝试次数)，包括重启前执行到一半的条目"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT idx, custom_id, request, attempts FROM batch_items "
+                "WHERE batch_id = ? AND status IN ('pending', 'running') ORDER BY idx",
+                (batch_id,),
+            ).fetchall()
+        return [(idx, custom_id, json.loads(request), attempts) for idx, custom_id, request, attempts in rows]
+
+    def mark_running(self, batch_id: str, idx: int, attempts: int):
+        with self._lock:
+            self._conn.execute(
+                "UPDATE batch_items SET status = 'running', attempts = ? WHERE batch_id = ? AND idx = ?",
+                (attempts, batch_id, idx),
+            )
+
+    def finish_item(
+        self,
+        batch_id: str,
+        idx: int,
+        status: str,
+        status_code: Optional[int] = None,
+        response: Optional[Dict[str, Any]] = None,
+        error: Optional[str] = None,
+    ):
+        with self._lock:
+            self._conn.execute(
+                "UPDATE batch_items SET status = ?, status_code = ?, response = ?, error = ? "
+                "WHERE batch_id = ? AND idx = ?",
+                (status, status_code, None if response is None else json.dumps(response, ensure_ascii=False),
+                 error, batch_id, idx),
+            )
+
+    def cancel_pending(self, batch_id: str):
+        with self._lock:
+            self._conn.execute(
+                "UPDATE batch_items SET status = 'cancelled' WHERE batch_id = ? AND status = 'pending'",
+                (batch_id,),
+            )
+
+    def results(self, batch_id: str) -> Iterator[Dict[str, Any]]:
+        """按提交顺序返回已结束条目的结果"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT idx, custom_id, status, status_code, response, error FROM batch_items "
+                "WHERE batch_id = ? AND status IN ('succeeded', 'failed', 'cancelled') ORDER BY idx",
+                (batch_id,),
+            ).fetchall()
+        for idx, custom_id, status, status_code, response, error in rows:
+            yield {
+                "index": idx,
+                "custom_id": custom_id,
+                "status": status,
+                "status_code": status_code,
+                "response": None if response is None else json.loads(response),
+                "error": error,
+            }
+
+
+class BatchEngine:
+    """
+    批处理执行器
+
+    用法:
+        engine = BatchEngine(BatchStore("batches.db"), execute, concurrency=2)
+        batch = engine.submit("openai", "/v1/chat/completions", "gemini-3.0-flash", items, api_key="sk-...")
+    """
+
+    def __init__(
+        self,
+        store: BatchStore,
+        execute: Executor,
+        concurrency: int = 1,
+        max_retries: int = 3,
+        retry_delay: float = 2.0,
+    ):
+        self.store = store
+        self.execute = execute
+        self.concurrency = max(1, concurrency)
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._tasks: Dict[str, asyncio.Task] = {}
+
+    def submit(
+        self,
+        kind: str,
+        endpoint: str,
+        model: str,
+        items: List[Tuple[str, Dict[str, Any]]],
+        metadata: Optional[Dict[str, Any]] = None,
+        api_key: str = "",
+    ) -> Dict[str, Any]:
+        """登记并开始执行一个批次（需要在事件循环中调用）"""
+        batch_id = self.store.create(kind, endpoint, model, items, metadata, api_key)
+        self._schedule(batch_id)
+        return self.store.get(batch_id)
+
+    def resume(self) -> int:
+        """继续执行未完成的批次（服务启动时调用），返回批次数"""
+        batch_ids = self.store.unfinished()
+        for batch_id in batch_ids:
+            self._schedule(batch_id)
+        if batch_ids:
+            print(f"[INFO] 继续执行 {len(batch_ids)} 个未完成的批处理任务")
+        return len(batch_ids)
+
+    def get(self, batch_id: str) -> Optional[Dict[str, Any]]:
+        return self.store.get(batch_id)
+
+    def list(self, limit: int = 20) -> List[Dict[str, Any]]:
+        return self.store.list(limit)
+
+    def results(self, batch_id: str) -> Iterator[Dict[str, Any]]:
+        return self.store.results(batch_id)
+
+    def cancel(self, batch_id: str) -> Optional[Dict[str, Any]]:
+        """取消批次：未开始的条目不再执行，正在执行的条目完成后结束"""
+        batch = self.store.get(batch_id)
+        if batch is None or batch["status"] in FINAL_STATUSES:
+            return batch
+        self.store.set_status(batch_id, CANCELLING)
+        if batch_id not in self._tasks:
+            self._finish(batch_id)
+        return self.store.get(batch_id)
+
+    def _schedule(self, batch_id: str):
+        if batch_id in self._tasks:
+            return
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        task = asyncio.ensure_future(self._run_batch(batch_id))
+        self._tasks[batch_id] = task
+        task.add_done_callback(lambda _: self._tasks.pop(batch_id, None))
+
+    async def _run_batch(self, batch_id: str):
+        batch = self.store.get(batch_id)
+        if batch is None:
+            return
+        queue = list(reversed(self.store.pending_items(batch_id)))
+
+        async def worker():
+            while queue:
+                if self.store.get(batch_id)["status"] != IN_PROGRESS:
+                    return
+                idx, custom_id, request, attempts = queue.pop()
+                await self._run_item(batch_id, batch, idx, request, attempts)
+
+        try:
+            await asyncio.gather(*(worker() for _ in range(min(self.concurrency, len(queue)) or 1)))
+        except Exception as e:
+            print(f"[WARN] 批处理任务 {batch_id} 执行失败: {e}")
+            self.store.set_status(batch_id, FAILED, error=str(e))
+            return
+        self._finish(batch_id)
+
+    async def _run_item(self, batch_id: str, batch: Dict[str, Any], idx: int, request: Dict[str, Any], attempts: int):
+        while True:
+            attempts += 1
+            self.store.mark_running(batch_id, idx, attempts)
+            try:
+                # 只在执行时占用并发名额，退避等待期间让给其他条目
+                async with self._semaphore:
+                    response = await self.execute(batch["kind"], batch["model"], request, batch["api_key"])
+            except BatchItemError as e:
+                self.store.finish_item(batch_id, idx, "failed", status_code=e.status_code, error=str(e))
+                metrics.inc("gemini_batch_items_total", status="failed")
+                return
+            except Exception as e:
+                if attempts <= self.max_retries:
+                    metrics.inc("gemini_batch_retries_total")
+                    await asyncio.sleep(self.retry_delay * (2 ** (attempts - 1)))
+                    continue
+                self.store.finish_item(
+                    batch_id, idx, "failed", status_code=getattr(e, "status_code", 500), error=str(e)
+                )
+                metrics.inc("gemini_batch_items_total", status="failed")
+                return
+            self.store.finish_item(batch_id, idx, "succeeded", status_code=200, response=response)
+            metrics.inc("gemini_batch_items_total", status="succeeded")
+            return
+
+    def _finish(self, batch_id: str):
+        if self.store.get(batch_id)["status"] == CANCELLING:
+            self.store.cancel_pending(batch_id)
+            self.store.set_status(batch_id, CANCELLED)
+        else:
+            self.store.set_status(batch_id, COMPLETED)
@@ -0,0 +1,72 @@
+"""
+流式响应每个 token 的 JSON 开销：标准库 json vs orjson
+
+模拟真流式的热点路径：解析上游一行 wrb.fr（外层 + 内层两次 loads），再序列化一个 OpenAI SSE 块。
+Gemini 每行返回截至目前的完整文本，所以越往后单行越长。
+
+运行: python benchmarks/bench_json.py
+"""
+
+import json
+import time
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def upstream_lines(tokens: int):
+    text = ""
+    lines = []
+    for i in range(tokens):
+        text += f"词{i} "
+        inner = [
+            None, ["c_3f9a1b2c4d5e6f70", "r_8a7b6c5d4e3f2a10"], None, None,
+            [["rc_0a1b2c3d4e5f6a7b", [text], [], None, None, None, True, None, [""], "zh"]],
+            ["CN", None, None, [None, None, None, [[[None] * 8]]]],
+        ]
+        lines.append(json.dumps([["wrb.fr", None, json.dumps(inner, ensure_ascii=False)]], ensure_ascii=False))
+    return lines
+
+
+def chunk(delta: str) -> dict:
+    return {
+        "id": "chatcmpl-1a2b3c4d",
+        "object": "chat.completion.chunk",
+        "created": 1700000000,
+        "model": "gemini-3.0-flash",
+        "choices": [{"index": 0, "delta": {"content": delta}, "finish_reason": None}],
+    }
+
+
+def run(lines, loads, dumps) -> float:
+    start = time.perf_counter()
+    prev = ""
+    for line in lines:
+        data = loads(line)
+        inner = loads(data[0][2])
+        text = inner[4][0][1][0]
+        delta, prev = text[len(prev):], text
+        out = f"data: {dumps(chunk(delta))}\n\n"
+    assert out
+    return (time.perf_counter() - start) / len(lines) * 1e6
+
+
+def main():
+    lines = upstream_lines(400)
+    backends = [("json", json.loads, json.dumps)]
+    if orjson is not None:
+        backends.append(("orjson", orjson.loads, lambda obj: orjson.dumps(obj).decode()))
+    else:
+        print("未安装 orjson，只测试标准库")
+    results = {}
+    for name, loads, dumps in backends:
+        results[name] = min(run(lines, loads, dumps) for _ in range(5))
+        print(f"{name:7s} 每个 token {results[name]:6.2f} µs")
+    if len(results) == 2:
+        print(f"加速 {results['json'] / results['orjson']:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+"""
+每个请求判断从哪个会话继续的开销：拼接全部用户消息计算 MD5（旧做法） vs 前缀树匹配
+
+模拟多轮对话：每次请求都带着完整历史，只有最后一条用户消息是新的；
+服务端已经记录了之前每一轮的快照（与请求历史一致）。每次请求的消息都是重新解析的 JSON（与服务端一致）。
+
+运行: python benchmarks/bench_matcher.py
+"""
+
+import hashlib
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from matcher import ConversationTrie, dialog_messages, message_key  # noqa: E402
+
+EN = "Can you explain how the scheduler decides which request runs next when the queue is full? "
+ZH = "请解释一下当队列已满时，调度器如何决定下一个执行的请求，并给出一个具体的例子。"
+
+
+def conversation(turns: int):
+    messages = []
+    for i in range(turns):
+        messages.append({"role": "user", "content": f"{i}: " + (EN if i % 2 else ZH) * 3})
+        messages.append({"role": "assistant", "content": f"{i}: " + (ZH if i % 2 else EN) * 12})
+    messages.append({"role": "user", "content": "最后一个问题"})
+    return messages
+
+
+def user_messages_hash(messages) -> str:
+    """旧做法：每次请求拼接全部用户消息计算 MD5"""
+    content_str = ""
+    for m in messages:
+        if m["role"] == "user":
+            content_str += f"{m['content']}|"
+    return hashlib.md5(content_str.encode()).hexdigest()
+
+
+def build_trie(history) -> ConversationTrie:
+    trie = ConversationTrie()
+    checkpoints = []
+    for i in range(0, len(history), 2):
+        user, reply = history[i], history[i + 1]
+        checkpoints.append({
+            "id": i // 2 + 1,
+            "parent": i // 2 or None,
+            "user": user["content"],
+            "reply": reply["content"],
+        })
+    trie.sync(checkpoints)
+    return trie
+
+
+def timed(fn, messages, repeat: int = 200) -> float:
+    """每次请求的耗时（µs），每次调用使用一份新解析的消息"""
+    raw = json.dumps(messages, ensure_ascii=False)
+    best = float("inf")
+    for _ in range(5):
+        requests = [json.loads(raw) for _ in range(repeat)]
+        start = time.perf_counter()
+        for request in requests:
+            fn(request)
+        best = min(best, (time.perf_counter() - start) / repeat)
+    return best * 1e6
+
+
+def main():
+    for turns in (1, 10, 50, 200):
+        messages = conversation(turns)
+        trie = build_trie(messages[:-1])
+
+        def old(request):
+            user_messages_hash(request[:-1])
+            user_messages_hash(request)
+
+        def new(request):
+            history = dialog_messages(request)[:-1]
+            trie.match(message_key(m["role"], m["content"]) for m in history)
+
+        # 与已记录的对话无关的多条消息请求：旧做法照样计算全部 hash，前缀树在第一条消息处停止
+        other = [{**m, "content": "另一段对话 " + m["content"]} for m in messages]
+
+        print(
+            f"{len(messages):4d} 条消息: MD5 拼接 {timed(old, messages):8.1f} µs, "
+            f"前缀树 {timed(new, messages):8.1f} µs; "
+            f"无关对话: MD5 拼接 {timed(old, other):8.1f} µs, 前缀树 {timed(new, other):8.1f} µs"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+"""
+会话消息历史的内存占用：普通 dataclass（之前） vs 不可变 __slots__ dataclass + role 驻留（现在）
+
+模拟 10000 个会话，每个会话保留 100 条消息（max_history_messages）。消息内容两种情况共用，
+只统计消息对象本身和 role 字符串（从 JSON 解析出来的 role 每条都是新的字符串对象）。
+
+运行: python benchmarks/bench_messages.py
+"""
+
+import gc
+import os
+import sys
+import time
+import tracemalloc
+from dataclasses import dataclass
+from typing import Any, Dict, List, Union
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from client import Message  # noqa: E402
+
+SESSIONS = 10000
+MESSAGES = 100
+
+
+@dataclass
+class OldMessage:
+    """之前的消息定义"""
+    role: str
+    content: Union[str, List[Dict[str, Any]]]
+
+
+def measure(cls, contents: List[str]):
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    sessions = []
+    for _ in range(SESSIONS):
+        history = []
+        for i, content in enumerate(contents):
+            role = "".join(("assist", "ant")) if i % 2 else "".join(("us", "er"))
+            history.append(cls(role=role, content=content))
+        sessions.append(history)
+    elapsed = time.perf_counter() - start
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del sessions
+    return current, elapsed
+
+
+def main():
+    contents = [f"第 {i} 条消息的内容" for i in range(MESSAGES)]
+    print(f"{SESSIONS} 个会话 × {MESSAGES} 条消息（消息内容不计入）")
+    results = {}
+    for name, cls in [("普通 dataclass", OldMessage), ("slots + 驻留", Message)]:
+        size, elapsed = measure(cls, contents)
+        results[name] = size
+        print(f"{name:14s}: {size / 2**20:7.1f} MiB, 每条 {size / (SESSIONS * MESSAGES):5.1f} 字节, 创建耗时 {elapsed:5.2f} s")
+    before, after = results.values()
+    print(f"节省 {(before - after) / 2**20:.1f} MiB ({1 - after / before:.0%})")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+"""
+SSE 块序列化：每块构造完整字典再 dumps vs 预序列化模板，以及合并窗口对字节数 / 块数的影响
+
+运行: python benchmarks/bench_sse.py
+"""
+
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import jsoncodec  # noqa: E402
+from sse import OpenAIChunkEncoder, coalesce  # noqa: E402
+
+COMPLETION_ID = "chatcmpl-1a2b3c4d"
+CREATED = 1700000000
+MODEL = "gemini-3.0-flash"
+
+
+def full_chunk(delta: str) -> bytes:
+    chunk_data = {
+        "id": COMPLETION_ID,
+        "object": "chat.completion.chunk",
+        "created": CREATED,
+        "model": MODEL,
+        "choices": [{"index": 0, "delta": {"content": delta}, "finish_reason": None}],
+    }
+    return f"data: {jsoncodec.dumps(chunk_data)}\n\n".encode("utf-8")
+
+
+def cpu_per_chunk(deltas):
+    encoder = OpenAIChunkEncoder(COMPLETION_ID, CREATED, MODEL)
+    for name, render in [("dict + dumps", full_chunk), ("模板", encoder.content)]:
+        best = float("inf")
+        for _ in range(5):
+            start = time.perf_counter()
+            for delta in deltas:
+                render(delta)
+            best = min(best, time.perf_counter() - start)
+        print(f"{name:12s} 每块 {best / len(deltas) * 1e6:5.2f} µs")
+
+
+async def upstream(deltas, burst: int, gap: float):
+    # 上游每 gap 秒到达一批（burst 个）小增量
+    for i, delta in enumerate(deltas):
+        if i % burst == 0:
+            await asyncio.sleep(gap)
+        yield delta
+
+
+def bytes_per_token(deltas, window_ms: float):
+    encoder = OpenAIChunkEncoder(COMPLETION_ID, CREATED, MODEL)
+
+    async def run():
+        return [encoder.content(text) async for text in coalesce(upstream(deltas, 4, 0.02), window_ms / 1000)]
+
+    chunks = asyncio.run(run())
+    total = sum(len(c) for c in chunks)
+    print(f"窗口 {window_ms:4.0f} ms: {len(chunks):4d} 块, {total:6d} 字节, 每 token {total / len(deltas):6.1f} 字节")
+
+
+def main():
+    print(f"JSON 后端: {jsoncodec.BACKEND}")
+    deltas = [f"词{i} " for i in range(400)]
+    cpu_per_chunk(deltas)
+    for window_ms in (0, 5, 15):
+        bytes_per_token(deltas[:200], window_ms)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+"""
+冷启动：python -X importtime 测量 import server 的耗时（目标 < STARTUP_BUDGET_MS）
+
+每次在新的解释器中导入 server，取中位数；同时列出耗时最多的直接依赖，
+并检查应当延迟导入的模块（httpx、uvicorn 等，只在用到时导入）没有在导入时被加载。
+导入时不应有网络请求或文件读写：配置在启动事件中加载，客户端（获取 BL）在后台预热。
+
+运行: python benchmarks/bench_startup.py
+超出预算或延迟导入的模块被提前加载时退出码为 1，可以放进 CI。
+"""
+
+import os
+import re
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+STARTUP_BUDGET_MS = float(os.getenv("STARTUP_BUDGET_MS", "1000"))
+RUNS = int(os.getenv("STARTUP_RUNS", "5"))
+# 只在用到时才导入的模块
+DEFERRED_MODULES = ("httpx", "uvicorn", "client")
+
+LINE = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)")
+
+
+def import_once():
+    """在新的解释器中导入 server，返回 {模块: (自身 µs, 累计 µs, 层级)}"""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import server"],
+        cwd=ROOT,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    modules = {}
+    for line in result.stderr.splitlines():
+        match = LINE.match(line)
+        if match:
+            self_us, total_us, indent, name = match.groups()
+            modules[name] = (int(self_us), int(total_us), len(indent) // 2)
+            if name == "site":
+                # 解释器启动时（site、.pth）导入的模块不属于 server
+                modules.clear()
+    return modules
+
+
+def main():
+    import_once()  # 第一次运行会编译 .pyc，不计入
+    runs = [import_once() for _ in range(RUNS)]
+    totals = [run["server"][1] / 1000 for run in runs]
+    median = statistics.median(totals)
+    last = runs[-1]
+
+    print(f"import server: 中位数 {median:.1f} ms（{RUNS} 次: {', '.join(f'{t:.0f}' for t in totals)}），"
+          f"server 模块自身 {last['server'][0] / 1000:.1f} ms")
+    # server 的直接依赖（-X importtime 中缩进为 1 级）按累计耗时排序
+    direct = sorted(
+        ((name, total) for name, (_, total, level) in last.items() if level == 1),
+        key=lambda item: item[1],
+        reverse=True,
+    )
+    for name, total in direct[:10]:
+        print(f"  {name:24s} {total / 1000:7.1f} ms")
+
+    failed = False
+    loaded = [name for name in DEFERRED_MODULES if name in last]
+    if loaded:
+        print(f"❌ 导入时加载了应当延迟导入的模块: {', '.join(loaded)}")
+        failed = True
+    if median > STARTUP_BUDGET_MS:
+        print(f"❌ 超出预算 {STARTUP_BUDGET_MS:.0f} ms")
+        failed = True
+    if not failed:
+        print(f"✅ 在预算 {STARTUP_BUDGET_MS:.0f} ms 以内")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
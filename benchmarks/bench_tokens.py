@@ -0,0 +1,54 @@
+"""
+每个请求估算 token 的开销（目标 < 50 µs）
+
+模拟多轮对话：每次请求都带着完整历史，只有最后两条消息是新的。
+
+运行: python benchmarks/bench_tokens.py
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import tokens  # noqa: E402
+
+EN = "Can you explain how the scheduler decides which request runs next when the queue is full? "
+ZH = "请解释一下当队列已满时，调度器如何决定下一个执行的请求，并给出一个具体的例子。"
+
+
+def conversation(turns: int):
+    messages = []
+    for i in range(turns):
+        messages.append({"role": "user", "content": f"{i}: " + (EN if i % 2 else ZH) * 3})
+        messages.append({"role": "assistant", "content": f"{i}: " + (ZH if i % 2 else EN) * 12})
+    return messages
+
+
+def per_request(turns: int, warm: bool) -> float:
+    history = conversation(turns)
+    best = float("inf")
+    for _ in range(5):
+        tokens.clear_cache()
+        if warm:
+            # 之前的请求已经算过除最后两条之外的历史
+            tokens.count_messages(history[:-2])
+        start = time.perf_counter()
+        prompt = tokens.count_messages(history[:-1])
+        tokens.usage(prompt, history[-1]["content"])
+        best = min(best, time.perf_counter() - start)
+    return best * 1e6
+
+
+def main():
+    for turns in (1, 10, 50):
+        cold = per_request(turns, warm=False)
+        warm = per_request(turns, warm=True)
+        print(f"{turns * 2:3d} 条消息: 首次 {cold:6.1f} µs, 历史已缓存 {warm:6.1f} µs")
+    for name, text in [("英文", EN * 12), ("中文", ZH * 12)]:
+        print(f"{name}: {len(text)} 字符 -> 估算 {tokens.count_text(text)} token")
+
+
+if __name__ == "__main__":
+    main()
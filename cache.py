@@ -0,0 +1,185 @@
+"""
+精确匹配响应缓存
+
+对无状态的单轮请求（相同模型、消息、工具、图片）直接返回之前的生成结果，不再请求上游。
+  - 内存层: LRU + TTL，按条目数和总字节数限制
+  - 磁盘层（可选）: SQLite，进程重启或多个 worker 之间共享
+缓存键由规范化后的消息列表计算，图片只参与哈希，不保存原始数据。
+"""
+
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+from metrics import metrics
+
+
+def _hash_text(value: str) -> str:
+    return hashlib.sha256(value.encode("utf-8")).hexdigest()
+
+
+def normalize_content(content: Any) -> List[Dict[str, str]]:
+    """
+    规范化单条消息内容
+
+    字符串和 [{"type": "text"}] 两种写法得到相同结果；图片替换为其 URL / base64 数据的哈希
+    """
+    if content is None:
+        return []
+    if isinstance(content, str):
+        return [{"type": "text", "text": content.strip()}]
+    parts = []
+    for item in content:
+        if not isinstance(item, dict):
+            parts.append({"type": "text", "text": str(item).strip()})
+            continue
+        item_type = item.get("type")
+        if item_type == "text":
+            parts.append({"type": "text", "text": item.get("text", "").strip()})
+        elif item_type == "image_url":
+            image_url = item.get("image_url", {})
+            url = image_url.get("url", "") if isinstance(image_url, dict) else str(image_url)
+            parts.append({"type": "image", "sha256": _hash_text(url)})
+        else:
+            parts.append({"type": str(item_type), "sha256": _hash_text(json.dumps(item, sort_keys=True))})
+    return parts
+
+
+def make_cache_key(model: str, messages: List[Dict[str, Any]], **params) -> str:
+    """
+    计算缓存键
+
+    Args:
+        model: 模型名
+        messages: [{"role": ..., "content": ...}]
+        **params: 其他影响输出的参数（tools、temperature 等），None 值忽略
+    """
+    payload = {
+        "model": model,
+        "messages": [
+            {"role": str(m.get("role", "")).lower(), "content": normalize_content(m.get("content"))}
+            for m in messages
+        ],
+        "params": {k: v for k, v in params.items() if v is not None},
+    }
+    raw = json.dumps(payload, sort_keys=True, ensure_ascii=False, separators=(",", ":"), default=str)
+    return _hash_text(raw)
+
+
+class ResponseCache:
+    """
+    两级响应缓存
+
+    用法:
+        cached = cache.get(key)
+        if cached is None:
+            ...  # 请求上游
+            cache.put(key, {"text": reply, "usage": {...}})
+    """
+
+    def __init__(
+        self,
+        max_entries: int = 1024,
+        max_bytes: int = 64 * 1024 * 1024,
+        ttl: float = 3600.0,
+        db_path: Optional[str] = None,
+    ):
+        self.max_entries = max(1, max_entries)
+        self.max_bytes = max(1, max_bytes)
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        # key -> (序列化后的值, 过期时间, 字节数)
+        self._entries: "OrderedDict[str, Tuple[str, float, int]]" = OrderedDict()
+        self._bytes = 0
+        self._conn = None
+        self._puts = 0
+        if db_path:
+            self._conn = sqlite3.connect(db_path, timeout=5.0, isolation_level=None, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS response_cache ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, expires REAL NOT NULL)"
+            )
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @property
+    def size_bytes(self) -> int:
+        return self._bytes
+
+    def get(self, key: str, now: Optional[float] = None) -> Optional[Dict[str, Any]]:
+        """命中返回缓存的值，未命中或已过期返回 None"""
+        now = time.time() if now is None else now
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[1] > now:
+                    self._entries.move_to_end(key)
+                    metrics.inc("gemini_cache_hits_total", tier="memory")
+                    return json.loads(entry[0])
+                self._remove(key)
+            if self._conn is not None:
+                row = self._conn.execute(
+                    "SELECT value, expires FROM response_cache WHERE key = ?", (key,)
+                ).fetchone()
+                if row and row[1] > now:
+                    # 提升到内存层
+                    self._insert(key, row[0], row[1])
+                    metrics.inc("gemini_cache_hits_total", tier="disk")
+                    return json.loads(row[0])
+            metrics.inc("gemini_cache_misses_total")
+            return None
+
+    def put(self, key: str, value: Dict[str, Any], now: Optional[float] = None):
+        """写入缓存（同时写入磁盘层）"""
+        now = time.time() if now is None else now
+        raw = json.dumps(value, ensure_ascii=False)
+        expires = now + self.ttl
+        with self._lock:
+            self._insert(key, raw, expires)
+            if self._conn is not None:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO response_cache (key, value, expires) VALUES (?, ?, ?)",
+                    (key, raw, expires),
+                )
+                self._puts += 1
+                if self._puts % 100 == 0:
+                    self._conn.execute("DELETE FROM response_cache WHERE expires <= ?", (now,))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+            if self._conn is not None:
+                self._conn.execute("DELETE FROM response_cache")
+            self._update_gauges()
+
+    def _insert(self, key: str, raw: str, expires: float):
+        size = len(raw.encode("utf-8")) + len(key)
+        if size > self.max_bytes:
+            # 单条超过内存上限，只保留在磁盘层
+            return
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = (raw, expires, size)
+        self._bytes += size
+        while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+            _, (_, _, evicted) = self._entries.popitem(last=False)
+            self._bytes -= evicted
+            metrics.inc("gemini_cache_evictions_total")
+        self._update_gauges()
+
+    def _remove(self, key: str):
+        _, _, size = self._entries.pop(key)
+        self._bytes -= size
+        self._update_gauges()
+
+    def _update_gauges(self):
+        metrics.set("gemini_cache_entries", len(self._entries))
+        metrics.set("gemini_cache_bytes", self._bytes)
@@ -0,0 +1,161 @@
+"""
+模型目录 / 路由表
+
+启动时从 configs/models.json 加载一次，预先序列化 /v1/models 和 /v1beta/models 的响应体；
+之后只在文件 mtime 变化（或后台手动重新加载）时重建，客户端可用 ETag / If-None-Match 获取 304。
+
+每个模型条目除 Gemini API 的公开字段外，还可以包含（不会出现在 /v1beta/models 响应中）:
+  upstreamId: 网页版模型 ID（请求头 x-goog-ext-525001261-jspb 的第 5 个元素）
+  maxConcurrency: 该模型同时进行的生成请求上限
+"""
+
+import hashlib
+import json
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+
+# 两次检查文件 mtime 的最小间隔（秒），SDK 频繁调用 /v1/models 时避免每次都 stat
+CHECK_INTERVAL = 1.0
+
+# 只用于路由的内部字段
+PRIVATE_FIELDS = ("upstreamId", "maxConcurrency")
+
+
+def _etag(body: bytes) -> str:
+    return '"' + hashlib.sha1(body).hexdigest()[:16] + '"'
+
+
+class ModelCatalog:
+    """
+    模型目录
+
+    用法:
+        catalog = ModelCatalog("configs/models.json", fallback=lambda: ["gemini-3.0-flash"])
+        body, etag = catalog.openai_body()
+    """
+
+    def __init__(self, path: str, fallback: Optional[Callable[[], List[str]]] = None):
+        """
+        Args:
+            path: models.json 路径
+            fallback: 文件不存在或为空时提供模型 ID 列表
+        """
+        self.path = path
+        self.fallback = fallback or (lambda: [])
+        self._lock = threading.Lock()
+        self._mtime: Optional[float] = None
+        self._checked = 0.0
+        self._loaded = False
+        self._created = 0
+        self.models: List[Dict[str, Any]] = []
+        self._by_id: Dict[str, Dict[str, Any]] = {}
+        self._upstream_ids: Dict[str, str] = {}
+        self._token_limits: Dict[str, int] = {}
+        self._openai: Tuple[bytes, str] = (b"", "")
+        self._gemini: Tuple[bytes, str] = (b"", "")
+
+    def _file_mtime(self) -> Optional[float]:
+        try:
+            return os.stat(self.path).st_mtime
+        except OSError:
+            return None
+
+    def _read_models(self) -> List[Dict[str, Any]]:
+        if self._mtime is not None:
+            try:
+                with open(self.path, "r", encoding="utf-8") as f:
+                    models = json.load(f).get("models", [])
+                models = [m for m in models if m.get("name")]
+                if models:
+                    return models
+            except Exception as e:
+                print(f"[WARN] 无法加载 models.json: {e}")
+        # 回退到默认模型
+        return [
+            {
+                "name": f"models/{m}",
+                "displayName": m.replace("models/", "").replace("-", " ").title(),
+                "inputTokenLimit": 1048576,
+                "outputTokenLimit": 65536,
+            }
+            for m in self.fallback()
+        ]
+
+    def reload(self) -> int:
+        """重新读取文件并重建响应体，返回模型数量"""
+        with self._lock:
+            self._mtime = self._file_mtime()
+            self._checked = time.monotonic()
+            models = self._read_models()
+            # created 只在模型列表内容变化时更新（取文件的修改时间），touch 文件或重新加载不改变 ETag
+            if models != self.models or not self._created:
+                self._created = int(self._mtime or time.time())
+            created = self._created
+            openai = json.dumps({
+                "object": "list",
+                "data": [
+                    {"id": m["name"].replace("models/", ""), "object": "model", "created": created, "owned_by": "google"}
+                    for m in models
+                ],
+            }, ensure_ascii=False).encode("utf-8")
+            gemini = json.dumps({
+                "models": [{k: v for k, v in m.items() if k not in PRIVATE_FIELDS} for m in models],
+            }, ensure_ascii=False).encode("utf-8")
+            self.models = models
+            self._by_id = {m["name"].replace("models/", ""): m for m in models}
+            self._upstream_ids = {
+                model_id: m["upstreamId"] for model_id, m in self._by_id.items() if m.get("upstreamId")
+            }
+            self._token_limits = {
+                model_id: int(m["inputTokenLimit"]) for model_id, m in self._by_id.items() if m.get("inputTokenLimit")
+            }
+            self._openai = (openai, _etag(openai))
+            self._gemini = (gemini, _etag(gemini))
+            self._loaded = True
+            return len(models)
+
+    def invalidate(self):
+        """下次访问时重新加载（回退模型列表变化时调用）"""
+        self._loaded = False
+
+    def refresh(self):
+        """文件 mtime 变化时重新加载"""
+        now = time.monotonic()
+        if self._loaded and now - self._checked < CHECK_INTERVAL:
+            return
+        self._checked = now
+        if not self._loaded or self._file_mtime() != self._mtime:
+            self.reload()
+
+    def get(self, model_id: str) -> Optional[Dict[str, Any]]:
+        """按模型 ID（可带 models/ 前缀）查找模型条目"""
+        self.refresh()
+        return self._by_id.get(model_id.replace("models/", ""))
+
+    def upstream_ids(self) -> Dict[str, str]:
+        """模型 ID -> 网页版模型 ID（重新加载前返回同一个字典对象）"""
+        self.refresh()
+        return self._upstream_ids
+
+    def token_limits(self) -> Dict[str, int]:
+        """模型 ID -> inputTokenLimit（重新加载前返回同一个字典对象）"""
+        self.refresh()
+        return self._token_limits
+
+    def max_concurrency(self, model_id: str) -> int:
+        """模型的并发上限，0 表示不单独限制"""
+        entry = self.get(model_id) or {}
+        return int(entry.get("maxConcurrency") or 0)
+
+    def openai_body(self) -> Tuple[bytes, str]:
+        """/v1/models 的响应体和 ETag"""
+        self.refresh()
+        return self._openai
+
+    def gemini_body(self) -> Tuple[bytes, str]:
+        """/v1beta/models 的响应体和 ETag"""
+        self.refresh()
+        return self._gemini
@@ -7,6 +7,8 @@ Gemini Web Reverse Engineering Client
 import re
 import json
 import os
+import sys
+import hashlib
 import random
 import string
 import base64
@@ -17,6 +19,23 @@ from dataclasses import dataclass, field
 from datetime import datetime
 import time
 
+import jsoncodec
+import tokens
+from health import EXPIRED_STATUS_CODES, account_label, health
+from history import MessageHistory, extractive_summary
+from matcher import message_text
+
+
+# 系统提示词只在对话开始（或内容变化）时随用户消息发送一次，之后的轮次由 Gemini 会话上下文记住
+SYSTEM_PROMPT_TEMPLATE = "【系统指令】\n{system}\n\n【用户消息】\n{text}"
+# 会话中缺少的历史消息（无法从快照继续时）整理成文字记录，随本轮消息一起发送
+CONTEXT_TEMPLATE = "【之前的对话】\n{transcript}\n\n【当前消息】\n{text}"
+CONTEXT_ROLE_NAMES = {"user": "用户", "assistant": "助手"}
+
+
+def system_prompt_hash(system: str) -> str:
+    return hashlib.sha256(system.encode("utf-8")).hexdigest()[:16]
+
 
 class CookieExpiredError(Exception):
     """Cookie 过期或无效异常"""
@@ -28,28 +47,33 @@ class ImageUploadError(Exception):
     pass
 
 
-@dataclass
+# 消息与响应对象不可变并使用 __slots__（没有实例 __dict__）：每个会话最多保留 max_history_messages 条消息，
+# 会话多时每个对象省下的几十字节会累积起来（见 benchmarks/bench_messages.py）
+@dataclass(frozen=True, slots=True)
 class Message:
-    """OpenAI 格式消息"""
+    """OpenAI 格式消息（role 驻留，所有消息共用同一个字符串对象）"""
     role: str
     content: Union[str, List[Dict[str, Any]]]
 
+    def __post_init__(self):
+        object.__setattr__(self, "role", sys.intern(self.role))
+
 
-@dataclass
+@dataclass(frozen=True, slots=True)
 class ChatCompletionChoice:
     index: int
     message: Message
     finish_reason: str = "stop"
 
 
-@dataclass
+@dataclass(frozen=True, slots=True)
 class Usage:
     prompt_tokens: int = 0
     completion_tokens: int = 0
     total_tokens: int = 0
 
 
-@dataclass
+@dataclass(frozen=True, slots=True)
 class ChatCompletionResponse:
     """OpenAI 格式响应"""
     id: str
@@ -81,6 +105,172 @@ class ChatCompletionResponse:
         }
 
 
+def build_request_envelope(
+    text: Any,
+    image_data: Any,
+    conv_id: Any,
+    resp_id: Any,
+    choice_id: Any,
+    snlm0e: Any,
+    session_id: Any,
+    timestamp: Any,
+) -> list:
+    """StreamGenerate 请求 f.req 的内层数组"""
+    # 构建内部 JSON 数组 (基于真实请求格式)
+    # 第一个元素: [text, 0, null, image_data, null, null, 0]
+    # 注意：URL 上下文可能需要添加到特定位置，当前先添加标记
+    return [
+        [text, 0, None, image_data, None, None, 0],
+        ["zh-CN"],
+        [conv_id, resp_id, choice_id, None, None, None, None, None, None, ""],
+        snlm0e,
+        None,  # 之前是 "test123"，改为 null
+        None,
+        [1],
+        1,
+        None,
+        None,
+        1,
+        0,
+        None,
+        None,
+        None,
+        None,
+        None,
+        [[0]],  # 模型相关字段，暂时使用 0
+        0,
+        None,
+        None,
+        None,
+        None,
+        None,
+        None,
+        None,
+        None,
+        1,
+        None,
+        None,
+        [4],
+        None,
+        None,
+        None,
+        None,
+        None,
+        None,
+        None,
+        None,
+        None,
+        None,
+        [1],
+        None,
+        None,
+        None,
+        None,
+        None,
+        None,
+        None,
+        None,
+        None,
+        None,
+        None,
+        0,
+        None,
+        None,
+        None,
+        None,
+        None,
+        session_id,
+        None,
+        [],  # 工具列表位置（URL 上下文等工具可以添加到这里）
+        None,
+        None,
+        None,
+        None,
+        timestamp,  # [秒, 纳秒]
+    ]
+
+
+# f.req 预编译模板：把内层数组和外层包装各序列化一次，可变字段处留空，之后每个请求只拼接字符串
+_ENVELOPE_FIELDS = 8
+_envelope_template: Optional[List[str]] = None
+
+
+def _get_envelope_template() -> List[str]:
+    global _envelope_template
+    if _envelope_template is None:
+        markers = [f"__ENVELOPE_FIELD_{i}__" for i in range(_ENVELOPE_FIELDS)]
+        inner_json = json.dumps(build_request_envelope(*markers), ensure_ascii=False, separators=(',', ':'))
+        template = json.dumps([None, inner_json], ensure_ascii=False, separators=(',', ':'))
+        segments = []
+        for marker in markers:
+            # 标记在内层是 "marker"，经外层转义后是 \"marker\"
+            head, template = template.split(f'\\"{marker}\\"')
+            segments.append(head)
+        segments.append(template)
+        _envelope_template = segments
+    return _envelope_template
+
+
+_encode_json_string = json.encoder.encode_basestring  # 与 json.dumps(str, ensure_ascii=False) 相同
+_envelope_encoder = json.JSONEncoder(ensure_ascii=False, separators=(',', ':'))
+
+
+def _encode_envelope_field(value: Any) -> str:
+    """字段值先按内层 JSON 序列化，再按外层字符串转义（与两次 json.dumps 的结果逐字节一致）"""
+    if value is None:
+        return "null"
+    if isinstance(value, str):
+        inner = _encode_json_string(value)
+    else:
+        inner = _envelope_encoder.encode(value)
+    return _encode_json_string(inner)[1:-1]
+
+
+def encode_request_envelope(
+    text: str,
+    image_data: Optional[list],
+    conv_id: str,
+    resp_id: str,
+    choice_id: str,
+    snlm0e: Optional[str],
+    session_id: str,
+    timestamp: List[int],
+) -> str:
+    """生成 f.req 表单值，等价于 json.dumps([None, json.dumps(build_request_envelope(...))])"""
+    segments = _get_envelope_template()
+    values = (text, image_data, conv_id, resp_id, choice_id, snlm0e, session_id, timestamp)
+    parts = [segments[0]]
+    for value, segment in zip(values, segments[1:]):
+        parts.append(_encode_envelope_field(value))
+        parts.append(segment)
+    return "".join(parts)
+
+
+class StreamHandle:
+    """
+    一次流式请求的取消状态
+    
+    每个流各自持有一个，同一个客户端上并发的多个流互不影响：取消只关闭自己的上游连接。
+    """
+    
+    __slots__ = ("response", "cancelled")
+    
+    def __init__(self):
+        self.response: Optional[httpx.Response] = None
+        self.cancelled = False
+    
+    def cancel(self):
+        """取消流式请求（可从其他线程调用）：关闭上游 httpx 连接，阻塞在读取上的生成器会立即结束"""
+        self.cancelled = True
+        resp = self.response
+        if resp is not None:
+            try:
+                resp.close()
+            except Exception:
+                # 连接已经关闭
+                pass
+
+
 class GeminiClient:
     """
     Gemini 网页版逆向客户端
@@ -96,6 +286,14 @@ class GeminiClient:
     
     BASE_URL = "https://gemini.google.com"
     
+    # 模型名 -> 网页版模型 ID（通过请求头 x-goog-ext-525001261-jspb 选择模型，未知模型使用网页版默认模型）
+    MODEL_IDS = {
+        "gemini-3.0-flash": "56fdd199312815e2",
+        "gemini-3.0-pro": "e6fa609c3fa255c0",
+        "gemini-3.0-flash-thinking": "e051ce1aa80aa576",
+    }
+    MODEL_HEADER = "x-goog-ext-525001261-jspb"
+    
     def __init__(
         self,
         secure_1psid: str,
@@ -107,6 +305,8 @@ class GeminiClient:
         push_id: str = None,
         proxy: str = None,
         debug: bool = False,
+        session_file: Optional[str] = "conversation_state.json",
+        summarize_history: bool = False,
     ):
         """
         初始化客户端 - 手动填写 token
@@ -121,8 +321,11 @@ class GeminiClient:
             push_id: Push ID for image upload (必填用于图片上传)
             proxy: 代理地址 (可选，格式: "http://proxy.example.com:8080" 或 "socks5://proxy.example.com:1080")
             debug: 是否打印调试信息
+            session_file: 会话状态文件路径（None 时不保存 / 恢复会话，如批处理使用的独立客户端）
+            summarize_history: 超出历史预算的消息压缩成摘要保留在历史开头，而不是直接丢弃
         """
         self.secure_1psid = secure_1psid
+        self.account = account_label(secure_1psid)  # 健康状态按账号记录
         self.secure_1psidts = secure_1psidts
         self.secure_1psidcc = secure_1psidcc
         self.snlm0e = snlm0e
@@ -185,14 +388,30 @@ class GeminiClient:
         self.choice_id: str = ""
         self.request_count: int = 0
         
-        # 消息历史
-        self.messages: List[Message] = []
+        # 模型路由表，以及按模型缓存的已编码请求头
+        self.model_ids: Dict[str, str] = dict(self.MODEL_IDS)
+        self._model_headers: Dict[str, Dict[str, bytes]] = {}
+        
+        # 消息历史（默认保留最近 50 轮对话，即 100 条消息；token 预算按模型的 inputTokenLimit 设置）
+        self.messages: MessageHistory = MessageHistory(
+            Message, max_messages=100, summarize=extractive_summary if summarize_history else None
+        )
+        
+        # 模型名 -> 消息历史的 token 预算（models.json 的 inputTokenLimit），未配置的模型不限制
+        self.history_token_limits: Dict[str, int] = {}
         
-        # 消息历史限制（默认保留最近 50 轮对话，即 100 条消息）
-        self.max_history_messages: int = 100
+        # 每轮对话结束后的会话快照（按 parent 组成树，分支对话共用前面的轮次），用于从任意一轮继续
+        self.checkpoints: List[Dict[str, Any]] = []
+        self.head_checkpoint: Optional[int] = None  # 当前分支最新一轮的快照 ID
+        self.max_checkpoints: int = 200
+        # 下一个快照 ID：只增不减，重置会话后也不重复使用，避免旧快照的历史被匹配到新对话上
+        self.next_checkpoint_id: int = 1
+        
+        # 当前会话已发送过的系统提示词的 hash（内容不变时不再重复发送）
+        self.system_hash: str = ""
         
         # 会话状态文件路径
-        self.session_file: str = "conversation_state.json"
+        self.session_file: Optional[str] = session_file
         
         # 验证必填参数
         if not self.snlm0e:
@@ -407,7 +626,7 @@ class GeminiClient:
             
             # 尝试解析 JSON
             try:
-                response_json = json.loads(response_text)
+                response_json = jsoncodec.loads(response_text)
                 image_path = self._extract_image_path(response_json)
             except json.JSONDecodeError:
                 # 如果不是 JSON，尝试从文本中提取路径
@@ -497,6 +716,43 @@ class GeminiClient:
                     return result
         return None
     
+    def set_model_ids(self, model_ids: Dict[str, str]):
+        """更新模型路由表（模型名 -> 网页版模型 ID）"""
+        self.model_ids = model_ids
+        self._model_headers = {}
+    
+    @property
+    def max_history_messages(self) -> int:
+        """消息历史最多保留的条数"""
+        return self.messages.max_messages
+    
+    @max_history_messages.setter
+    def max_history_messages(self, value: int):
+        self.messages.max_messages = value
+        self.messages.trim()
+    
+    def _apply_history_budget(self, model: str = None):
+        """按本轮使用的模型设置消息历史的 token 预算（切换到预算更小的模型时立即淘汰）"""
+        limit = self.history_token_limits.get((model or "").replace("models/", "")) or None
+        if limit != self.messages.max_tokens:
+            self.messages.max_tokens = limit
+            self.messages.trim()
+    
+    def _model_headers_for(self, model: str = None) -> Optional[Dict[str, bytes]]:
+        """选择模型的请求头，每个模型只编码一次"""
+        if not model:
+            return None
+        headers = self._model_headers.get(model)
+        if headers is None:
+            model_id = self.model_ids.get(model.replace("models/", ""))
+            if not model_id:
+                if self.debug:
+                    print(f"[DEBUG] 未配置模型 ID: {model}，使用默认模型")
+                return None
+            value = json.dumps([1, None, None, None, model_id, None, None, 0, [4], None, None, 2], separators=(",", ":"))
+            headers = self._model_headers[model] = {self.MODEL_HEADER: value.encode("ascii")}
+        return headers
+    
     def _build_request_data(self, text: str, images: List[Dict] = None, image_paths: List[str] = None, model: str = None, url_context: bool = False, tools: List[Dict] = None) -> str:
         """构建请求数据 - 基于真实请求格式
         
@@ -539,79 +795,6 @@ class GeminiClient:
         session_id = str(uuid.uuid4()).upper()
         timestamp = int(time.time() * 1000)
         
-        # 构建内部 JSON 数组 (基于真实请求格式)
-        # 第一个元素: [text, 0, null, image_data, null, null, 0]
-        # 注意：URL 上下文可能需要添加到特定位置，当前先添加标记
-        inner_data = [
-            [text, 0, None, image_data, None, None, 0],
-            ["zh-CN"],
-            [conv_id, resp_id, choice_id, None, None, None, None, None, None, ""],
-            self.snlm0e,
-            None,  # 之前是 "test123"，改为 null
-            None,
-            [1],
-            1,
-            None,
-            None,
-            1,
-            0,
-            None,
-            None,
-            None,
-            None,
-            None,
-            [[0]],  # 模型相关字段，暂时使用 0
-            0,
-            None,
-            None,
-            None,
-            None,
-            None,
-            None,
-            None,
-            None,
-            1,
-            None,
-            None,
-            [4],
-            None,
-            None,
-            None,
-            None,
-            None,
-            None,
-            None,
-            None,
-            None,
-            None,
-            [1],
-            None,
-            None,
-            None,
-            None,
-            None,
-            None,
-            None,
-            None,
-            None,
-            None,
-            None,
-            0,
-            None,
-            None,
-            None,
-            None,
-            None,
-            session_id,
-            None,
-            [],  # 工具列表位置（URL 上下文等工具可以添加到这里）
-            None,
-            None,
-            None,
-            None,
-            [timestamp // 1000, (timestamp % 1000) * 1000000]
-        ]
-        
         # 如果启用了 URL 上下文，尝试添加到工具列表位置
         # 注意：网页版 API 的工具格式可能需要特殊处理
         if url_context_flag is not None:
@@ -620,14 +803,17 @@ class GeminiClient:
             if self.debug:
                 print(f"[DEBUG] URL 上下文标记已设置（位置可能需要根据实际 API 调整）")
         
-        # 序列化为 JSON 字符串
-        inner_json = json.dumps(inner_data, ensure_ascii=False, separators=(',', ':'))
-        
-        # 外层包装
-        outer_data = [None, inner_json]
-        f_req_value = json.dumps(outer_data, ensure_ascii=False, separators=(',', ':'))
-        
-        return f_req_value
+        # 按预编译模板拼接 f.req（与分别序列化内外两层的结果逐字节一致）
+        return encode_request_envelope(
+            text,
+            image_data,
+            conv_id,
+            resp_id,
+            choice_id,
+            self.snlm0e,
+            session_id,
+            [timestamp // 1000, (timestamp % 1000) * 1000000],
+        )
 
     
     def _parse_response(self, response_text: str) -> str:
@@ -647,7 +833,7 @@ class GeminiClient:
                     continue
                 
                 try:
-                    data = json.loads(line)
+                    data = jsoncodec.loads(line)
                     # data 是一个嵌套数组，data[0] 才是真正的数据
                     if isinstance(data, list) and len(data) > 0 and isinstance(data[0], list):
                         actual_data = data[0]
@@ -665,7 +851,7 @@ class GeminiClient:
                                 # [3] 是知识库响应，不跳过，继续处理
                             
                             if actual_data[2]:
-                                inner_json = json.loads(actual_data[2])
+                                inner_json = jsoncodec.loads(actual_data[2])
                                 
                                 # 更新会话上下文（即使没有文本内容）
                                 if len(inner_json) > 1 and inner_json[1]:
@@ -844,7 +1030,8 @@ class GeminiClient:
         model: str = None,
         stream: bool = False,
         url_context: bool = False,
-        tools: List[Dict] = None
+        tools: List[Dict] = None,
+        context: List[Dict[str, Any]] = None,
     ) -> ChatCompletionResponse:
         """
         发送聊天请求 (OpenAI 兼容格式)
@@ -859,18 +1046,25 @@ class GeminiClient:
             stream: 是否流式响应
             url_context: 是否启用 URL 上下文
             tools: 工具列表（用于 URL 上下文等）
+            context: 会话中缺少、需要随本轮补发的历史消息（OpenAI 格式，只发送文本）
         
         Returns:
             ChatCompletionResponse: OpenAI 格式响应（流式时返回生成器）
         """
         if reset_context:
             self.reset()
+        self._apply_history_budget(model)
         
         # 处理输入
         text = ""
         images = []
+        system_parts = []
         
         if messages:
+            # 补发的历史消息排在本轮消息之前进入历史
+            for m in self._context_messages(context):
+                self.messages.append(Message(role=m["role"], content=m["content"]))
+            
             # OpenAI 格式 - 处理所有消息（保留历史上下文）
             # 只提取最后一条用户消息的内容用于发送
             for msg in messages:
@@ -887,16 +1081,10 @@ class GeminiClient:
                 elif role == "assistant":
                     # 保存 assistant 的回复到历史
                     self.messages.append(Message(role="assistant", content=content))
-                # 忽略 system 等其他角色的消息
-            
-            # 限制消息历史数量（保留最近的对话）
-            if len(self.messages) > self.max_history_messages:
-                # 保留最近的消息，删除最旧的消息
-                # 但要确保保留完整的对话对（user + assistant）
-                keep_count = self.max_history_messages
-                if keep_count % 2 == 1:  # 如果是奇数，减1确保是偶数（成对保留）
-                    keep_count -= 1
-                self.messages = self.messages[-keep_count:]
+                elif role == "system":
+                    # 系统提示词不进入历史，只在对话开始或内容变化时发送一次
+                    system_parts.append(self._parse_content(content)[0] if isinstance(content, list) else content)
+                # 忽略其他角色的消息（超出条数 / token 预算的消息在追加时已从最早一轮开始淘汰）
         elif message:
             text = message
             self.messages.append(Message(role="user", content=message))
@@ -919,11 +1107,42 @@ class GeminiClient:
         if not text:
             raise ValueError("消息内容不能为空")
         
+        system = "\n\n".join(part for part in system_parts if part) or None
+        
         # 发送请求
         if stream:
-            return self._send_stream_request(text, images, model, url_context, tools)
+            return self._send_stream_request(text, images, model, url_context, tools, system=system, context=context)
         else:
-            return self._send_request(text, images, model, url_context, tools)
+            return self._send_request(text, images, model, url_context, tools, system=system, context=context)
+    
+    @staticmethod
+    def _context_messages(context: Optional[List[Dict[str, Any]]]) -> List[Dict[str, str]]:
+        """补发的历史消息只保留文本"""
+        return [{"role": m["role"], "content": message_text(m["content"])} for m in context or []]
+    
+    def _apply_context(self, text: str, context: List[Dict[str, str]]) -> str:
+        """把需要补发的历史整理成文字记录放在本轮消息前面"""
+        if not context:
+            return text
+        transcript = "\n".join(f"{CONTEXT_ROLE_NAMES.get(m['role'], m['role'])}：{m['content']}" for m in context)
+        if self.debug:
+            print(f"[DEBUG] 补发 {len(context)} 条历史消息")
+        return CONTEXT_TEMPLATE.format(transcript=transcript, text=text)
+    
+    def _apply_system_prompt(self, text: str, system: Optional[str]) -> tuple:
+        """
+        需要时把系统提示词附在本轮消息前面
+        
+        新对话或系统提示词内容变化时才发送；返回 (实际发送的文本, 本轮成功后会话的系统提示词 hash)
+        """
+        if not system:
+            return text, self.system_hash
+        system_hash = system_prompt_hash(system)
+        if system_hash == self.system_hash and self.conversation_id:
+            return text, system_hash
+        if self.debug:
+            print(f"[DEBUG] 发送系统提示词（{len(system)} 字符）")
+        return SYSTEM_PROMPT_TEMPLATE.format(system=system, text=text), system_hash
 
     
     def _log_gemini_call(self, request_data: dict, response_text: str, error: str = None):
@@ -942,7 +1161,7 @@ class GeminiClient:
         except Exception as e:
             print(f"[LOG ERROR] 写入 Gemini 日志失败: {e}")
 
-    def _send_stream_request(self, text: str, images: List[Dict] = None, model: str = None, url_context: bool = False, tools: List[Dict] = None, image_paths: List[str] = None):
+    def _send_stream_request(self, text: str, images: List[Dict] = None, model: str = None, url_context: bool = False, tools: List[Dict] = None, image_paths: List[str] = None, system: str = None, context: List[Dict[str, Any]] = None, handle: StreamHandle = None):
         """发送流式请求到 Gemini（生成器）
         
         Args:
@@ -952,7 +1171,13 @@ class GeminiClient:
             url_context: 是否启用 URL 上下文
             tools: 工具列表
             image_paths: 已上传的图片路径列表（可选，如果提供则不会重新上传）
+            system: 系统提示词（已发送过且内容未变时不再发送）
+            context: 需要随本轮补发的历史消息
+            handle: 本次流的取消状态（见 open_stream），不传时不可从外部取消
         """
+        if handle is None:
+            handle = StreamHandle()
+        self._apply_history_budget(model)
         url = f"{self.BASE_URL}/_/BardChatUi/data/assistant.lamda.BardFrontendService/StreamGenerate"
         
         params = {
@@ -977,90 +1202,131 @@ class GeminiClient:
                 except Exception as e:
                     raise ImageUploadError(f"图片上传失败: {e}")
         
+        text = self._apply_context(text, self._context_messages(context))
+        text, system_hash = self._apply_system_prompt(text, system)
         req_data = self._build_request_data(text, images, image_paths, model, url_context, tools)
         form_data = {
             "f.req": req_data,
             "at": self.snlm0e,
         }
         
+        # 记录发送前的会话上下文，本轮被取消时回滚，保证下一轮从完整的上一轮继续
+        prev_context = (self.conversation_id, self.response_id, self.choice_id)
+        
         try:
-            # 使用 httpx 的流式请求
-            resp = self.session.post(url, params=params, data=form_data, timeout=1220.0)
-            resp.raise_for_status()
-            self.request_count += 1
-            
-            # 流式解析响应 - 跟踪已输出的内容，只输出增量
-            response_text = resp.text
-            lines = response_text.split("\n")
-            last_text = ""  # 跟踪上次输出的完整文本
-            
-            for line in lines:
-                line = line.strip()
-                if not line or line.startswith(")]}'") or line.isdigit():
-                    continue
+            # 使用 httpx 的流式请求，逐行读取；生成器关闭时连接随之关闭
+            with self.session.stream(
+                "POST", url, params=params, data=form_data, headers=self._model_headers_for(model), timeout=1220.0
+            ) as resp:
+                handle.response = resp
+                resp.raise_for_status()
+                self.request_count += 1
                 
-                try:
-                    data = json.loads(line)
-                    if isinstance(data, list) and len(data) > 0 and isinstance(data[0], list):
-                        actual_data = data[0]
-                        if len(actual_data) >= 3 and actual_data[0] == "wrb.fr" and actual_data[2]:
-                            inner_json = json.loads(actual_data[2])
-                            
-                            # 更新会话上下文
-                            if len(inner_json) > 1 and inner_json[1]:
-                                if isinstance(inner_json[1], list):
-                                    if len(inner_json[1]) > 0 and inner_json[1][0]:
-                                        self.conversation_id = inner_json[1][0] or self.conversation_id
-                                    if len(inner_json[1]) > 1 and inner_json[1][1]:
-                                        self.response_id = inner_json[1][1] or self.response_id
-                            
-                            # 提取文本内容
-                            if inner_json and len(inner_json) > 4 and inner_json[4]:
-                                candidates = inner_json[4]
-                                if candidates and len(candidates) > 0:
-                                    candidate = candidates[0]
-                                    if candidate and len(candidate) > 1 and candidate[1]:
-                                        content_parts = candidate[1]
-                                        
-                                        # 提取当前完整文本（包括图片）
-                                        current_text = ""
-                                        if isinstance(content_parts, list):
-                                            for part in content_parts:
-                                                if isinstance(part, str):
-                                                    # 清理换行符和空白字符
-                                                    part = part.strip()
-                                                    # 检查是否是图片 URL
-                                                    # 直接添加文本（不再处理图片生成 URL）
-                                                    current_text += part
-                                                elif isinstance(part, dict):
-                                                    if "text" in part:
-                                                        part_text = part["text"]
-                                                        # 直接添加文本
-                                                        current_text += part_text
-                                                    elif "content" in part:
-                                                        current_text += str(part["content"])
-                                                    elif "inlineData" in part:
-                                                        # 跳过 inlineData（图片生成功能已移除）
-                                                        if self.debug:
-                                                            print(f"[DEBUG] 流式响应中检测到 inlineData，已跳过")
-                                                        continue
-                                        elif isinstance(content_parts, str):
-                                            # 直接使用文本内容
-                                            current_text = content_parts
-                                        
-                                        # 只输出新增的部分（增量）
-                                        if current_text and len(current_text) > len(last_text):
-                                            new_text = current_text[len(last_text):]
-                                            if new_text:
-                                                yield new_text
-                                                last_text = current_text
-                except:
-                    continue
+                # 流式解析响应 - 只输出增量
+                for chunk in self._iter_stream_deltas(resp.iter_lines()):
+                    yield chunk
+                if not handle.cancelled:
+                    self.system_hash = system_hash
+                    health.record_success(self.account)
+        except GeneratorExit:
+            # 下游不再消费（客户端断开），丢弃本轮
+            self._rollback_stream_context(prev_context)
+            raise
         except Exception as e:
+            if handle.cancelled:
+                self._rollback_stream_context(prev_context)
+                return
+            status_code = e.response.status_code if isinstance(e, httpx.HTTPStatusError) else None
+            health.record_failure(self.account, str(e), status_code in EXPIRED_STATUS_CODES)
             raise Exception(f"流式请求失败: {e}")
+        finally:
+            handle.response = None
+    
+    def open_stream(self, **kwargs) -> tuple:
+        """
+        开始一次可取消的流式请求，返回 (StreamHandle, 生成器)
+        
+        handle.cancel() 关闭这个流的上游连接，会话上下文回滚到本轮之前；参数同 _send_stream_request
+        """
+        handle = StreamHandle()
+        return handle, self._send_stream_request(handle=handle, **kwargs)
+    
+    def _rollback_stream_context(self, prev_context: tuple):
+        """流式请求被取消时恢复会话上下文"""
+        self.conversation_id, self.response_id, self.choice_id = prev_context
+        self._save_session_state()
+        if self.debug:
+            print(f"[DEBUG] 流式请求已取消，会话上下文已回滚")
+    
+    def _iter_stream_deltas(self, lines):
+        """解析流式响应行，只输出新增的文本（增量）"""
+        last_text = ""
+        for line in lines:
+            line = line.strip()
+            if not line or line.startswith(")]}'") or line.isdigit():
+                continue
+            
+            try:
+                data = jsoncodec.loads(line)
+                if isinstance(data, list) and len(data) > 0 and isinstance(data[0], list):
+                    actual_data = data[0]
+                    if len(actual_data) >= 3 and actual_data[0] == "wrb.fr" and actual_data[2]:
+                        inner_json = jsoncodec.loads(actual_data[2])
+                        
+                        # 更新会话上下文
+                        if len(inner_json) > 1 and inner_json[1]:
+                            if isinstance(inner_json[1], list):
+                                if len(inner_json[1]) > 0 and inner_json[1][0]:
+                                    self.conversation_id = inner_json[1][0] or self.conversation_id
+                                if len(inner_json[1]) > 1 and inner_json[1][1]:
+                                    self.response_id = inner_json[1][1] or self.response_id
+                        
+                        # 提取文本内容
+                        if inner_json and len(inner_json) > 4 and inner_json[4]:
+                            candidates = inner_json[4]
+                            if candidates and len(candidates) > 0:
+                                candidate = candidates[0]
+                                if candidate and len(candidate) > 1 and candidate[1]:
+                                    content_parts = candidate[1]
+                                    
+                                    # 提取当前完整文本（包括图片）
+                                    current_text = ""
+                                    if isinstance(content_parts, list):
+                                        for part in content_parts:
+                                            if isinstance(part, str):
+                                                # 清理换行符和空白字符
+                                                part = part.strip()
+                                                # 检查是否是图片 URL
+                                                # 直接添加文本（不再处理图片生成 URL）
+                                                current_text += part
+                                            elif isinstance(part, dict):
+                                                if "text" in part:
+                                                    part_text = part["text"]
+                                                    # 直接添加文本
+                                                    current_text += part_text
+                                                elif "content" in part:
+                                                    current_text += str(part["content"])
+                                                elif "inlineData" in part:
+                                                    # 跳过 inlineData（图片生成功能已移除）
+                                                    if self.debug:
+                                                        print(f"[DEBUG] 流式响应中检测到 inlineData，已跳过")
+                                                    continue
+                                    elif isinstance(content_parts, str):
+                                        # 直接使用文本内容
+                                        current_text = content_parts
+                                    
+                                    # 只输出新增的部分（增量）
+                                    if current_text and len(current_text) > len(last_text):
+                                        new_text = current_text[len(last_text):]
+                                        if new_text:
+                                            yield new_text
+                                            last_text = current_text
+            except Exception:
+                # 单行解析失败直接跳过（不能吞掉 GeneratorExit）
+                continue
 
-    def _send_request(self, text: str, images: List[Dict] = None, model: str = None, url_context: bool = False, tools: List[Dict] = None) -> ChatCompletionResponse:
-        """发送请求到 Gemini"""
+    def _send_request(self, text: str, images: List[Dict] = None, model: str = None, url_context: bool = False, tools: List[Dict] = None, system: str = None, context: List[Dict[str, Any]] = None) -> ChatCompletionResponse:
+        """发送请求到 Gemini（system 为系统提示词，已发送过且内容未变时不再发送；context 为需要补发的历史消息）"""
         url = f"{self.BASE_URL}/_/BardChatUi/data/assistant.lamda.BardFrontendService/StreamGenerate"
         
         params = {
@@ -1097,6 +1363,10 @@ class GeminiClient:
                     # 其他错误也抛出，让调用者知道上传失败
                     raise ImageUploadError(f"图片上传失败: {e}")
         
+        user_text = text
+        context = self._context_messages(context)
+        text = self._apply_context(text, context)
+        text, system_hash = self._apply_system_prompt(text, system)
         req_data = self._build_request_data(text, images, image_paths, model, url_context, tools)
         
         form_data = {
@@ -1123,7 +1393,7 @@ class GeminiClient:
                 print(f"[DEBUG] 请求数据前300字符: {req_data[:300]}")
         
         try:
-            resp = self.session.post(url, params=params, data=form_data)
+            resp = self.session.post(url, params=params, data=form_data, headers=self._model_headers_for(model))
             
             if self.debug:
                 print(f"[DEBUG] 响应状态: {resp.status_code}")
@@ -1157,11 +1427,11 @@ class GeminiClient:
                             if not line or line.startswith(")]}'") or line.isdigit():
                                 continue
                             try:
-                                data = json.loads(line)
+                                data = jsoncodec.loads(line)
                                 if isinstance(data, list) and len(data) > 0 and isinstance(data[0], list):
                                     actual_data = data[0]
                                     if len(actual_data) >= 3 and actual_data[0] == "wrb.fr" and actual_data[2]:
-                                        inner_json = json.loads(actual_data[2])
+                                        inner_json = jsoncodec.loads(actual_data[2])
                                         print(f"[DEBUG] 响应结构: inner_json长度={len(inner_json) if inner_json else 0}")
                                         
                                         # 检查是否是流式响应的初始块
@@ -1288,7 +1558,7 @@ class GeminiClient:
                                 if not line or line.startswith(")]}'") or line.isdigit():
                                     continue
                                 try:
-                                    data = json.loads(line)
+                                    data = jsoncodec.loads(line)
                                     if isinstance(data, list) and len(data) > 0 and isinstance(data[0], list):
                                         actual_data = data[0]
                                         if (len(actual_data) >= 6 and actual_data[0] == "wrb.fr" and 
@@ -1313,13 +1583,18 @@ class GeminiClient:
                         else:
                             print(f"[DEBUG] 最终检查：未检测到知识库响应，返回无法解析响应")
             
-            # 保存助手回复
+            # 保存助手回复（token 按完整历史估算，不含本次回复）
+            prompt_tokens = tokens.REPLY_OVERHEAD + self.messages.tokens
             self.messages.append(Message(role="assistant", content=reply_text))
+            self.system_hash = system_hash
+            self._add_checkpoint(user_text, reply_text, context)
             
             # 保存会话状态（包括消息历史）
             self._save_session_state()
             
             # 构建 OpenAI 格式响应
+            usage = tokens.usage(prompt_tokens, reply_text)
+            health.record_success(self.account)
             return ChatCompletionResponse(
                 id=f"chatcmpl-{self.conversation_id or 'gemini'}-{int(time.time())}",
                 created=int(time.time()),
@@ -1331,22 +1606,24 @@ class GeminiClient:
                         finish_reason="stop"
                     )
                 ],
-                usage=Usage(
-                    prompt_tokens=len(text),
-                    completion_tokens=len(reply_text),
-                    total_tokens=len(text) + len(reply_text)
-                )
+                usage=Usage(**usage)
             )
             
         except httpx.HTTPStatusError as e:
             self._log_gemini_call(gemini_request_log, e.response.text if hasattr(e, 'response') else "", error=f"HTTP {e.response.status_code}")
+            health.record_failure(
+                self.account, f"HTTP {e.response.status_code}", e.response.status_code in EXPIRED_STATUS_CODES
+            )
             raise Exception(f"HTTP 错误: {e.response.status_code}")
         except Exception as e:
             self._log_gemini_call(gemini_request_log, "", error=str(e))
+            health.record_failure(self.account, str(e))
             raise Exception(f"请求失败: {e}")
     
     def _save_session_state(self):
         """保存会话状态到文件"""
+        if not self.session_file:
+            return
         try:
             state = {
                 "conversation_id": self.conversation_id,
@@ -1355,7 +1632,11 @@ class GeminiClient:
                 "messages": [
                     {"role": m.role, "content": m.content}
                     for m in self.messages
-                ]
+                ],
+                "checkpoints": self.checkpoints,
+                "head_checkpoint": self.head_checkpoint,
+                "next_checkpoint_id": self.next_checkpoint_id,
+                "system_hash": self.system_hash,
             }
             with open(self.session_file, "w", encoding="utf-8") as f:
                 json.dump(state, f, ensure_ascii=False, indent=2)
@@ -1367,6 +1648,8 @@ class GeminiClient:
     
     def _load_session_state(self):
         """从文件加载会话状态"""
+        if not self.session_file:
+            return
         try:
             if not os.path.exists(self.session_file):
                 if self.debug:
@@ -1383,17 +1666,18 @@ class GeminiClient:
             
             # 恢复消息历史
             messages_data = state.get("messages", [])
-            self.messages = [
+            self.messages.replace(
                 Message(role=msg["role"], content=msg["content"])
                 for msg in messages_data
-            ]
-            
-            # 限制消息历史数量
-            if len(self.messages) > self.max_history_messages:
-                keep_count = self.max_history_messages
-                if keep_count % 2 == 1:
-                    keep_count -= 1
-                self.messages = self.messages[-keep_count:]
+            )
+            self.checkpoints = state.get("checkpoints", [])
+            self.head_checkpoint = state.get("head_checkpoint")
+            # 旧版本的状态文件没有计数器，从已有快照之后继续
+            self.next_checkpoint_id = max(
+                state.get("next_checkpoint_id", 1),
+                self.checkpoints[-1]["id"] + 1 if self.checkpoints else 1,
+            )
+            self.system_hash = state.get("system_hash", "")
             
             if self.debug:
                 print(f"[DEBUG] 会话状态已恢复: conversation_id={self.conversation_id[:20] if self.conversation_id else 'None'}..., messages={len(self.messages)}条")
@@ -1404,17 +1688,23 @@ class GeminiClient:
             self.conversation_id = ""
             self.response_id = ""
             self.choice_id = ""
-            self.messages = []
+            self.messages.clear()
+            self.checkpoints = []
+            self.head_checkpoint = None
+            self.system_hash = ""
     
     def reset(self):
         """重置会话上下文"""
         self.conversation_id = ""
         self.response_id = ""
         self.choice_id = ""
-        self.messages = []
+        self.messages.clear()
+        self.checkpoints = []
+        self.head_checkpoint = None
+        self.system_hash = ""
         # 删除会话状态文件
         try:
-            if os.path.exists(self.session_file):
+            if self.session_file and os.path.exists(self.session_file):
                 os.remove(self.session_file)
                 if self.debug:
                     print(f"[DEBUG] 会话状态文件已删除")
@@ -1422,6 +1712,122 @@ class GeminiClient:
             if self.debug:
                 print(f"[DEBUG] 删除会话状态文件失败: {e}")
     
+    def checkpoint(self) -> tuple:
+        """当前会话位置 (conversation_id, response_id, choice_id)，之后可用 restore() 从这里继续"""
+        return (self.conversation_id, self.response_id, self.choice_id)
+    
+    def restore(self, checkpoint: tuple, messages: List[Dict[str, Any]] = None):
+        """
+        从会话快照继续（分叉）：下一条消息接在快照那一轮之后，而不是最新一轮
+        
+        Args:
+            checkpoint: checkpoint() 返回的 (conversation_id, response_id, choice_id)
+            messages: 快照之前的消息历史（OpenAI 格式，可选）
+        """
+        self.conversation_id, self.response_id, self.choice_id = checkpoint
+        self.messages.replace(Message(role=m["role"], content=m["content"]) for m in messages or [])
+        self.head_checkpoint = None
+        self.system_hash = ""
+    
+    def _add_checkpoint(
+        self,
+        user_content: Union[str, List[Dict[str, Any]]],
+        reply_text: str,
+        context: List[Dict[str, str]] = None,
+    ) -> int:
+        """记录本轮结束后的会话快照，作为当前分支的最新一轮，返回快照 ID（context 为本轮补发的历史消息）"""
+        checkpoint_id = self.next_checkpoint_id
+        self.next_checkpoint_id += 1
+        checkpoint = {
+            "id": checkpoint_id,
+            "parent": self.head_checkpoint,
+            "state": list(self.checkpoint()),
+            "system_hash": self.system_hash,
+            "user": message_text(user_content),
+            "reply": reply_text,
+            "created": int(time.time()),
+        }
+        if context:
+            checkpoint["context"] = context
+        self._append_checkpoint(checkpoint)
+        self.head_checkpoint = checkpoint_id
+        return checkpoint_id
+    
+    def _append_checkpoint(self, checkpoint: Dict[str, Any]):
+        self.checkpoints.append(checkpoint)
+        if len(self.checkpoints) > self.max_checkpoints:
+            del self.checkpoints[:len(self.checkpoints) - self.max_checkpoints]
+    
+    def adopt_checkpoint(self, checkpoint: Dict[str, Any]) -> int:
+        """
+        把另一个客户端上新对话的第一轮加入快照列表（作为一段新对话的开头），返回新的快照 ID
+        
+        不切换当前分支；之后带着这一轮历史的请求可以 fork 到该快照继续，不必重放。
+        """
+        checkpoint_id = self.next_checkpoint_id
+        self.next_checkpoint_id += 1
+        self._append_checkpoint({**checkpoint, "id": checkpoint_id, "parent": None})
+        self._save_session_state()
+        return checkpoint_id
+    
+    def get_checkpoint(self, checkpoint_id: int) -> Optional[Dict[str, Any]]:
+        for checkpoint in reversed(self.checkpoints):
+            if checkpoint["id"] == checkpoint_id:
+                return checkpoint
+        return None
+    
+    def checkpoint_path(self, checkpoint_id: int) -> List[Dict[str, Any]]:
+        """从第一轮到指定快照的各轮（更早的快照已被淘汰时从能找到的最早一轮开始）"""
+        path = []
+        checkpoint = self.get_checkpoint(checkpoint_id)
+        while checkpoint is not None:
+            path.append(checkpoint)
+            checkpoint = self.get_checkpoint(checkpoint["parent"]) if checkpoint["parent"] is not None else None
+        path.reverse()
+        return path
+    
+    def fork(self, checkpoint_id: Optional[int]):
+        """
+        从某一轮之后继续（重新生成、编辑后重发、分支对话），下一条消息只需一次上游请求
+        
+        Args:
+            checkpoint_id: 快照 ID，None 表示从对话开头（第一轮之前）继续
+        
+        Raises:
+            KeyError: 快照不存在
+        """
+        if checkpoint_id is None:
+            self.restore(("", "", ""))
+            self.system_hash = ""
+        else:
+            checkpoint = self.get_checkpoint(checkpoint_id)
+            if checkpoint is None:
+                raise KeyError(f"快照不存在: {checkpoint_id}")
+            history = []
+            for turn in self.checkpoint_path(checkpoint_id):
+                history.extend(turn.get("context", []))
+                history.append({"role": "user", "content": turn["user"]})
+                history.append({"role": "assistant", "content": turn["reply"]})
+            self.restore(tuple(checkpoint["state"]), history)
+            self.head_checkpoint = checkpoint_id
+            self.system_hash = checkpoint.get("system_hash", "")
+        self._save_session_state()
+    
+    def record_turn(
+        self,
+        user_content: Union[str, List[Dict[str, Any]]],
+        reply_text: str,
+        context: List[Dict[str, Any]] = None,
+    ):
+        """记录一轮完整的流式对话到消息历史（流式请求不经过 chat()），context 为本轮补发的历史消息"""
+        context = self._context_messages(context)
+        for m in context:
+            self.messages.append(Message(role=m["role"], content=m["content"]))
+        self.messages.append(Message(role="user", content=user_content))
+        self.messages.append(Message(role="assistant", content=reply_text))
+        self._add_checkpoint(user_content, reply_text, context)
+        self._save_session_state()
+    
     def get_history(self) -> List[Dict]:
         """获取消息历史 (OpenAI 格式)"""
         return [{"role": m.role, "content": m.content} for m in self.messages]
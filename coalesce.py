@@ -0,0 +1,147 @@
+"""
+相同请求合并（single-flight）
+
+同一时刻到达的相同无状态请求只向上游发起一次生成：
+  - 第一个请求（leader）登记一个 Flight 并负责生成，结果通过 publish / finish 发布
+  - 之后到达的相同请求（follower）订阅这个 Flight：先重放已输出的增量，再实时接收后续增量
+  - 流式生成由独立任务驱动，任一订阅者断开不影响其他订阅者；所有订阅者都离开后才取消上游
+"""
+
+import asyncio
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional
+
+from metrics import metrics
+
+
+class FlightCancelled(Exception):
+    """所有订阅者都已离开，上游生成被取消"""
+
+
+class Flight:
+    """一次进行中的上游生成"""
+
+    def __init__(self, key: Optional[str] = None, registry: Optional["SingleFlight"] = None):
+        self.key = key
+        self.chunks: List[str] = []
+        self.usage: Optional[Dict[str, Any]] = None
+        self.error: Optional[BaseException] = None
+        self.done = False
+        self.started = False
+        self.subscribers = 0
+        self._registry = registry
+        self._changed = asyncio.Event()
+        self._producer: Optional[Callable[["Flight"], Awaitable[None]]] = None
+        self._task: Optional[asyncio.Task] = None
+        self._abandon_callbacks: List[Callable[[], None]] = []
+
+    @property
+    def text(self) -> str:
+        return "".join(self.chunks)
+
+    def set_producer(self, producer: Callable[["Flight"], Awaitable[None]]):
+        """
+        设置流式生成任务，在第一个订阅者开始读取时启动
+
+        订阅者一直没有出现（客户端在流开始前断开）时不会请求上游
+        """
+        self._producer = producer
+
+    def on_abandon(self, callback: Callable[[], None]):
+        """所有订阅者离开且生成尚未结束时调用（用于取消上游）"""
+        self._abandon_callbacks.append(callback)
+
+    def publish(self, chunk: str):
+        if self.done or not chunk:
+            return
+        self.chunks.append(chunk)
+        self._notify()
+
+    def finish(self, error: Optional[BaseException] = None, usage: Optional[Dict[str, Any]] = None):
+        """结束生成（可重复调用，只有第一次生效）"""
+        if self.done:
+            return
+        self.done = True
+        self.error = error
+        self.usage = usage
+        if self._registry is not None:
+            self._registry.discard(self)
+        self._notify()
+
+    def _notify(self):
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+    def _ensure_started(self):
+        if self.started or self._producer is None or self.done:
+            return
+        self.started = True
+        self._task = asyncio.ensure_future(self._run())
+
+    async def _run(self):
+        try:
+            await self._producer(self)
+        except BaseException as e:
+            self.finish(error=e)
+            if not isinstance(e, Exception):
+                raise
+        finally:
+            self.finish()
+
+    async def subscribe(self) -> AsyncIterator[str]:
+        """重放已输出的增量，然后实时接收后续增量；生成失败时抛出原异常"""
+        self.subscribers += 1
+        try:
+            self._ensure_started()
+            index = 0
+            while True:
+                changed = self._changed
+                while index < len(self.chunks):
+                    index += 1
+                    yield self.chunks[index - 1]
+                if self.done:
+                    break
+                await changed.wait()
+            if self.error is not None:
+                raise self.error
+        finally:
+            self.subscribers -= 1
+            if self.subscribers == 0 and self.started and not self.done:
+                for callback in self._abandon_callbacks:
+                    callback()
+                self.finish(error=FlightCancelled("所有订阅者已断开"))
+
+    async def result(self) -> str:
+        """等待生成完成并返回完整内容"""
+        async for _ in self.subscribe():
+            pass
+        return self.text
+
+
+class SingleFlight:
+    """按请求键登记进行中的 Flight"""
+
+    def __init__(self):
+        self._flights: Dict[str, Flight] = {}
+
+    def __len__(self) -> int:
+        return len(self._flights)
+
+    def get(self, key: str) -> Optional[Flight]:
+        """返回进行中的相同请求（follower 订阅它），没有则返回 None"""
+        flight = self._flights.get(key)
+        if flight is None or flight.done:
+            return None
+        metrics.inc("gemini_coalesced_requests_total")
+        return flight
+
+    def start(self, key: str) -> Flight:
+        """登记一个新的 Flight（leader 调用），结束时自动注销"""
+        flight = Flight(key, self)
+        self._flights[key] = flight
+        metrics.set("gemini_inflight_generations", len(self._flights))
+        return flight
+
+    def discard(self, flight: Flight):
+        if self._flights.get(flight.key) is flight:
+            del self._flights[flight.key]
+            metrics.set("gemini_inflight_generations", len(self._flights))
@@ -0,0 +1,175 @@
+"""
+响应压缩中间件
+
+按请求头 Accept-Encoding 协商 br（需要安装 brotli）或 gzip：
+  - 普通响应（JSON / HTML / 文本）: 超过 minimum_size 字节才压缩，一次性压缩整个响应体
+  - SSE 流式响应: 由 sse_policy 决定
+      flush: 每个事件单独压缩并立即刷新（同一个压缩流，后续事件可以引用前面的重复内容），不会积攒数据造成延迟
+      off:   不压缩
+  - 已经带 Content-Encoding 的响应、其他流式响应原样输出
+"""
+
+import zlib
+from typing import Dict, List, Optional, Tuple
+
+from metrics import metrics
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+
+# 值得压缩的 Content-Type（前缀匹配）
+COMPRESSIBLE_TYPES = ("application/json", "text/", "application/javascript")
+SSE_TYPE = "text/event-stream"
+
+
+def negotiate_encoding(accept_encoding: str) -> Optional[str]:
+    """根据 Accept-Encoding 选择 br / gzip，都不接受时返回 None"""
+    if not accept_encoding:
+        return None
+    quality: Dict[str, float] = {}
+    for item in accept_encoding.split(","):
+        name, _, params = item.strip().partition(";")
+        q = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        quality[name.strip().lower()] = q
+    wildcard = quality.get("*", 0.0)
+    candidates = (["br"] if brotli is not None else []) + ["gzip"]
+    best, best_q = None, 0.0
+    for name in candidates:
+        q = quality.get(name, wildcard)
+        if q > best_q:
+            best, best_q = name, q
+    return best
+
+
+class _Compressor:
+    """gzip / br 压缩流"""
+
+    def __init__(self, encoding: str):
+        self.encoding = encoding
+        if encoding == "br":
+            self._br = brotli.Compressor(quality=BROTLI_QUALITY)
+        else:
+            self._gz = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def flush(self, data: bytes) -> bytes:
+        """压缩 data 并立即刷新（接收方不等后续数据就能解压出这部分）"""
+        if self.encoding == "br":
+            return self._br.process(data) + self._br.flush()
+        return self._gz.compress(data) + self._gz.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self, data: bytes = b"") -> bytes:
+        if self.encoding == "br":
+            return self._br.process(data) + self._br.finish()
+        return self._gz.compress(data) + self._gz.flush()
+
+
+def _header(headers: List[Tuple[bytes, bytes]], name: bytes) -> Optional[bytes]:
+    for key, value in headers:
+        if key.lower() == name:
+            return value
+    return None
+
+
+def _encoded_headers(headers: List[Tuple[bytes, bytes]], encoding: str, length: Optional[int]):
+    """替换 Content-Length，加上 Content-Encoding 和 Vary"""
+    result = [(k, v) for k, v in headers if k.lower() not in (b"content-length", b"content-encoding")]
+    if length is not None:
+        result.append((b"content-length", str(length).encode("latin-1")))
+    result.append((b"content-encoding", encoding.encode("latin-1")))
+    vary = _header(result, b"vary")
+    if vary is None:
+        result.append((b"vary", b"Accept-Encoding"))
+    elif b"accept-encoding" not in vary.lower():
+        result = [(k, v + b", Accept-Encoding" if k.lower() == b"vary" else v) for k, v in result]
+    return result
+
+
+class CompressionMiddleware:
+    """
+    纯 ASGI 中间件（不包装成 BaseHTTPMiddleware，避免流式响应被缓冲）
+
+    用法:
+        app.add_middleware(CompressionMiddleware, minimum_size=1024, sse_policy="flush")
+    """
+
+    def __init__(self, app, minimum_size: int = 1024, sse_policy: str = "flush"):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.sse_policy = sse_policy
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        accept = ""
+        for key, value in scope.get("headers", []):
+            if key == b"accept-encoding":
+                accept = value.decode("latin-1")
+                break
+        encoding = negotiate_encoding(accept)
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+
+        start_message: Optional[dict] = None
+        # None: 尚未决定；"plain": 原样输出；"stream": 按事件压缩
+        mode: Optional[str] = None
+        compressor: Optional[_Compressor] = None
+
+        async def send_wrapper(message):
+            nonlocal start_message, mode, compressor
+            if message["type"] == "http.response.start":
+                start_message = message
+                return
+            if message["type"] != "http.response.body" or mode == "plain":
+                await send(message)
+                return
+
+            body = message.get("body", b"")
+            more_body = message.get("more_body", False)
+            if mode == "stream":
+                data = compressor.flush(body) if more_body else compressor.finish(body)
+                await send({"type": "http.response.body", "body": data, "more_body": more_body})
+                return
+
+            headers = list(start_message.get("headers", []))
+            content_type = (_header(headers, b"content-type") or b"").decode("latin-1")
+            if _header(headers, b"content-encoding") is not None:
+                mode = "plain"
+            elif not more_body:
+                # 一次性响应：超过阈值且类型可压缩才压缩
+                if len(body) >= self.minimum_size and content_type.startswith(COMPRESSIBLE_TYPES):
+                    compressed = _Compressor(encoding).finish(body)
+                    metrics.inc("gemini_compression_saved_bytes_total", len(body) - len(compressed), encoding=encoding)
+                    start_message["headers"] = _encoded_headers(headers, encoding, len(compressed))
+                    await send(start_message)
+                    await send({"type": "http.response.body", "body": compressed})
+                    return
+                mode = "plain"
+            elif content_type.startswith(SSE_TYPE) and self.sse_policy == "flush":
+                mode = "stream"
+                compressor = _Compressor(encoding)
+                start_message["headers"] = _encoded_headers(headers, encoding, None)
+                await send(start_message)
+                await send({"type": "http.response.body", "body": compressor.flush(body), "more_body": True})
+                return
+            else:
+                mode = "plain"
+            if _header(headers, b"vary") is None and content_type.startswith(COMPRESSIBLE_TYPES):
+                start_message["headers"] = headers + [(b"vary", b"Accept-Encoding")]
+            await send(start_message)
+            await send(message)
+
+        await self.app(scope, receive, send_wrapper)
+
@@ -0,0 +1,178 @@
+"""
+上下文缓存（Gemini cachedContents）
+
+网页版没有上下文缓存接口，这里用会话快照实现：创建缓存时把系统指令和文档内容作为第一轮消息发给 Gemini，
+记下这一轮之后的会话位置 (conversation_id, response_id, choice_id)。之后引用该缓存的请求从快照处分叉，
+只发送新的用户消息，不再重复上传前缀（也省去上游对前缀的处理时间）。
+
+快照保存在 JSON 文件中，服务重启后仍然可用；过期的条目在读取时删除。
+"""
+
+import hashlib
+import json
+import os
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional, Tuple
+
+# 会话快照: (conversation_id, response_id, choice_id)
+Checkpoint = Tuple[str, str, str]
+
+NAME_PREFIX = "cachedContents/"
+
+
+def parse_ttl(ttl: Optional[str]) -> Optional[float]:
+    """解析 Gemini 的 Duration 字符串（如 "3600s"、"1.5s"），格式错误时抛出 ValueError"""
+    if ttl is None:
+        return None
+    value = str(ttl).strip()
+    if not value.endswith("s"):
+        raise ValueError(f"ttl 格式错误: {ttl}（应为如 \"3600s\" 的秒数）")
+    seconds = float(value[:-1])
+    if seconds <= 0:
+        raise ValueError("ttl 必须大于 0")
+    return seconds
+
+
+def parse_timestamp(value: str) -> float:
+    """解析 RFC 3339 时间（如 "2025-01-01T00:00:00Z"）"""
+    return datetime.fromisoformat(value.replace("Z", "+00:00")).timestamp()
+
+
+def format_timestamp(ts: float) -> str:
+    return datetime.fromtimestamp(ts, timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+
+
+def content_hash(model: str, contents: List[Dict[str, Any]], system_instruction: Optional[Dict[str, Any]]) -> str:
+    """缓存内容的指纹，相同内容重复创建时复用已有快照"""
+    payload = json.dumps(
+        {"model": model, "contents": contents, "systemInstruction": system_instruction},
+        ensure_ascii=False,
+        sort_keys=True,
+        separators=(",", ":"),
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class CachedContentStore:
+    """
+    上下文缓存条目的存储
+
+    用法:
+        store = CachedContentStore("cached_contents.json")
+        entry = store.create("gemini-3.0-flash", checkpoint, total_tokens=1200, ttl=3600)
+        store.get(entry["name"])["checkpoint"]
+    """
+
+    def __init__(self, path: Optional[str] = "cached_contents.json"):
+        self.path = path
+        self._lock = threading.Lock()
+        self._entries: Dict[str, Dict[str, Any]] = {}
+        self._load()
+
+    def _load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                self._entries = {entry["name"]: entry for entry in json.load(f)}
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            print(f"[WARN] 读取上下文缓存失败: {e}")
+
+    def _save(self):
+        if not self.path:
+            return
+        tmp = f"{self.path}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(list(self._entries.values()), f, ensure_ascii=False, indent=2)
+        os.replace(tmp, self.path)
+
+    def _purge_expired(self) -> bool:
+        now = time.time()
+        expired = [name for name, entry in self._entries.items() if entry["expire_time"] <= now]
+        for name in expired:
+            del self._entries[name]
+        return bool(expired)
+
+    def create(
+        self,
+        model: str,
+        checkpoint: Checkpoint,
+        total_tokens: int,
+        ttl: float,
+        display_name: str = "",
+        fingerprint: str = "",
+    ) -> Dict[str, Any]:
+        now = time.time()
+        entry = {
+            "name": f"{NAME_PREFIX}{uuid.uuid4().hex[:16]}",
+            "model": model,
+            "display_name": display_name,
+            "checkpoint": list(checkpoint),
+            "total_tokens": total_tokens,
+            "fingerprint": fingerprint,
+            "create_time": now,
+            "update_time": now,
+            "expire_time": now + ttl,
+        }
+        with self._lock:
+            self._purge_expired()
+            self._entries[entry["name"]] = entry
+            self._save()
+        return dict(entry)
+
+    def get(self, name: str) -> Optional[Dict[str, Any]]:
+        """按名称（cachedContents/xxx 或 xxx）查找未过期的条目"""
+        if not name.startswith(NAME_PREFIX):
+            name = NAME_PREFIX + name
+        with self._lock:
+            if self._purge_expired():
+                self._save()
+            entry = self._entries.get(name)
+            return dict(entry) if entry else None
+
+    def find(self, fingerprint: str) -> Optional[Dict[str, Any]]:
+        """查找内容相同且未过期的条目"""
+        with self._lock:
+            for entry in self._entries.values():
+                if entry["fingerprint"] == fingerprint and entry["expire_time"] > time.time():
+                    return dict(entry)
+        return None
+
+    def list(self) -> List[Dict[str, Any]]:
+        with self._lock:
+            if self._purge_expired():
+                self._save()
+            return sorted((dict(e) for e in self._entries.values()), key=lambda e: e["create_time"], reverse=True)
+
+    def update_expiry(self, name: str, expire_time: float) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry is None:
+                return None
+            entry["expire_time"] = expire_time
+            entry["update_time"] = time.time()
+            self._save()
+            return dict(entry)
+
+    def delete(self, name: str) -> bool:
+        with self._lock:
+            if self._entries.pop(name, None) is None:
+                return False
+            self._save()
+            return True
+
+
+def to_resource(entry: Dict[str, Any]) -> Dict[str, Any]:
+    """Gemini CachedContent 资源格式（不返回内容本身，与官方 API 一致）"""
+    return {
+        "name": entry["name"],
+        "model": f"models/{entry['model']}",
+        "displayName": entry["display_name"],
+        "usageMetadata": {"totalTokenCount": entry["total_tokens"]},
+        "createTime": format_timestamp(entry["create_time"]),
+        "updateTime": format_timestamp(entry["update_time"]),
+        "expireTime": format_timestamp(entry["expire_time"]),
+    }
@@ -0,0 +1,118 @@
+"""
+上游账号健康状态
+
+/healthz 只说明进程存活；/readyz 读取这里缓存的状态，判断实例是否还能成功生成：
+  - 被动记录：GeminiClient 每次生成成功、或上游返回 401 / 403（Cookie 失效）时更新
+  - 主动探测：后台任务定期请求 Gemini 页面检查 Cookie（最近已有成功生成时跳过，不额外请求上游）
+
+健康检查本身从不请求上游，负载均衡器频繁检查也没有额外开销。
+"""
+
+import hashlib
+import threading
+import time
+from typing import Any, Dict, Optional
+
+# 凭证状态
+CREDENTIAL_UNKNOWN = "unknown"  # 启动后还没有生成或探测结果
+CREDENTIAL_OK = "ok"
+CREDENTIAL_EXPIRED = "expired"  # Cookie 失效，需要在后台重新配置
+
+# 上游返回这些状态码时认为 Cookie 已失效
+EXPIRED_STATUS_CODES = (401, 403)
+
+
+def account_label(secure_1psid: str) -> str:
+    """账号标识（__Secure-1PSID 的摘要，用于指标和健康状态，不暴露原始 cookie）"""
+    return hashlib.sha1((secure_1psid or "").encode()).hexdigest()[:8]
+
+
+class _AccountHealth:
+    __slots__ = ("credential", "last_success", "last_error", "last_error_time", "last_probe")
+
+    def __init__(self):
+        self.credential = CREDENTIAL_UNKNOWN
+        self.last_success = 0.0
+        self.last_error = ""
+        self.last_error_time = 0.0
+        self.last_probe = 0.0
+
+
+class HealthMonitor:
+    """
+    按账号记录凭证状态和最近一次成功生成的时间（线程安全，生成在线程池中进行）
+
+    用法:
+        health.record_success(account)
+        health.record_failure(account, "HTTP 401", credential_expired=True)
+        health.snapshot(account)
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._accounts: Dict[str, _AccountHealth] = {}
+
+    def _get(self, account: str) -> _AccountHealth:
+        state = self._accounts.get(account)
+        if state is None:
+            state = self._accounts[account] = _AccountHealth()
+        return state
+
+    def record_success(self, account: str):
+        """一次生成成功：凭证有效"""
+        with self._lock:
+            state = self._get(account)
+            state.credential = CREDENTIAL_OK
+            state.last_success = time.time()
+
+    def record_failure(self, account: str, error: str, credential_expired: bool = False):
+        """一次生成失败；credential_expired 为 True 时标记凭证失效（网络错误等不改变凭证状态）"""
+        with self._lock:
+            state = self._get(account)
+            state.last_error = error[:200]
+            state.last_error_time = time.time()
+            if credential_expired:
+                state.credential = CREDENTIAL_EXPIRED
+
+    def record_probe(self, account: str, credential: Optional[str], error: str = ""):
+        """后台探测结果；credential 为 None 表示探测本身失败（如网络错误），不改变凭证状态"""
+        with self._lock:
+            state = self._get(account)
+            state.last_probe = time.time()
+            if credential is not None:
+                state.credential = credential
+            if error:
+                state.last_error = error[:200]
+                state.last_error_time = state.last_probe
+
+    def needs_probe(self, account: str, interval: float) -> bool:
+        """距上次成功生成和上次探测都超过 interval 秒时才需要探测"""
+        with self._lock:
+            state = self._get(account)
+            return time.time() - max(state.last_success, state.last_probe) >= interval
+
+    def forget(self, account: str):
+        """账号配置更换后丢弃旧状态"""
+        with self._lock:
+            self._accounts.pop(account, None)
+
+    def snapshot(self, account: str) -> Dict[str, Any]:
+        now = time.time()
+        with self._lock:
+            state = self._get(account)
+            return {
+                "account": account,
+                "credential": state.credential,
+                "last_success": _timestamp(state.last_success),
+                "last_success_age_seconds": round(now - state.last_success, 1) if state.last_success else None,
+                "last_error": state.last_error or None,
+                "last_error_time": _timestamp(state.last_error_time),
+                "last_probe": _timestamp(state.last_probe),
+            }
+
+
+def _timestamp(value: float) -> Optional[int]:
+    return int(value) if value else None
+
+
+health = HealthMonitor()
@@ -0,0 +1,172 @@
+"""
+消息历史窗口
+
+deque 保存消息，同时维护累计 token 数（按 tokens.py 估算，与 usage 的口径一致）；
+追加消息后超出条数或 token 预算时从左侧淘汰最早的消息，每条消息只进出一次，均摊 O(1)，
+不再每次请求都用切片复制整个列表。
+
+淘汰以轮为单位：淘汰一条用户消息时，紧随其后的助手回复一并淘汰，不会留下开头孤立的回复。
+最新的一条消息永远保留（即使它自己就超出预算）。
+
+可选的摘要淘汰：淘汰的消息不直接丢弃，而是压缩成一条 system 消息放在历史开头，
+默认摘取每条消息的开头部分（不请求模型），总长度有上限。
+"""
+
+from collections import deque
+from typing import Any, Callable, Deque, Iterable, Iterator, List, Optional
+
+import tokens
+from matcher import message_text
+
+# 摘要消息的前缀（会话状态文件中据此识别摘要）
+SUMMARY_PREFIX = "【较早的对话摘要】\n"
+# 摘要中每条消息最多保留的字符数、摘要的总字符数上限（超出时保留最近的部分）
+SUMMARY_LINE_CHARS = 100
+SUMMARY_MAX_CHARS = 2000
+
+SUMMARY_ROLE_NAMES = {"user": "用户", "assistant": "助手"}
+
+
+def message_cost(message: Any) -> int:
+    """一条消息的估算 token 数（含每条消息的固定开销）"""
+    return tokens.MESSAGE_OVERHEAD + tokens.count_content(message.content)
+
+
+def extractive_summary(previous: str, evicted: List[Any]) -> str:
+    """默认摘要：之前的摘要 + 每条淘汰消息的开头部分，超出上限时丢弃最早的内容"""
+    lines = [previous] if previous else []
+    for message in evicted:
+        text = " ".join(message_text(message.content).split())
+        if len(text) > SUMMARY_LINE_CHARS:
+            text = text[:SUMMARY_LINE_CHARS] + "…"
+        lines.append(f"{SUMMARY_ROLE_NAMES.get(message.role, message.role)}：{text}")
+    return "\n".join(lines)[-SUMMARY_MAX_CHARS:]
+
+
+class MessageHistory:
+    """
+    有条数 / token 预算的消息历史
+
+    用法:
+        history = MessageHistory(Message, max_messages=100)
+        history.max_tokens = 1048576  # 按模型的 inputTokenLimit 设置
+        history.append(Message(role="user", content="你好"))
+        history.tokens  # 当前历史的估算 token 数
+    """
+
+    def __init__(
+        self,
+        message_factory: Callable[..., Any],
+        max_messages: int = 100,
+        max_tokens: Optional[int] = None,
+        summarize: Optional[Callable[[str, List[Any]], str]] = None,
+    ):
+        """
+        Args:
+            message_factory: 创建消息对象（role=, content=），用于生成摘要消息
+            max_messages: 最多保留的消息条数（不含摘要）
+            max_tokens: token 预算（含摘要），None 表示不限制
+            summarize: 摘要函数 (之前的摘要文本, 淘汰的消息) -> 新的摘要文本，None 表示直接丢弃
+        """
+        self._factory = message_factory
+        self._items: Deque[Any] = deque()
+        self._costs: Deque[int] = deque()
+        self._summary: Optional[Any] = None
+        self._summary_cost = 0
+        self.tokens = 0
+        self.max_messages = max_messages
+        self.max_tokens = max_tokens
+        self.summarize = summarize
+
+    def __len__(self) -> int:
+        return len(self._items) + (self._summary is not None)
+
+    def __iter__(self) -> Iterator[Any]:
+        if self._summary is not None:
+            yield self._summary
+        yield from self._items
+
+    def __getitem__(self, index: int) -> Any:
+        """按位置取一条消息（只支持整数下标，末尾 O(1)）"""
+        if self._summary is None:
+            return self._items[index]
+        if index == 0 or index == -len(self):
+            return self._summary
+        return self._items[index - 1 if index > 0 else index]
+
+    def __bool__(self) -> bool:
+        return bool(self._items) or self._summary is not None
+
+    @property
+    def summary(self) -> Optional[str]:
+        """淘汰消息的摘要文本（未启用摘要或还没有淘汰时为 None）"""
+        return self._summary.content[len(SUMMARY_PREFIX):] if self._summary is not None else None
+
+    def append(self, message: Any):
+        """追加一条消息，超出预算时淘汰最早的消息"""
+        self._push(message)
+        self.trim()
+
+    def extend(self, messages: Iterable[Any]):
+        for message in messages:
+            self._push(message)
+        self.trim()
+
+    def replace(self, messages: Iterable[Any]):
+        """整体替换（恢复会话状态、切换分支），开头的摘要消息恢复为摘要"""
+        self.clear()
+        for message in messages:
+            if not self._items and self._summary is None and _is_summary(message):
+                self._set_summary(message.content[len(SUMMARY_PREFIX):])
+            else:
+                self._push(message)
+        self.trim()
+
+    def clear(self):
+        self._items.clear()
+        self._costs.clear()
+        self._summary = None
+        self._summary_cost = 0
+        self.tokens = 0
+
+    def trim(self):
+        """从左侧淘汰消息，直到条数和 token 数都在预算内（预算调小后可单独调用）"""
+        evicted = []
+        while len(self._items) > 1 and self._over_budget():
+            evicted.append(self._pop())
+            # 成对淘汰：不留下开头孤立的助手回复
+            while len(self._items) > 1 and self._items[0].role == "assistant":
+                evicted.append(self._pop())
+        if evicted and self.summarize is not None:
+            self._set_summary(self.summarize(self.summary or "", evicted))
+            # 摘要本身也占预算：摘要变长后仍超出时继续淘汰（摘要有长度上限，最终会停下）
+            while len(self._items) > 1 and self.max_tokens is not None and self.tokens > self.max_tokens:
+                extra = [self._pop()]
+                while len(self._items) > 1 and self._items[0].role == "assistant":
+                    extra.append(self._pop())
+                self._set_summary(self.summarize(self.summary or "", extra))
+
+    def _over_budget(self) -> bool:
+        if len(self._items) > self.max_messages:
+            return True
+        return self.max_tokens is not None and self.tokens > self.max_tokens
+
+    def _push(self, message: Any):
+        cost = message_cost(message)
+        self._items.append(message)
+        self._costs.append(cost)
+        self.tokens += cost
+
+    def _pop(self) -> Any:
+        self.tokens -= self._costs.popleft()
+        return self._items.popleft()
+
+    def _set_summary(self, text: str):
+        self.tokens -= self._summary_cost
+        self._summary = self._factory(role="system", content=SUMMARY_PREFIX + text)
+        self._summary_cost = message_cost(self._summary)
+        self.tokens += self._summary_cost
+
+
+def _is_summary(message: Any) -> bool:
+    return message.role == "system" and isinstance(message.content, str) and message.content.startswith(SUMMARY_PREFIX)
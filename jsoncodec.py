@@ -0,0 +1,63 @@
+"""
+JSON 编解码
+
+安装了 orjson 时使用 orjson（解析上游响应行、序列化 SSE 块和响应体都明显更快），否则回退到标准库 json。
+环境变量 JSON_BACKEND=json 可强制使用标准库。
+
+输出均为紧凑格式、不转义非 ASCII 字符；两种后端的结果是等价的 JSON。
+"""
+
+import json
+import os
+from typing import Any, Union
+
+JSONDecodeError = json.JSONDecodeError
+
+_stdlib_encoder = json.JSONEncoder(ensure_ascii=False, separators=(",", ":"))
+_stdlib_decoder = json.JSONDecoder()
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+if os.getenv("JSON_BACKEND", "").lower() == "json":
+    orjson = None
+
+BACKEND = "orjson" if orjson is not None else "json"
+
+
+def _stdlib_loads(data: Union[str, bytes]) -> Any:
+    if isinstance(data, (bytes, bytearray)):
+        data = data.decode("utf-8")
+    return _stdlib_decoder.decode(data)
+
+
+def _stdlib_dumps(obj: Any) -> str:
+    return _stdlib_encoder.encode(obj)
+
+
+def _stdlib_dumps_bytes(obj: Any) -> bytes:
+    return _stdlib_encoder.encode(obj).encode("utf-8")
+
+
+if orjson is not None:
+    def loads(data: Union[str, bytes]) -> Any:
+        """解析 JSON，失败时抛出 json.JSONDecodeError（orjson 的异常是它的子类）"""
+        return orjson.loads(data)
+
+    def dumps(obj: Any) -> str:
+        """序列化为紧凑 JSON 字符串"""
+        return dumps_bytes(obj).decode("utf-8")
+
+    def dumps_bytes(obj: Any) -> bytes:
+        """序列化为 UTF-8 字节（响应体直接使用，省一次编码）"""
+        try:
+            return orjson.dumps(obj)
+        except TypeError:
+            # orjson 不支持的类型（如非字符串键、超出 64 位的整数），交给标准库处理
+            return _stdlib_dumps_bytes(obj)
+else:
+    loads = _stdlib_loads
+    dumps = _stdlib_dumps
+    dumps_bytes = _stdlib_dumps_bytes
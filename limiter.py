@@ -0,0 +1,248 @@
+"""
+上游账号并发限制与准入控制
+
+每个 Gemini 账号（cookie）同一时间只允许有限数量的生成请求，
+超出的请求进入有界等待队列，排队超时或队列已满时立即拒绝（503 + Retry-After），
+避免突发流量把账号打出 429 / 人机验证。
+排队顺序由 scheduler.FairQueue 决定（优先级 + API Key 加权公平）。
+"""
+
+import asyncio
+import math
+import time
+from typing import Dict, Optional
+
+from metrics import metrics
+from scheduler import DEFAULT_PRIORITY, PRIORITY_CLASSES, FairQueue
+
+
+class AdmissionError(Exception):
+    """无法获得账号执行槽位（队列已满或排队超时）"""
+
+    def __init__(self, message: str, retry_after: int = 1, reason: str = "queue_full"):
+        super().__init__(message)
+        self.retry_after = retry_after
+        self.reason = reason
+
+
+class Slot:
+    """已获得的执行槽位，release() 可重复调用"""
+
+    __slots__ = ("_limiter", "_acquired_at", "_released")
+
+    def __init__(self, limiter: "AccountLimiter"):
+        self._limiter = limiter
+        self._acquired_at = time.monotonic()
+        self._released = False
+
+    @property
+    def released(self) -> bool:
+        return self._released
+
+    def release(self):
+        if self._released:
+            return
+        self._released = True
+        self._limiter._release(time.monotonic() - self._acquired_at)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.release()
+
+
+class SlotGroup:
+    """同时持有的多个槽位（如模型 + 账号），按获取的相反顺序一起释放"""
+
+    __slots__ = ("_slots",)
+
+    def __init__(self, *slots: Slot):
+        self._slots = [slot for slot in slots if slot is not None]
+
+    @property
+    def released(self) -> bool:
+        return all(slot.released for slot in self._slots)
+
+    def release(self):
+        for slot in reversed(self._slots):
+            slot.release()
+
+
+class AccountLimiter:
+    """
+    单个上游账号的并发信号量 + 有界优先级等待队列
+
+    用法:
+        slot = await limiter.acquire(priority="interactive", key=api_key)
+        try:
+            ...  # 调用 GeminiClient
+        finally:
+            slot.release()
+    """
+
+    def __init__(
+        self,
+        account: str,
+        max_concurrency: int = 1,
+        max_queue: int = 16,
+        queue_timeout: float = 30.0,
+        weights: Optional[Dict[str, float]] = None,
+    ):
+        """
+        Args:
+            account: 账号标识（用于指标标签，不要传入原始 cookie）
+            max_concurrency: 同时进行的生成请求上限
+            max_queue: 等待队列长度上限，超出直接拒绝
+            queue_timeout: 排队等待超时时间（秒）
+            weights: API Key -> 公平排队权重
+        """
+        self.account = account
+        self.max_concurrency = max(1, int(max_concurrency))
+        self.max_queue = max(0, int(max_queue))
+        self.queue_timeout = float(queue_timeout)
+
+        self._active = 0
+        self._waiters = FairQueue(weights)
+        # 平均占用时长（指数滑动平均），用于估算 Retry-After
+        self._avg_hold = 5.0
+
+    @property
+    def active(self) -> int:
+        return self._active
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self._waiters)
+
+    def retry_after(self) -> int:
+        """估算排到当前队尾需要的秒数"""
+        rounds = (len(self._waiters) + 1) / self.max_concurrency
+        return max(1, math.ceil(rounds * self._avg_hold))
+
+    async def acquire(
+        self,
+        priority: str = DEFAULT_PRIORITY,
+        key: str = "",
+        cost: float = 1.0,
+        timeout: Optional[float] = None,
+    ) -> Slot:
+        """
+        获取执行槽位
+
+        Args:
+            priority: 优先级类别（interactive / agent / batch）
+            key: 调用方标识（API Key），用于同级公平排队
+            cost: 本次请求的相对成本
+            timeout: 排队超时，默认使用 queue_timeout
+
+        Raises:
+            AdmissionError: 队列已满、排队超时或被高优先级请求挤出
+        """
+        start = time.monotonic()
+        if self._active < self.max_concurrency and not self._waiters:
+            self._active += 1
+            self._observe_admitted(priority, 0.0)
+            return Slot(self)
+
+        if len(self._waiters) >= self.max_queue:
+            # 队列已满：尝试挤掉一个尚未开始的低优先级请求
+            victim = self._waiters.evict_lower_than(PRIORITY_CLASSES[priority])
+            if victim is None:
+                metrics.inc("gemini_account_rejected_total", account=self.account, reason="queue_full")
+                raise AdmissionError(
+                    f"账号繁忙：等待队列已满 ({self.max_queue})",
+                    retry_after=self.retry_after(),
+                    reason="queue_full",
+                )
+            metrics.inc("gemini_account_rejected_total", account=self.account, reason="preempted")
+            victim.fut.set_exception(AdmissionError(
+                "账号繁忙：排队请求被更高优先级的请求抢占",
+                retry_after=self.retry_after(),
+                reason="preempted",
+            ))
+
+        fut = asyncio.get_running_loop().create_future()
+        waiter = self._waiters.push(fut, priority, key, cost)
+        self._update_gauges()
+        try:
+            await asyncio.wait_for(fut, timeout if timeout is not None else self.queue_timeout)
+        except asyncio.TimeoutError:
+            self._discard_waiter(waiter)
+            metrics.inc("gemini_account_rejected_total", account=self.account, reason="timeout")
+            raise AdmissionError(
+                f"账号繁忙：排队超时 ({self.queue_timeout:g}s)",
+                retry_after=self.retry_after(),
+                reason="timeout",
+            )
+        except AdmissionError:
+            # 被抢占，已经移出队列
+            self._update_gauges()
+            raise
+        except BaseException:
+            # 调用方被取消：如果槽位已经转交过来，需要归还
+            if fut.done() and not fut.cancelled() and fut.exception() is None:
+                self._release(0.0)
+            else:
+                self._discard_waiter(waiter)
+            raise
+
+        # 槽位由 _release 直接转交，_active 未减少，无需再加
+        self._observe_admitted(priority, time.monotonic() - start)
+        return Slot(self)
+
+    def _discard_waiter(self, waiter):
+        self._waiters.remove(waiter)
+        self._update_gauges()
+
+    def resize(self, max_concurrency: int):
+        """
+        调整并发上限（模型目录重新加载后调用）
+
+        调大时立即把新增的槽位转交给排队中的请求；调小时正在执行的请求不受影响，
+        之后释放的槽位不再转交，直到执行数降到新上限以内。
+        """
+        self.max_concurrency = max(1, int(max_concurrency))
+        while self._active < self.max_concurrency:
+            waiter = self._waiters.pop()
+            if waiter is None:
+                break
+            self._active += 1
+            waiter.fut.set_result(None)
+        self._update_gauges()
+
+    def _release(self, held: float):
+        if held > 0:
+            self._avg_hold = self._avg_hold * 0.8 + held * 0.2
+        # 直接把槽位转交给调度器选出的下一个请求（上限调小后超出的槽位直接收回）
+        waiter = self._waiters.pop() if self._active <= self.max_concurrency else None
+        if waiter is not None:
+            waiter.fut.set_result(None)
+            self._update_gauges()
+            return
+        self._active = max(0, self._active - 1)
+        self._update_gauges()
+
+    def _observe_admitted(self, priority: str, waited: float):
+        metrics.observe("gemini_account_queue_wait_seconds", waited, account=self.account)
+        metrics.observe("gemini_scheduler_wait_seconds", waited, priority=priority)
+        self._update_gauges()
+
+    def _update_gauges(self):
+        metrics.set("gemini_account_queue_depth", len(self._waiters), account=self.account)
+        for name, depth in self._waiters.depth_by_class().items():
+            metrics.set("gemini_scheduler_queue_depth", depth, account=self.account, priority=name)
+        metrics.set("gemini_account_active", self._active, account=self.account)
+        metrics.set("gemini_account_max_concurrency", self.max_concurrency, account=self.account)
+
+    def snapshot(self) -> dict:
+        return {
+            "account": self.account,
+            "active": self._active,
+            "queue_depth": len(self._waiters),
+            "queue_depth_by_priority": self._waiters.depth_by_class(),
+            "max_concurrency": self.max_concurrency,
+            "max_queue": self.max_queue,
+            "queue_timeout": self.queue_timeout,
+            "avg_hold_seconds": round(self._avg_hold, 3),
+        }
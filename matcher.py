@@ -0,0 +1,160 @@
+"""
+对话前缀匹配
+
+OpenAI 格式的请求每次都带着完整的消息历史。每轮对话结束后的会话快照挂在一棵以消息为边的前缀树上，
+请求到来时沿树向下走，找到与消息历史匹配的最深的快照：
+  - 完全匹配：从该快照继续（可能是另一个分支或另一段对话），只发送最后一条用户消息
+  - 部分匹配：从最深的快照继续，之后未匹配的消息随本轮补发
+  - 不匹配：新对话
+
+每条消息以 (角色, 文本) 作为边，文本与会话快照中记录的是同一个字符串对象，不额外占用内存。
+匹配是逐条字典查找（字符串 hash 由 C 实现计算一次），不再把全部用户消息拼接后整体计算 MD5，
+也不会把任意多条消息的请求都当作当前对话的延续；记录新的一轮只在上一轮的节点下追加几条边，与历史长度无关。
+图片不参与匹配（与会话快照中记录的内容一致）。
+"""
+
+from collections import deque
+from typing import Any, Dict, Iterable, List, NamedTuple, Optional, Sequence, Tuple
+
+# 参与匹配的角色（system 由系统提示词 hash 单独跟踪，tool 等角色不发送给 Gemini）
+DIALOG_ROLES = ("user", "assistant")
+
+
+def message_text(content: Any) -> str:
+    """消息内容中的文本（内容列表只取 text 部分），与会话快照中记录的用户消息一致"""
+    if isinstance(content, list):
+        return " ".join(
+            item.get("text", "") for item in content if isinstance(item, dict) and item.get("type") == "text"
+        )
+    return content or ""
+
+
+# 前缀树的边：(角色, 去掉首尾空白的文本)
+MessageKey = Tuple[str, str]
+
+
+def message_key(role: str, content: Any) -> MessageKey:
+    """一条消息在前缀树中的边（首尾空白不影响匹配）"""
+    return role, message_text(content).strip()
+
+
+class Match(NamedTuple):
+    checkpoint_id: Optional[int]  # 匹配到的最深快照，None 表示对话开头
+    depth: int  # 该快照覆盖的消息条数
+
+
+class _Node:
+    __slots__ = ("children", "checkpoint_id", "parent", "key")
+
+    def __init__(self, parent: Optional["_Node"] = None, key: Optional[MessageKey] = None):
+        self.children: Dict[MessageKey, "_Node"] = {}
+        self.checkpoint_id: Optional[int] = None
+        self.parent = parent
+        self.key = key
+
+
+class ConversationTrie:
+    """
+    消息前缀 -> 会话快照
+
+    用法:
+        trie = ConversationTrie()
+        trie.sync(client.checkpoints)
+        checkpoint_id, depth = trie.match([message_key(m["role"], m["content"]) for m in history])
+    """
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self._root = _Node()
+        self._nodes: Dict[int, _Node] = {}
+        self._order: deque = deque()  # 快照 ID 按添加顺序（递增）
+        self._last_id = 0
+
+    def __len__(self) -> int:
+        return len(self._nodes)
+
+    def __contains__(self, checkpoint_id: int) -> bool:
+        return checkpoint_id in self._nodes
+
+    def add(self, checkpoint_id: int, parent_id: Optional[int], keys: Sequence[MessageKey]):
+        """在父快照（None 为对话开头）之后追加消息 keys，末端挂上快照"""
+        node = self._nodes.get(parent_id, self._root) if parent_id is not None else self._root
+        for key in keys:
+            child = node.children.get(key)
+            if child is None:
+                child = node.children[key] = _Node(node, key)
+            node = child
+        node.checkpoint_id = checkpoint_id
+        self._nodes[checkpoint_id] = node
+        self._order.append(checkpoint_id)
+        self._last_id = max(self._last_id, checkpoint_id)
+
+    def discard(self, checkpoint_id: int):
+        """快照已淘汰：不再作为匹配结果，没有后续快照经过的节点一并删除"""
+        node = self._nodes.pop(checkpoint_id, None)
+        if node is None or node.checkpoint_id != checkpoint_id:
+            return
+        node.checkpoint_id = None
+        while node.parent is not None and not node.children and node.checkpoint_id is None:
+            del node.parent.children[node.key]
+            node = node.parent
+
+    def match(self, keys: Iterable[MessageKey]) -> Match:
+        """沿消息向下查找，返回经过的最深的快照（消息走出树或到达末尾时停止，可以传入生成器按需计算）"""
+        node = self._root
+        best = Match(None, 0)
+        for depth, key in enumerate(keys, 1):
+            node = node.children.get(key)
+            if node is None:
+                break
+            if node.checkpoint_id is not None:
+                best = Match(node.checkpoint_id, depth)
+        return best
+
+    def sync(self, checkpoints: List[Dict[str, Any]]) -> int:
+        """
+        与客户端的快照列表同步：添加新快照、丢弃已淘汰的快照，返回新增数量
+
+        快照按 ID 递增排列，只查看列表末尾新增的部分。客户端重置会话后快照 ID 仍然递增，
+        旧快照在列表中消失后按淘汰处理；ID 回退（如加载了旧的会话状态文件）时重建。
+        """
+        if not checkpoints:
+            if self._nodes:
+                self.clear()
+            return 0
+        if checkpoints[-1]["id"] < self._last_id:
+            self.clear()
+        new = []
+        for checkpoint in reversed(checkpoints):
+            if checkpoint["id"] <= self._last_id:
+                break
+            new.append(checkpoint)
+        for checkpoint in reversed(new):
+            self.add(checkpoint["id"], checkpoint["parent"], checkpoint_keys(checkpoint))
+        first_id = checkpoints[0]["id"]
+        while self._order and self._order[0] < first_id:
+            self.discard(self._order.popleft())
+        return len(new)
+
+
+def checkpoint_keys(checkpoint: Dict[str, Any]) -> List[MessageKey]:
+    """一个快照在父快照之后的消息：补发的历史（如有）、用户消息、回复"""
+    keys = [message_key(m["role"], m["content"]) for m in checkpoint.get("context", [])]
+    keys.append(message_key("user", checkpoint["user"]))
+    keys.append(message_key("assistant", checkpoint["reply"]))
+    return keys
+
+
+def dialog_messages(messages: Iterable[Any]) -> List[Dict[str, Any]]:
+    """请求中参与匹配的消息（dict 或带 role / content 属性的对象），截止到最后一条用户消息"""
+    dialog = []
+    for m in messages:
+        role = m.get("role") if isinstance(m, dict) else getattr(m, "role", None)
+        if role in DIALOG_ROLES:
+            content = m.get("content") if isinstance(m, dict) else getattr(m, "content", None)
+            dialog.append({"role": role, "content": content})
+    while dialog and dialog[-1]["role"] != "user":
+        dialog.pop()
+    return dialog
@@ -0,0 +1,149 @@
+"""
+运行时指标
+进程内的计数器 / 仪表 / 分布统计，通过 /metrics 以 Prometheus 文本格式导出
+"""
+
+import threading
+from collections import deque
+from typing import Any, Dict, Tuple
+
+
+# 分布统计只保留最近的样本，用于计算分位数
+SAMPLE_WINDOW = 2048
+
+
+def _label_key(labels: Dict[str, Any]) -> Tuple:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _format_labels(label_key: Tuple) -> str:
+    if not label_key:
+        return ""
+    inner = ",".join(f'{k}="{v}"' for k, v in label_key)
+    return "{" + inner + "}"
+
+
+class _Summary:
+    """分布统计：总数、总和 + 最近样本窗口"""
+
+    __slots__ = ("count", "total", "samples")
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.samples = deque(maxlen=SAMPLE_WINDOW)
+
+    def observe(self, value: float):
+        self.count += 1
+        self.total += value
+        self.samples.append(value)
+
+    def quantile(self, q: float) -> float:
+        if not self.samples:
+            return 0.0
+        ordered = sorted(self.samples)
+        idx = min(len(ordered) - 1, max(0, int(round(q * (len(ordered) - 1)))))
+        return ordered[idx]
+
+
+class Metrics:
+    """线程安全的简单指标注册表"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters: Dict[str, Dict[Tuple, float]] = {}
+        self._gauges: Dict[str, Dict[Tuple, float]] = {}
+        self._summaries: Dict[str, Dict[Tuple, _Summary]] = {}
+
+    def inc(self, name: str, value: float = 1.0, **labels):
+        """计数器累加"""
+        key = _label_key(labels)
+        with self._lock:
+            series = self._counters.setdefault(name, {})
+            series[key] = series.get(key, 0.0) + value
+
+    def set(self, name: str, value: float, **labels):
+        """设置仪表当前值"""
+        key = _label_key(labels)
+        with self._lock:
+            self._gauges.setdefault(name, {})[key] = float(value)
+
+    def observe(self, name: str, value: float, **labels):
+        """记录一次分布样本（如等待时间）"""
+        key = _label_key(labels)
+        with self._lock:
+            series = self._summaries.setdefault(name, {})
+            summary = series.get(key)
+            if summary is None:
+                summary = series[key] = _Summary()
+            summary.observe(value)
+
+    def get(self, name: str, **labels) -> float:
+        """读取计数器或仪表的当前值"""
+        key = _label_key(labels)
+        with self._lock:
+            if name in self._counters:
+                return self._counters[name].get(key, 0.0)
+            return self._gauges.get(name, {}).get(key, 0.0)
+
+    def quantile(self, name: str, q: float, **labels) -> float:
+        """读取分布统计的分位数"""
+        key = _label_key(labels)
+        with self._lock:
+            summary = self._summaries.get(name, {}).get(key)
+            return summary.quantile(q) if summary else 0.0
+
+    def snapshot(self) -> dict:
+        """导出为 JSON 友好的字典（后台页面使用）"""
+        with self._lock:
+            result = {"counters": {}, "gauges": {}, "summaries": {}}
+            for kind, store in (("counters", self._counters), ("gauges", self._gauges)):
+                for name, series in store.items():
+                    result[kind][name] = [
+                        {"labels": dict(k), "value": v} for k, v in series.items()
+                    ]
+            for name, series in self._summaries.items():
+                result["summaries"][name] = [
+                    {
+                        "labels": dict(k),
+                        "count": s.count,
+                        "sum": s.total,
+                        "p50": s.quantile(0.5),
+                        "p99": s.quantile(0.99),
+                    }
+                    for k, s in series.items()
+                ]
+            return result
+
+    def render_prometheus(self) -> str:
+        """导出为 Prometheus 文本格式"""
+        lines = []
+        with self._lock:
+            for name, series in sorted(self._counters.items()):
+                lines.append(f"# TYPE {name} counter")
+                for k, v in series.items():
+                    lines.append(f"{name}{_format_labels(k)} {v}")
+            for name, series in sorted(self._gauges.items()):
+                lines.append(f"# TYPE {name} gauge")
+                for k, v in series.items():
+                    lines.append(f"{name}{_format_labels(k)} {v}")
+            for name, series in sorted(self._summaries.items()):
+                lines.append(f"# TYPE {name} summary")
+                for k, s in series.items():
+                    for q in (0.5, 0.99):
+                        qk = _label_key({**dict(k), "quantile": q})
+                        lines.append(f"{name}{_format_labels(qk)} {s.quantile(q)}")
+                    lines.append(f"{name}_count{_format_labels(k)} {s.count}")
+                    lines.append(f"{name}_sum{_format_labels(k)} {s.total}")
+        return "\n".join(lines) + "\n"
+
+    def reset(self):
+        """清空所有指标（测试使用）"""
+        with self._lock:
+            self._counters.clear()
+            self._gauges.clear()
+            self._summaries.clear()
+
+
+# 全局指标实例
+metrics = Metrics()
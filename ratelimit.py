@@ -0,0 +1,238 @@
+"""
+按 API Key 的令牌桶限流
+
+每个 API Key 有两个令牌桶:
+  - requests: 每分钟请求数 (rpm)
+  - chars:    每分钟字符数 (cpm，输入 + 输出)
+默认在进程内计数；多个 uvicorn worker 时可切换为 SQLite 共享后端，让限额跨进程生效。
+"""
+
+import math
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+
+# (桶名称, 容量, 每秒补充量, 本次消耗量)
+BucketSpec = Tuple[str, float, float, float]
+
+
+class RateLimitExceeded(Exception):
+    """超出 API Key 的限额"""
+
+    def __init__(self, message: str, result: "RateLimitResult"):
+        super().__init__(message)
+        self.result = result
+
+
+@dataclass
+class RateLimitResult:
+    allowed: bool
+    limit_requests: int
+    remaining_requests: int
+    reset_requests: float
+    limit_chars: int
+    remaining_chars: int
+    reset_chars: float
+
+    @property
+    def retry_after(self) -> int:
+        wait = 0.0
+        if self.remaining_requests <= 0:
+            wait = max(wait, self.reset_requests)
+        if self.remaining_chars <= 0:
+            wait = max(wait, self.reset_chars)
+        return max(1, math.ceil(wait))
+
+    def headers(self) -> Dict[str, str]:
+        """OpenAI 风格的 x-ratelimit-* 响应头（tokens 系列以字符计）"""
+        headers = {
+            "x-ratelimit-limit-requests": str(self.limit_requests),
+            "x-ratelimit-remaining-requests": str(max(0, self.remaining_requests)),
+            "x-ratelimit-reset-requests": _format_reset(self.reset_requests),
+            "x-ratelimit-limit-tokens": str(self.limit_chars),
+            "x-ratelimit-remaining-tokens": str(max(0, self.remaining_chars)),
+            "x-ratelimit-reset-tokens": _format_reset(self.reset_chars),
+        }
+        if not self.allowed:
+            headers["Retry-After"] = str(self.retry_after)
+        return headers
+
+
+def _format_reset(seconds: float) -> str:
+    if seconds <= 0:
+        return "0s"
+    if seconds < 1:
+        return f"{int(seconds * 1000)}ms"
+    return f"{seconds:.1f}s".replace(".0s", "s")
+
+
+def _refill(tokens: float, updated: float, capacity: float, rate: float, now: float) -> float:
+    return min(capacity, tokens + max(0.0, now - updated) * rate)
+
+
+class MemoryBackend:
+    """进程内令牌桶（默认）"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._buckets: Dict[Tuple[str, str], Tuple[float, float]] = {}
+
+    def take(self, key: str, specs: List[BucketSpec], now: float) -> List[float]:
+        """
+        原子地从多个桶扣减（全部足够才扣减）
+
+        Returns:
+            扣减前（补充后）各桶的令牌数；任一不足时不扣减
+        """
+        with self._lock:
+            levels = []
+            for name, capacity, rate, _ in specs:
+                tokens, updated = self._buckets.get((key, name), (capacity, now))
+                levels.append(_refill(tokens, updated, capacity, rate, now))
+            if all(level >= amount for level, (_, _, _, amount) in zip(levels, specs)):
+                for level, (name, _, _, amount) in zip(levels, specs):
+                    self._buckets[(key, name)] = (level - amount, now)
+            else:
+                for level, (name, _, _, _) in zip(levels, specs):
+                    self._buckets[(key, name)] = (level, now)
+            return levels
+
+    def charge(self, key: str, spec: BucketSpec, now: float) -> float:
+        """强制扣减（允许欠账为负），返回扣减后的令牌数"""
+        name, capacity, rate, amount = spec
+        with self._lock:
+            tokens, updated = self._buckets.get((key, name), (capacity, now))
+            level = _refill(tokens, updated, capacity, rate, now) - amount
+            self._buckets[(key, name)] = (level, now)
+            return level
+
+
+class SQLiteBackend:
+    """SQLite 共享令牌桶，多个 worker 进程共用同一个数据库文件"""
+
+    def __init__(self, path: str = "ratelimit.db"):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=5.0, isolation_level=None, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS buckets ("
+            "key TEXT NOT NULL, name TEXT NOT NULL, tokens REAL NOT NULL, updated REAL NOT NULL, "
+            "PRIMARY KEY (key, name))"
+        )
+
+    def _load(self, key: str, name: str, capacity: float, now: float) -> Tuple[float, float]:
+        row = self._conn.execute(
+            "SELECT tokens, updated FROM buckets WHERE key = ? AND name = ?", (key, name)
+        ).fetchone()
+        return row if row else (capacity, now)
+
+    def _store(self, key: str, name: str, tokens: float, now: float):
+        self._conn.execute(
+            "INSERT OR REPLACE INTO buckets (key, name, tokens, updated) VALUES (?, ?, ?, ?)",
+            (key, name, tokens, now),
+        )
+
+    def take(self, key: str, specs: List[BucketSpec], now: float) -> List[float]:
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                levels = []
+                for name, capacity, rate, _ in specs:
+                    tokens, updated = self._load(key, name, capacity, now)
+                    levels.append(_refill(tokens, updated, capacity, rate, now))
+                allowed = all(level >= amount for level, (_, _, _, amount) in zip(levels, specs))
+                for level, (name, _, _, amount) in zip(levels, specs):
+                    self._store(key, name, level - amount if allowed else level, now)
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            return levels
+
+    def charge(self, key: str, spec: BucketSpec, now: float) -> float:
+        name, capacity, rate, amount = spec
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                tokens, updated = self._load(key, name, capacity, now)
+                level = _refill(tokens, updated, capacity, rate, now) - amount
+                self._store(key, name, level, now)
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            return level
+
+
+class RateLimiter:
+    """
+    API Key 限流器
+
+    用法:
+        result = limiter.check(api_key, rpm=60, cpm=200000, chars=len(prompt))
+        ...  # 生成完成后
+        limiter.charge(api_key, cpm=200000, chars=len(reply))
+    """
+
+    def __init__(self, backend=None):
+        self.backend = backend or MemoryBackend()
+
+    def check(self, key: str, rpm: int, cpm: int, chars: int = 0, now: Optional[float] = None) -> RateLimitResult:
+        """
+        扣减 1 个请求和 chars 个字符的额度
+
+        Raises:
+            RateLimitExceeded: 任一令牌桶额度不足
+        """
+        now = time.time() if now is None else now
+        # 单次请求的字符数超过整个桶容量时按桶容量计，避免永远无法通过
+        chars = min(float(chars), float(cpm))
+        specs = [
+            ("requests", float(rpm), rpm / 60.0, 1.0),
+            ("chars", float(cpm), cpm / 60.0, chars),
+        ]
+        levels = self.backend.take(key, specs, now)
+        allowed = levels[0] >= 1.0 and levels[1] >= chars
+        req_left = levels[0] - 1.0 if allowed else levels[0]
+        char_left = levels[1] - chars if allowed else levels[1]
+        result = RateLimitResult(
+            allowed=allowed,
+            limit_requests=int(rpm),
+            remaining_requests=int(req_left),
+            reset_requests=self._reset_time(req_left, rpm, 1.0 if not allowed else 0.0),
+            limit_chars=int(cpm),
+            remaining_chars=int(char_left),
+            reset_chars=self._reset_time(char_left, cpm, chars if not allowed else 0.0),
+        )
+        if not allowed:
+            which = "请求数" if levels[0] < 1.0 else "字符数"
+            raise RateLimitExceeded(f"超出 API Key 限额（每分钟{which}）", result)
+        return result
+
+    def charge(self, key: str, cpm: int, chars: int, now: Optional[float] = None) -> float:
+        """生成完成后补扣输出字符（允许欠账，下次请求时体现）"""
+        if chars <= 0:
+            return 0.0
+        now = time.time() if now is None else now
+        return self.backend.charge(key, ("chars", float(cpm), cpm / 60.0, float(chars)), now)
+
+    @staticmethod
+    def _reset_time(level: float, per_minute: int, needed: float) -> float:
+        """桶恢复到可用（needed > 0）或装满（needed == 0）所需的秒数"""
+        rate = per_minute / 60.0
+        if rate <= 0:
+            return 0.0
+        target = needed if needed > 0 else per_minute
+        return max(0.0, (target - level) / rate)
+
+
+def create_rate_limiter(backend: str = "memory", path: str = "ratelimit.db") -> RateLimiter:
+    """按配置创建限流器（memory / sqlite）"""
+    if backend == "sqlite":
+        return RateLimiter(SQLiteBackend(path))
+    return RateLimiter(MemoryBackend())
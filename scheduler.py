@@ -0,0 +1,146 @@
+"""
+优先级调度队列
+
+账号槽位空出来时，决定下一个执行哪个排队请求:
+1. 按优先级类别（interactive > agent > batch）严格优先
+2. 同一类别内按 API Key 做加权公平排队（WFQ），避免单个调用方霸占队列
+3. 队列已满时，高优先级请求可以挤掉尚未开始的低优先级请求
+"""
+
+import itertools
+import time
+from collections import deque
+from typing import Dict, Optional
+
+
+# 优先级类别 -> 排名（数字越小越优先）
+PRIORITY_CLASSES = {
+    "interactive": 0,  # 交互式聊天
+    "agent": 1,        # 工具调用 / Agent
+    "batch": 2,        # 后台批量任务
+}
+DEFAULT_PRIORITY = "interactive"
+
+
+def normalize_priority(value: Optional[str]) -> Optional[str]:
+    """规范化优先级名称，无法识别时返回 None"""
+    if not value:
+        return None
+    value = value.strip().lower()
+    return value if value in PRIORITY_CLASSES else None
+
+
+class Waiter:
+    """一个排队中的请求"""
+
+    __slots__ = ("fut", "priority", "rank", "key", "finish", "seq", "enqueued_at")
+
+    def __init__(self, fut, priority: str, key: str, finish: float, seq: int):
+        self.fut = fut
+        self.priority = priority
+        self.rank = PRIORITY_CLASSES[priority]
+        self.key = key
+        self.finish = finish
+        self.seq = seq
+        self.enqueued_at = time.monotonic()
+
+
+class FairQueue:
+    """
+    多优先级 + 加权公平队列
+
+    每个类别内为每个 API Key 维护独立 FIFO，入队时分配虚拟完成时间
+    finish = max(虚拟时钟, 该 Key 上次的 finish) + cost / weight，
+    出队时选取 finish 最小的队头（自计时公平排队 SCFQ）。
+    """
+
+    def __init__(self, weights: Optional[Dict[str, float]] = None):
+        """
+        Args:
+            weights: API Key -> 权重（默认 1.0），权重越大分到的份额越多
+        """
+        self.weights = weights or {}
+        self._queues: Dict[int, Dict[str, deque]] = {rank: {} for rank in PRIORITY_CLASSES.values()}
+        self._vtime: Dict[int, float] = {rank: 0.0 for rank in PRIORITY_CLASSES.values()}
+        self._last_finish: Dict[int, Dict[str, float]] = {rank: {} for rank in PRIORITY_CLASSES.values()}
+        self._seq = itertools.count()
+        self._size = 0
+
+    def __len__(self) -> int:
+        return self._size
+
+    def push(self, fut, priority: str = DEFAULT_PRIORITY, key: str = "", cost: float = 1.0) -> Waiter:
+        rank = PRIORITY_CLASSES[priority]
+        weight = max(self.weights.get(key, 1.0), 1e-6)
+        start = max(self._vtime[rank], self._last_finish[rank].get(key, 0.0))
+        finish = start + cost / weight
+        self._last_finish[rank][key] = finish
+
+        waiter = Waiter(fut, priority, key, finish, next(self._seq))
+        self._queues[rank].setdefault(key, deque()).append(waiter)
+        self._size += 1
+        return waiter
+
+    def pop(self) -> Optional[Waiter]:
+        """取出下一个应执行的请求（跳过已取消的）"""
+        while self._size:
+            waiter = self._pop_head()
+            if waiter is None:
+                return None
+            if not waiter.fut.done():
+                return waiter
+        return None
+
+    def _pop_head(self) -> Optional[Waiter]:
+        for rank in sorted(self._queues):
+            per_key = self._queues[rank]
+            if not per_key:
+                continue
+            key = min(per_key, key=lambda k: (per_key[k][0].finish, per_key[k][0].seq))
+            queue = per_key[key]
+            waiter = queue.popleft()
+            if not queue:
+                del per_key[key]
+            self._size -= 1
+            self._vtime[rank] = waiter.finish
+            if not per_key:
+                # 类别空闲后重置虚拟时钟，避免历史积累影响新一轮排队
+                self._vtime[rank] = 0.0
+                self._last_finish[rank].clear()
+            return waiter
+        return None
+
+    def remove(self, waiter: Waiter) -> bool:
+        """移除指定请求（排队超时 / 客户端取消）"""
+        per_key = self._queues[waiter.rank]
+        queue = per_key.get(waiter.key)
+        if not queue:
+            return False
+        try:
+            queue.remove(waiter)
+        except ValueError:
+            return False
+        if not queue:
+            del per_key[waiter.key]
+        self._size -= 1
+        return True
+
+    def evict_lower_than(self, rank: int) -> Optional[Waiter]:
+        """挤掉一个比 rank 优先级更低、最晚入队的请求，用于给高优先级请求让位"""
+        for victim_rank in sorted(self._queues, reverse=True):
+            if victim_rank <= rank:
+                break
+            per_key = self._queues[victim_rank]
+            if not per_key:
+                continue
+            key = max(per_key, key=lambda k: per_key[k][-1].seq)
+            waiter = per_key[key][-1]
+            self.remove(waiter)
+            return waiter
+        return None
+
+    def depth_by_class(self) -> Dict[str, int]:
+        result = {}
+        for name, rank in PRIORITY_CLASSES.items():
+            result[name] = sum(len(q) for q in self._queues[rank].values())
+        return result
@@ -11,21 +11,37 @@ Gemini OpenAI 兼容 API 服务
 """
 
 from fastapi import FastAPI, HTTPException, Header, Request
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import HTMLResponse, RedirectResponse, StreamingResponse, JSONResponse
+from fastapi.responses import HTMLResponse, RedirectResponse, StreamingResponse, JSONResponse, PlainTextResponse, Response
+from starlette.background import BackgroundTask
 from pydantic import BaseModel, ConfigDict
 from typing import List, Dict, Any, Optional, Union
-import uvicorn
+import asyncio
 import time
 import uuid
 import json
 import os
 import re
-import httpx
-import hashlib
 import secrets
-import socket
-import subprocess
+import threading
+
+import jsoncodec
+import tokens
+from batch import BatchEngine, BatchItemError, BatchStore, FINAL_STATUSES, parse_jsonl
+from cache import ResponseCache, make_cache_key
+from catalog import ModelCatalog
+from contexts import CachedContentStore, content_hash, parse_timestamp, parse_ttl, to_resource
+from health import CREDENTIAL_EXPIRED, CREDENTIAL_OK, account_label, health
+from compression import CompressionMiddleware
+from coalesce import Flight, FlightCancelled, SingleFlight
+from limiter import AccountLimiter, AdmissionError, SlotGroup
+from matcher import ConversationTrie, dialog_messages, message_key
+from metrics import metrics
+from ratelimit import RateLimiter, RateLimitExceeded, create_rate_limiter
+from scheduler import DEFAULT_PRIORITY, PRIORITY_CLASSES, normalize_priority
+from sse import DONE, PING, GeminiChunkEncoder, OpenAIChunkEncoder, coalesce, heartbeat, pace, split_chunks, usage_metadata
+from upstream import UpstreamStream
 
 # ============ 配置 ============
 API_KEY = "sk-gemini"
@@ -37,7 +53,15 @@ ADMIN_USERNAME = "admin"
 ADMIN_PASSWORD = "admin123"
 # ==============================
 
-app = FastAPI(title="Gemini OpenAI API", version="1.0.0")
+
+class FastJSONResponse(JSONResponse):
+    """用 jsoncodec 序列化的 JSON 响应（安装了 orjson 时更快）"""
+
+    def render(self, content: Any) -> bytes:
+        return jsoncodec.dumps_bytes(content)
+
+
+app = FastAPI(title="Gemini OpenAI API", version="1.0.0", default_response_class=FastJSONResponse)
 
 app.add_middleware(
     CORSMiddleware,
@@ -72,6 +96,71 @@ FORCE_URL_CONTEXT = os.getenv("FORCE_URL_CONTEXT", "false").lower() == "true"
 STREAMING_MODE = os.getenv("STREAMING_MODE", "real")  # real: 真流式, fake: 假流式
 FORCE_URL_CONTEXT = os.getenv("FORCE_URL_CONTEXT", "false").lower() == "true"
 
+# 流式输出合并窗口（毫秒）：窗口内连续到达的小增量合并成一个 SSE 块，减少写入次数；0 表示逐个输出
+SSE_FLUSH_WINDOW_MS = float(os.getenv("SSE_FLUSH_WINDOW_MS", "15"))
+# 流式响应超过 N 秒没有输出时发送 SSE 注释 ": ping"（上传图片、思考模型出字前），避免代理 / 负载均衡空闲超时断开；0 表示关闭
+SSE_HEARTBEAT_INTERVAL = float(os.getenv("SSE_HEARTBEAT_INTERVAL", "15"))
+# 假流式：完整回复按句子 / 单词边界切成约 N 个字符的块立即输出；可选按字节每秒限速（0 表示不限速）
+FAKE_STREAM_CHUNK_SIZE = int(os.getenv("FAKE_STREAM_CHUNK_SIZE", "64"))
+FAKE_STREAM_BYTES_PER_SEC = float(os.getenv("FAKE_STREAM_BYTES_PER_SEC", "0"))
+
+# 上游账号并发限制（GeminiClient 只保存一份会话上下文，默认每个账号同时只跑一个生成）
+ACCOUNT_MAX_CONCURRENCY = int(os.getenv("ACCOUNT_MAX_CONCURRENCY", "1"))
+ACCOUNT_MAX_QUEUE = int(os.getenv("ACCOUNT_MAX_QUEUE", "16"))  # 等待队列上限，超出直接返回 503
+ACCOUNT_QUEUE_TIMEOUT = float(os.getenv("ACCOUNT_QUEUE_TIMEOUT", "30"))  # 排队超时（秒）
+
+# 批处理（/v1/batches、batchGenerateContent）：任务保存在 SQLite，重启后继续执行；
+# 条目按 batch 优先级排队获取账号槽位（不挤占交互请求），并发默认等于账号并发上限
+BATCH_DB = os.getenv("BATCH_DB", "batches.db")
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", str(ACCOUNT_MAX_CONCURRENCY)))
+BATCH_MAX_RETRIES = int(os.getenv("BATCH_MAX_RETRIES", "3"))  # 单条失败后的重试次数（指数退避）
+BATCH_MAX_REQUESTS = 50000  # 单个批次的请求数上限
+
+# 上下文缓存（/v1beta/cachedContents）：前缀只发送一次，之后的请求从预热好的会话快照分叉
+CACHED_CONTENTS_FILE = os.getenv("CACHED_CONTENTS_FILE", "cached_contents.json")
+CACHED_CONTENT_TTL = float(os.getenv("CACHED_CONTENT_TTL", "3600"))  # 未指定 ttl 时的有效期（秒）
+
+# 消息历史超出预算（最近 100 条、按模型 inputTokenLimit 估算的 token 数）时，淘汰的消息压缩成摘要保留在历史开头
+HISTORY_SUMMARY = os.getenv("HISTORY_SUMMARY", "false").lower() == "true"
+
+# 健康检查：后台每隔多少秒探测一次 Cookie 是否有效（期间有成功的生成时跳过），0 表示不探测
+HEALTH_PROBE_INTERVAL = float(os.getenv("HEALTH_PROBE_INTERVAL", "300"))
+HEALTH_PROBE_TIMEOUT = 10.0
+
+# 多 API Key 配置: Key -> 限流与调度参数（未填写的字段使用默认值）
+#   rpm: 每分钟请求数   cpm: 每分钟字符数（输入 + 输出）
+#   priority: 默认优先级（interactive / agent / batch，请求头 X-Priority 可覆盖）
+#   weight: 同优先级内的公平排队权重
+# 也可以在 config_data.json 中添加 "API_KEYS" 字段（格式相同）
+API_KEYS: Dict[str, Dict[str, Any]] = {API_KEY: {}} if API_KEY else {}
+# 例如: API_KEYS["sk-batch"] = {"rpm": 20, "cpm": 500000, "priority": "batch"}
+
+# 限流默认值与后端（memory: 进程内；sqlite: 多个 worker 共享同一数据库文件）
+RATE_LIMIT_RPM = int(os.getenv("RATE_LIMIT_RPM", "60"))
+RATE_LIMIT_CPM = int(os.getenv("RATE_LIMIT_CPM", "200000"))
+RATE_LIMIT_BACKEND = os.getenv("RATE_LIMIT_BACKEND", "memory")
+RATE_LIMIT_DB = os.getenv("RATE_LIMIT_DB", "ratelimit.db")
+
+# 精确匹配响应缓存（默认关闭）：只对无状态的单轮请求生效，请求头 Cache-Control: no-cache 可跳过
+RESPONSE_CACHE = os.getenv("RESPONSE_CACHE", "false").lower() == "true"
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", "3600"))  # 过期时间（秒）
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "1024"))
+RESPONSE_CACHE_MAX_MB = float(os.getenv("RESPONSE_CACHE_MAX_MB", "64"))  # 内存层上限
+RESPONSE_CACHE_DB = os.getenv("RESPONSE_CACHE_DB", "")  # 磁盘层 SQLite 文件，为空时只用内存
+RESPONSE_CACHE_STREAM_CHUNK = 64  # 命中时按多少字符一块输出流
+
+# 合并同时到达的相同无状态请求：只向上游生成一次，其余请求订阅结果（流式请求重放已输出的内容后实时接收）
+REQUEST_COALESCING = os.getenv("REQUEST_COALESCING", "true").lower() == "true"
+
+# 响应压缩：按 Accept-Encoding 协商 br（需要 pip install brotli）/ gzip，超过阈值的 JSON / HTML 响应才压缩
+COMPRESSION = os.getenv("COMPRESSION", "true").lower() == "true"
+COMPRESSION_MIN_SIZE = int(os.getenv("COMPRESSION_MIN_SIZE", "1024"))  # 字节
+# SSE 压缩策略：flush 每个事件压缩后立即刷新（不积攒、不增加延迟）；off 不压缩
+SSE_COMPRESSION = os.getenv("SSE_COMPRESSION", "flush")
+
+if COMPRESSION:
+    app.add_middleware(CompressionMiddleware, minimum_size=COMPRESSION_MIN_SIZE, sse_policy=SSE_COMPRESSION)
+
 # 配置存储
 _config = {
     "SNLM0E": "",
@@ -157,28 +246,38 @@ def parse_cookie_string(cookie_str: str) -> dict:
     return result
 
 
+GEMINI_PAGE_URL = "https://gemini.google.com"
+
+
+def gemini_page_session(cookies_str: str, timeout: float = 30.0):
+    """带 Cookie 的 httpx 会话，用于请求 Gemini 页面"""
+    import httpx
+    
+    session = httpx.Client(
+        timeout=timeout,
+        follow_redirects=True,
+        headers={
+            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/131.0.0.0 Safari/537.36",
+            "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8",
+            "Accept-Language": "zh-CN,zh;q=0.9,en;q=0.8",
+        }
+    )
+    
+    # 设置 cookies
+    for item in cookies_str.split(";"):
+        item = item.strip()
+        if "=" in item:
+            key, value = item.split("=", 1)
+            session.cookies.set(key.strip(), value.strip(), domain=".google.com")
+    return session
+
+
 def fetch_tokens_from_page(cookies_str: str) -> dict:
     """从 Gemini 页面自动获取 SNLM0E、PUSH_ID 和可用模型列表"""
     result = {"snlm0e": "", "push_id": "", "models": []}
     try:
-        session = httpx.Client(
-            timeout=30.0,
-            follow_redirects=True,
-            headers={
-                "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/131.0.0.0 Safari/537.36",
-                "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8",
-                "Accept-Language": "zh-CN,zh;q=0.9,en;q=0.8",
-            }
-        )
-        
-        # 设置 cookies
-        for item in cookies_str.split(";"):
-            item = item.strip()
-            if "=" in item:
-                key, value = item.split("=", 1)
-                session.cookies.set(key.strip(), value.strip(), domain=".google.com")
-        
-        resp = session.get("https://gemini.google.com")
+        session = gemini_page_session(cookies_str)
+        resp = session.get(GEMINI_PAGE_URL)
         if resp.status_code != 200:
             return result
         
@@ -250,6 +349,9 @@ def load_config():
                 if saved.get("SNLM0E") and saved.get("SECURE_1PSID"):
                     _config.update(saved)
                     loaded_from_json = True
+                # 额外的 API Key 配置
+                if isinstance(saved.get("API_KEYS"), dict):
+                    API_KEYS.update(saved["API_KEYS"])
         except:
             pass
     
@@ -269,16 +371,8 @@ def save_config():
         json.dump(_config, f, indent=2, ensure_ascii=False)
 
 
-def get_client():
-    global _client
-    
-    if not _config.get("SNLM0E") or not _config.get("SECURE_1PSID"):
-        raise HTTPException(status_code=500, detail="请先在后台配置 Token 和 Cookie")
-    
-    # 如果 client 已存在，直接复用，保持会话上下文
-    if _client is not None:
-        return _client
-    
+def build_cookie_string() -> str:
+    """由配置拼出请求 Gemini 使用的 Cookie"""
     cookies = f"__Secure-1PSID={_config['SECURE_1PSID']}"
     if _config.get("SECURE_1PSIDTS"):
         cookies += f"; __Secure-1PSIDTS={_config['SECURE_1PSIDTS']}"
@@ -292,16 +386,272 @@ def get_client():
         cookies += f"; SSID={_config['SSID']}"
     if _config.get("APISID"):
         cookies += f"; APISID={_config['APISID']}"
+    return cookies
+
+
+# 启动预热（线程池中）与第一个请求同时创建客户端时只创建一次
+_client_lock = threading.Lock()
+
+
+def get_client():
+    global _client
+    
+    if not _config.get("SNLM0E") or not _config.get("SECURE_1PSID"):
+        raise HTTPException(status_code=500, detail="请先在后台配置 Token 和 Cookie")
+    
+    # 如果 client 已存在，直接复用，保持会话上下文
+    if _client is not None:
+        sync_model_ids(_client)
+        return _client
     
+    with _client_lock:
+        if _client is None:
+            # 创建时获取 BL 需要请求一次 Gemini 页面（启动时已在后台预热）
+            from client import GeminiClient
+            _client = GeminiClient(
+                secure_1psid=_config["SECURE_1PSID"],
+                snlm0e=_config["SNLM0E"],
+                cookies_str=build_cookie_string(),
+                push_id=_config.get("PUSH_ID") or None,
+                debug=True,  # 启用调试模式以查看响应格式
+                summarize_history=HISTORY_SUMMARY,
+            )
+        client = _client
+    sync_model_ids(client)
+    return client
+
+
+_prefetch_task: Optional[asyncio.Task] = None
+_probe_task: Optional[asyncio.Task] = None
+
+
+@app.on_event("startup")
+async def load_config_and_prefetch():
+    """
+    启动时加载配置，并在后台预热客户端（获取 BL 版本号、加载会话状态）、启动凭证探测
+
+    预热不阻塞启动，服务立即开始接受请求；模型目录在第一次访问时加载。
+    """
+    global _prefetch_task, _probe_task
+    load_config()
+    loop = asyncio.get_running_loop()
+    if _config.get("SNLM0E") and _config.get("SECURE_1PSID"):
+        _prefetch_task = loop.create_task(prefetch_client())
+    if HEALTH_PROBE_INTERVAL > 0:
+        _probe_task = loop.create_task(probe_credentials_loop())
+
+
+async def prefetch_client():
+    started = time.perf_counter()
+    try:
+        await run_in_threadpool(get_client)
+        print(f"[INFO] 客户端预热完成，用时 {time.perf_counter() - started:.2f}s")
+    except Exception as e:
+        print(f"[WARN] 客户端预热失败（第一个请求时重试）: {e}")
+
+
+def probe_credentials() -> Optional[str]:
+    """
+    请求一次 Gemini 页面检查 Cookie：页面中有 SNlM0e 说明仍处于登录状态
+
+    返回凭证状态；网络错误等无法判断时返回 None
+    """
+    try:
+        with gemini_page_session(build_cookie_string(), timeout=HEALTH_PROBE_TIMEOUT) as session:
+            resp = session.get(GEMINI_PAGE_URL)
+    except Exception as e:
+        print(f"[WARN] 凭证探测失败: {e}")
+        return None
+    if resp.status_code in (401, 403) or (resp.status_code == 200 and '"SNlM0e"' not in resp.text):
+        return CREDENTIAL_EXPIRED
+    if resp.status_code == 200:
+        return CREDENTIAL_OK
+    print(f"[WARN] 凭证探测失败: HTTP {resp.status_code}")
+    return None
+
+
+async def probe_credentials_loop():
+    """后台定期探测当前账号的凭证，结果缓存在 health 中供 /readyz 读取"""
+    while True:
+        account = account_label(_config.get("SECURE_1PSID", ""))
+        if _config.get("SECURE_1PSID") and health.needs_probe(account, HEALTH_PROBE_INTERVAL):
+            credential = await run_in_threadpool(probe_credentials)
+            health.record_probe(account, credential, "" if credential != CREDENTIAL_EXPIRED else "Cookie 已失效")
+        await asyncio.sleep(min(HEALTH_PROBE_INTERVAL, 60))
+
+
+def sync_model_ids(client):
+    """models.json 中配置了 upstreamId 时，用它更新客户端的模型路由表；inputTokenLimit 作为消息历史的 token 预算"""
+    model_ids = _model_catalog.upstream_ids()
+    if model_ids and client.model_ids is not model_ids:
+        client.set_model_ids(model_ids)
+    client.history_token_limits = _model_catalog.token_limits()
+
+
+# 独立客户端（批处理、从会话快照分叉的请求使用，空闲的放回这里复用），不影响交互会话的上下文
+_isolated_clients: List[Any] = []
+
+
+def new_isolated_client():
+    """创建独立客户端：与主客户端共用账号，但不保存 / 恢复会话状态文件"""
+    main = get_client()
     from client import GeminiClient
-    _client = GeminiClient(
+    client = GeminiClient(
         secure_1psid=_config["SECURE_1PSID"],
         snlm0e=_config["SNLM0E"],
-        cookies_str=cookies,
+        cookies_str=build_cookie_string(),
         push_id=_config.get("PUSH_ID") or None,
-        debug=True,  # 启用调试模式以查看响应格式
+        bl=main.bl,
+        session_file=None,
+    )
+    sync_model_ids(client)
+    return client
+
+
+async def checkout_client():
+    """取出一个空闲的独立客户端（没有时新建），用完后调用 checkin_client 放回"""
+    if _isolated_clients:
+        return _isolated_clients.pop()
+    return await run_in_threadpool(new_isolated_client)
+
+
+def checkin_client(client):
+    _isolated_clients.append(client)
+
+
+class ClientLease:
+    """把独立客户端的归还当作槽位释放，与账号槽位组成 SlotGroup 交给流式生成任务"""
+    
+    def __init__(self, client):
+        self.client = client
+        self.released = False
+    
+    def release(self):
+        if not self.released:
+            self.released = True
+            checkin_client(self.client)
+
+
+async def fork_client(slot, checkpoint: tuple):
+    """
+    取出独立客户端并恢复到会话快照，下一条消息接在快照之后
+
+    返回 (client, 新槽位)：释放新槽位时同时归还客户端
+    """
+    client = await checkout_client()
+    client.restore(checkpoint)
+    return client, SlotGroup(slot, ClientLease(client))
+
+
+async def fresh_client(slot):
+    """
+    取出独立客户端并开始新对话（可缓存 / 可合并的无状态请求使用）
+
+    回复不受主会话中其他调用方的上下文影响，也不推进主会话；返回 (client, 新槽位)
+    """
+    client = await checkout_client()
+    client.reset()
+    return client, SlotGroup(slot, ClientLease(client))
+
+
+def share_first_turn(client) -> Optional[int]:
+    """
+    把独立客户端上新对话的第一轮记入主会话的快照（不切换主会话），返回它在主会话中的快照 ID
+
+    带着这一轮历史的下一轮请求按快照匹配直接从这里继续，不必补发第一轮。
+    """
+    checkpoint = client.get_checkpoint(client.head_checkpoint) if client.head_checkpoint is not None else None
+    if checkpoint is None:
+        return None
+    return get_client().adopt_checkpoint(checkpoint)
+
+
+_account_limiters: Dict[str, AccountLimiter] = {}
+_model_limiters: Dict[str, AccountLimiter] = {}
+
+
+def get_account_limiter() -> AccountLimiter:
+    """获取当前上游账号的并发限制器（按 __Secure-1PSID 区分账号，标签只使用其摘要）"""
+    account = account_label(_config.get("SECURE_1PSID", ""))
+    limiter = _account_limiters.get(account)
+    if limiter is None:
+        limiter = AccountLimiter(
+            account,
+            max_concurrency=ACCOUNT_MAX_CONCURRENCY,
+            max_queue=ACCOUNT_MAX_QUEUE,
+            queue_timeout=ACCOUNT_QUEUE_TIMEOUT,
+            weights={key: float(conf.get("weight", 1.0)) for key, conf in API_KEYS.items()},
+        )
+        _account_limiters[account] = limiter
+    return limiter
+
+
+def get_bearer_key(authorization: str = None) -> str:
+    """从 Authorization 头中取出 API Key"""
+    if authorization and authorization.startswith("Bearer "):
+        return authorization[7:]
+    return ""
+
+
+def resolve_priority(authorization: str = None, x_priority: str = None) -> str:
+    """请求优先级: X-Priority 请求头 > API Key 默认类别 > interactive"""
+    return (
+        normalize_priority(x_priority)
+        or normalize_priority(API_KEYS.get(get_bearer_key(authorization), {}).get("priority"))
+        or DEFAULT_PRIORITY
     )
-    return _client
+
+
+def get_model_limiter(model: str = None) -> Optional[AccountLimiter]:
+    """models.json 中配置了 maxConcurrency 的模型单独限制并发（如限制 Pro，给 Flash 留出容量）"""
+    if not model:
+        return None
+    model = model.replace("models/", "")
+    max_concurrency = _model_catalog.max_concurrency(model)
+    if max_concurrency <= 0:
+        return None
+    limiter = _model_limiters.get(model)
+    if limiter is None or limiter.max_concurrency != max_concurrency:
+        if limiter is not None and (limiter.active or limiter.queue_depth):
+            # 仍有请求在使用旧限制器，调整上限即可（调大时立即放行排队中的请求）
+            limiter.resize(max_concurrency)
+            return limiter
+        limiter = AccountLimiter(
+            f"model:{model}",
+            max_concurrency=max_concurrency,
+            max_queue=ACCOUNT_MAX_QUEUE,
+            queue_timeout=ACCOUNT_QUEUE_TIMEOUT,
+            weights={key: float(conf.get("weight", 1.0)) for key, conf in API_KEYS.items()},
+        )
+        _model_limiters[model] = limiter
+    return limiter
+
+
+async def acquire_account_slot(authorization: str = None, x_priority: str = None, model: str = None):
+    """按优先级排队获取模型和账号执行槽位，无法准入时返回 503 + Retry-After"""
+    priority = resolve_priority(authorization, x_priority)
+    key = get_bearer_key(authorization)
+    model_slot = None
+    try:
+        model_limiter = get_model_limiter(model)
+        if model_limiter is not None:
+            model_slot = await model_limiter.acquire(priority=priority, key=key)
+        account_slot = await get_account_limiter().acquire(priority=priority, key=key)
+    except AdmissionError as e:
+        if model_slot is not None:
+            model_slot.release()
+        raise HTTPException(
+            status_code=503,
+            detail=str(e),
+            headers={"Retry-After": str(e.retry_after)},
+        )
+    except BaseException:
+        if model_slot is not None:
+            model_slot.release()
+        raise
+    if model_slot is None:
+        return account_slot
+    return SlotGroup(model_slot, account_slot)
 
 
 def get_login_html():
@@ -477,6 +827,8 @@ def get_admin_html():
                 <p>API Key: <strong id="apiKey"></strong></p>
                 <p style="margin-top: 10px; font-size: 12px; color: #666;">💡 服务器地址: <strong id="serverIp"></strong></p>
             </div>
+            
+            <button type="button" class="btn" id="reloadModelsBtn">🔄 重新加载模型列表</button>
         </div>
     </div>
     
@@ -622,14 +974,34 @@ def get_admin_html():
             if (!r.ok) throw new Error('未登录');
             return r.json();
         }).then(config => {
-            if (config.FULL_COOKIE) {
-                document.getElementById('FULL_COOKIE').value = config.FULL_COOKIE;
-                showParsedFields(parseCookie(config.FULL_COOKIE));
+            // 已保存的 Cookie 不回显，只显示脱敏后的字段
+            if (config.COOKIE_FIELDS && Object.keys(config.COOKIE_FIELDS).length) {
+                document.getElementById('FULL_COOKIE').placeholder = '已保存 Cookie（不回显），需要更换时粘贴新的完整 Cookie 字符串...';
+                showParsedFields(config.COOKIE_FIELDS);
             }
         }).catch(err => {
             console.log('加载配置失败:', err);
         });
         
+        // 修改 configs/models.json 后手动重新加载（文件修改时间变化也会自动重新加载）
+        document.getElementById('reloadModelsBtn').addEventListener('click', async () => {
+            const statusEl = document.getElementById('status');
+            try {
+                const resp = await fetch('/admin/models/reload', {method: 'POST', credentials: 'same-origin'});
+                if (resp.status === 401) {
+                    window.location.href = '/admin/login';
+                    return;
+                }
+                const result = await resp.json();
+                statusEl.className = result.success ? 'status success' : 'status error';
+                statusEl.textContent = (result.success ? '✅ ' : '❌ ') + result.message;
+            } catch (err) {
+                statusEl.className = 'status error';
+                statusEl.textContent = '❌ 重新加载失败: ' + err.message;
+            }
+            statusEl.style.display = 'block';
+        });
+        
         document.getElementById('configForm').addEventListener('submit', async (e) => {
             e.preventDefault();
             const formData = new FormData(e.target);
@@ -752,32 +1124,37 @@ async def admin_save(request: Request):
         return {"success": False, "message": "Cookie 中未找到 __Secure-1PSID 字段，请确保复制了完整的 Cookie"}
     
     # 从页面自动获取 SNLM0E 和 PUSH_ID
-    tokens = fetch_tokens_from_page(full_cookie)
+    page_tokens = fetch_tokens_from_page(full_cookie)
     
-    if not tokens.get("snlm0e"):
+    if not page_tokens.get("snlm0e"):
         return {"success": False, "message": "无法自动获取 AT Token，请检查 Cookie 是否有效或已过期"}
     
     # 更新配置
     _config["FULL_COOKIE"] = full_cookie
-    _config["SNLM0E"] = tokens["snlm0e"]
-    _config["PUSH_ID"] = tokens.get("push_id", "")
+    _config["SNLM0E"] = page_tokens["snlm0e"]
+    _config["PUSH_ID"] = page_tokens.get("push_id", "")
     
     # 从解析结果更新各字段
     for field in ["SECURE_1PSID", "SECURE_1PSIDTS", "SAPISID", "SID", "HSID", "SSID", "APISID"]:
         _config[field] = parsed.get(field, "")
     
     # 使用自动获取的模型列表，如果获取失败则使用默认值
-    if tokens.get("models"):
-        _config["MODELS"] = tokens["models"]
+    if page_tokens.get("models"):
+        _config["MODELS"] = page_tokens["models"]
     else:
         _config["MODELS"] = DEFAULT_MODELS.copy()
     
     save_config()
+    _model_catalog.invalidate()
     _client = None
+    _isolated_clients.clear()
+    _conversation_trie.clear()
+    # 刚从页面取到了 AT Token，说明新 Cookie 有效
+    health.record_probe(account_label(_config["SECURE_1PSID"]), CREDENTIAL_OK)
     
     # 构建结果信息
     parsed_fields = [k for k in ["SECURE_1PSID", "SECURE_1PSIDTS", "SAPISID", "SID", "HSID", "SSID", "APISID"] if parsed.get(k)]
-    push_id_msg = f"，PUSH_ID ✓" if tokens.get("push_id") else "，PUSH_ID ✗ (图片功能不可用)"
+    push_id_msg = f"，PUSH_ID ✓" if page_tokens.get("push_id") else "，PUSH_ID ✗ (图片功能不可用)"
     models_msg = f"，{len(_config['MODELS'])} 个模型" if _config.get("MODELS") else ""
     
     try:
@@ -795,11 +1172,25 @@ async def admin_save(request: Request):
         }
 
 
+# 账号凭证字段：/admin/config 不返回原值，只返回脱敏后的 Cookie 字段
+SECRET_CONFIG_FIELDS = ("SNLM0E", "SECURE_1PSID", "SECURE_1PSIDTS", "SAPISID", "SID", "HSID", "SSID", "APISID", "FULL_COOKIE")
+
+
+def mask_secret(value: str) -> str:
+    """脱敏：只保留开头 6 个字符"""
+    return value[:6] + "..." if len(value) > 6 else "***"
+
+
 @app.get("/admin/config")
 async def admin_get_config(request: Request):
     if not verify_admin_session(request):
         raise HTTPException(status_code=401, detail="未登录")
-    return _config
+    config = {k: v for k, v in _config.items() if k not in SECRET_CONFIG_FIELDS}
+    config["COOKIE_FIELDS"] = {
+        k: mask_secret(_config[k]) for k in SECRET_CONFIG_FIELDS
+        if k not in ("SNLM0E", "FULL_COOKIE") and _config.get(k)
+    }
+    return config
 
 
 # ============ API 路由 ============
@@ -828,6 +1219,9 @@ class ChatCompletionRequest(BaseModel):
     n: Optional[int] = None
     user: Optional[str] = None
     tools: Optional[List[Dict[str, Any]]] = None  # 支持工具配置（URL 上下文等）
+    stream_options: Optional[Dict[str, Any]] = None  # {"include_usage": true} 时流式最后发送用量块
+    # 扩展字段：从指定快照（某一轮之后，0 为对话开头）继续，用于重新生成、编辑后重发和分支对话，只需一次上游请求
+    checkpoint_id: Optional[int] = None
 
 
 class ChatCompletionChoice(BaseModel):
@@ -852,76 +1246,269 @@ class ChatCompletionResponse(BaseModel):
 
 
 def verify_api_key(authorization: str = Header(None)):
-    if not API_KEY:
+    if not API_KEYS:
         return True
-    if not authorization or not authorization.startswith("Bearer ") or authorization[7:] != API_KEY:
+    if not authorization or not authorization.startswith("Bearer ") or authorization[7:] not in API_KEYS:
         raise HTTPException(status_code=401, detail="Invalid API key")
     return True
 
 
+_rate_limiter: Optional[RateLimiter] = None
+
+
+def get_rate_limiter() -> RateLimiter:
+    global _rate_limiter
+    if _rate_limiter is None:
+        _rate_limiter = create_rate_limiter(RATE_LIMIT_BACKEND, RATE_LIMIT_DB)
+    return _rate_limiter
+
+
+_response_cache: Optional[ResponseCache] = None
+
+
+def get_response_cache() -> ResponseCache:
+    global _response_cache
+    if _response_cache is None:
+        _response_cache = ResponseCache(
+            max_entries=RESPONSE_CACHE_MAX_ENTRIES,
+            max_bytes=int(RESPONSE_CACHE_MAX_MB * 1024 * 1024),
+            ttl=RESPONSE_CACHE_TTL,
+            db_path=RESPONSE_CACHE_DB or None,
+        )
+    return _response_cache
+
+
+def is_stateless_request(messages: List[Dict[str, Any]]) -> bool:
+    """只有一条用户消息（可带 system）、没有历史回复的请求才视为无状态，可以缓存"""
+    roles = [m.get("role", "") for m in messages]
+    return bool(roles) and roles[-1] == "user" and roles.count("user") == 1 and all(
+        role in ("system", "user") for role in roles
+    )
+
+
+def stateless_request_key(model: str, messages: List[Dict[str, Any]], **params) -> Optional[str]:
+    """无状态请求的键（响应缓存和相同请求合并共用），多轮对话或两者都未开启时返回 None"""
+    if not (RESPONSE_CACHE or REQUEST_COALESCING) or not is_stateless_request(messages):
+        return None
+    return make_cache_key(model, messages, **params)
+
+
+def response_cache_key(cache_control: Optional[str], request_key: Optional[str]) -> Optional[str]:
+    """可缓存时返回缓存键，否则返回 None（未开启、多轮对话或请求要求跳过缓存）"""
+    if not RESPONSE_CACHE or not request_key:
+        return None
+    if cache_control and any(d in cache_control.lower() for d in ("no-cache", "no-store")):
+        metrics.inc("gemini_cache_bypass_total")
+        return None
+    return request_key
+
+
+_single_flight = SingleFlight()
+
+
+def join_inflight(request_key: Optional[str]) -> Optional[Flight]:
+    """已有相同请求在生成时返回它的 Flight"""
+    if not REQUEST_COALESCING or not request_key:
+        return None
+    return _single_flight.get(request_key)
+
+
+def start_flight(request_key: Optional[str]) -> Flight:
+    """登记本请求的生成；不可合并的请求使用不登记的 Flight（只有自己订阅）"""
+    if not REQUEST_COALESCING or not request_key:
+        return Flight()
+    return _single_flight.start(request_key)
+
+
+def start_stream_producer(
+    flight: Flight,
+    client,
+    slot,
+    content,
+    model: str,
+    url_context: bool,
+    tools,
+    cache_key: Optional[str] = None,
+    prompt_tokens: int = 0,
+    cached_tokens: int = 0,
+    system: Optional[str] = None,
+    context: Optional[List[Dict[str, Any]]] = None,
+    share_turn: bool = False,
+):
+    """
+    为真流式请求设置生成任务
+
+    上游增量发布到 flight，由所有订阅者共享；生成结束后记录会话、写入响应缓存并释放账号槽位。
+    所有订阅者断开后取消上游生成（会话上下文回滚）。share_turn 为 True 时（独立客户端上的新对话）
+    本轮同时记入主会话的快照。
+    """
+    async def produce(flight: Flight):
+        upstream = None
+        try:
+            # 解析消息的文本和图片（URL 图片需要下载，放到线程池）
+            text_content, images = await run_in_threadpool(client._parse_content, content)
+            if flight.done:
+                return
+            upstream = UpstreamStream(
+                client,
+                text=text_content,
+                images=images,
+                model=model,
+                url_context=url_context,
+                tools=tools,
+                system=system,
+                context=context,
+            )
+            flight.on_abandon(upstream.cancel)
+            async for chunk in upstream:
+                flight.publish(chunk)
+            if upstream.cancelled or flight.done:
+                return
+            reply = flight.text
+            client.record_turn(content, reply, context)
+            if share_turn:
+                share_first_turn(client)
+            usage = tokens.usage(prompt_tokens, reply, cached_tokens)
+            if cache_key:
+                get_response_cache().put(cache_key, {"text": reply, "usage": usage})
+            flight.finish(usage=usage)
+        finally:
+            if upstream is not None:
+                upstream.close()
+            slot.release()
+    
+    flight.set_producer(produce)
+
+
+def abandon_unstarted_flight(flight: Flight, slot):
+    """兜底：客户端在流开始前断开时生成任务不会启动，由后台任务释放槽位"""
+    if not flight.started:
+        flight.finish(error=FlightCancelled("请求已取消"))
+        slot.release()
+
+
+def iter_cached_chunks(text: str):
+    """把缓存的完整回复切成流式输出的块"""
+    return split_chunks(text, RESPONSE_CACHE_STREAM_CHUNK)
+
+
+def get_key_limits(api_key: str) -> tuple:
+    """API Key 的 (rpm, cpm) 限额"""
+    conf = API_KEYS.get(api_key, {})
+    return int(conf.get("rpm", RATE_LIMIT_RPM)), int(conf.get("cpm", RATE_LIMIT_CPM))
+
+
+def count_content_chars(content) -> int:
+    """统计消息内容的字符数（图片不计）"""
+    if isinstance(content, str):
+        return len(content)
+    if isinstance(content, list):
+        return sum(len(item.get("text", "")) for item in content if isinstance(item, dict))
+    return 0
+
+
+def check_rate_limit(authorization: str, chars: int) -> Dict[str, str]:
+    """
+    按 API Key 扣减请求数和输入字符额度
+
+    Returns:
+        x-ratelimit-* 响应头
+    Raises:
+        HTTPException: 429，附带 Retry-After
+    """
+    if not API_KEYS:
+        return {}
+    api_key = get_bearer_key(authorization)
+    rpm, cpm = get_key_limits(api_key)
+    try:
+        result = get_rate_limiter().check(api_key, rpm, cpm, chars)
+    except RateLimitExceeded as e:
+        metrics.inc("gemini_rate_limited_total")
+        raise HTTPException(status_code=429, detail=str(e), headers=e.result.headers())
+    return result.headers()
+
+
+def charge_output_chars(authorization: str, chars: int):
+    """生成完成后补扣输出字符额度"""
+    if not API_KEYS or chars <= 0:
+        return
+    api_key = get_bearer_key(authorization)
+    _, cpm = get_key_limits(api_key)
+    try:
+        get_rate_limiter().charge(api_key, cpm, chars)
+    except Exception as e:
+        print(f"[WARN] 扣减输出字符额度失败: {e}")
+
+
 @app.get("/")
 async def root():
     return RedirectResponse(url="/admin")
 
 
+@app.get("/healthz")
+async def healthz():
+    """存活检查：进程能处理请求即可，不做任何 I/O"""
+    return {"status": "ok"}
+
+
+@app.get("/readyz")
+async def readyz():
+    """
+    就绪检查：账号凭证状态、最近一次成功生成的时间、连接池占用
+
+    只读取缓存的状态（生成结果和后台探测），从不请求上游。
+    未配置账号或 Cookie 已失效时返回 503；尚未探测（unknown）视为就绪。
+    """
+    configured = bool(_config.get("SNLM0E") and _config.get("SECURE_1PSID"))
+    account = health.snapshot(account_label(_config.get("SECURE_1PSID", "")))
+    limiter = get_account_limiter()
+    ready = configured and account["credential"] != CREDENTIAL_EXPIRED
+    return FastJSONResponse(
+        {
+            "status": "ready" if ready else "not_ready",
+            "configured": configured,
+            "client_ready": _client is not None,
+            "account": account,
+            "pool": {
+                "active": limiter.active,
+                "max_concurrency": limiter.max_concurrency,
+                "queue_depth": limiter.queue_depth,
+                "max_queue": limiter.max_queue,
+                "saturation": round(limiter.active / limiter.max_concurrency, 3),
+            },
+            "probe_interval_seconds": HEALTH_PROBE_INTERVAL,
+        },
+        status_code=200 if ready else 503,
+    )
+
+
+# 模型目录：启动时加载一次，models.json 修改后自动重新加载
+_model_catalog = ModelCatalog(
+    os.path.join(os.path.dirname(__file__), "configs", "models.json"),
+    fallback=lambda: _config.get("MODELS", DEFAULT_MODELS),
+)
+
+
+def catalog_response(request: Request, body: bytes, etag: str) -> Response:
+    """返回预先序列化的模型列表，If-None-Match 命中时返回 304"""
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if_none_match = request.headers.get("if-none-match", "")
+    if etag in (tag.strip() for tag in if_none_match.split(",")) or if_none_match.strip() == "*":
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
+
 @app.get("/v1/models")
-async def list_models(authorization: str = Header(None)):
+async def list_models(request: Request, authorization: str = Header(None)):
     verify_api_key(authorization)
-    
-    # 优先从 models.json 加载所有模型
-    try:
-        import json as json_lib
-        models_file = os.path.join(os.path.dirname(__file__), "configs", "models.json")
-        if os.path.exists(models_file):
-            with open(models_file, "r", encoding="utf-8") as f:
-                models_data = json_lib.load(f)
-                models_list = models_data.get("models", [])
-                # 提取模型名称（去掉 "models/" 前缀）
-                model_ids = [m.get("name", "").replace("models/", "") for m in models_list if m.get("name")]
-                if model_ids:
-                    models = model_ids
-                else:
-                    models = _config.get("MODELS", DEFAULT_MODELS)
-        else:
-            models = _config.get("MODELS", DEFAULT_MODELS)
-    except Exception as e:
-        print(f"[WARN] 无法加载 models.json: {e}")
-        models = _config.get("MODELS", DEFAULT_MODELS)
-    
-    created = int(time.time())
-    return {
-        "object": "list",
-        "data": [{"id": m, "object": "model", "created": created, "owned_by": "google"} for m in models]
-    }
+    return catalog_response(request, *_model_catalog.openai_body())
 
 
 @app.get("/v1beta/models")
-async def list_models_v1beta(authorization: str = Header(None)):
+async def list_models_v1beta(request: Request, authorization: str = Header(None)):
     """Gemini 原生 API - 列出模型"""
     verify_api_key(authorization)
-    try:
-        import json as json_lib
-        models_file = os.path.join(os.path.dirname(__file__), "configs", "models.json")
-        if os.path.exists(models_file):
-            with open(models_file, "r", encoding="utf-8") as f:
-                models_data = json_lib.load(f)
-                return {"models": models_data.get("models", [])}
-    except Exception as e:
-        print(f"[WARN] 无法加载 models.json: {e}")
-    
-    # 回退到默认模型
-    models = _config.get("MODELS", DEFAULT_MODELS)
-    return {
-        "models": [
-            {
-                "name": f"models/{m}",
-                "displayName": m.replace("models/", "").replace("-", " ").title(),
-                "inputTokenLimit": 1048576,
-                "outputTokenLimit": 65536,
-            }
-            for m in models
-        ]
-    }
+    return catalog_response(request, *_model_catalog.gemini_body())
 
 
 def log_api_call(request_data: dict, response_data: dict, error: str = None):
@@ -940,71 +1527,175 @@ def log_api_call(request_data: dict, response_data: dict, error: str = None):
         print(f"[LOG ERROR] 写入日志失败: {e}")
 
 
-# 用于追踪会话：保存上次请求的所有用户消息内容
-_last_user_messages_hash = ""
+# 会话快照的消息前缀树：按请求携带的消息历史找到可以继续的快照
+_conversation_trie = ConversationTrie()
+
 
+def route_conversation(client, messages: List[Any]) -> List[Dict[str, Any]]:
+    """
+    按请求的消息历史选择从哪个快照继续，返回需要随本轮补发的历史消息
 
-def get_user_messages_hash(messages: list) -> str:
-    """计算所有用户消息的 hash，用于判断是否是同一会话"""
-    content_str = ""
+    最后一条用户消息之前的历史与快照逐条匹配：切换到匹配最深的快照（可能是另一个分支或另一段对话），
+    之后未匹配的消息随本轮补发；完全不匹配时开始新对话。
+    """
+    _conversation_trie.sync(client.checkpoints)
+    dialog = dialog_messages(messages)
+    history = dialog[:-1]
+    checkpoint_id, depth = _conversation_trie.match(message_key(m["role"], m["content"]) for m in history)
+    if checkpoint_id != client.head_checkpoint or (checkpoint_id is None and client.conversation_id):
+        if client.debug:
+            print(f"[DEBUG] 会话切换到快照 {checkpoint_id}，匹配 {depth}/{len(history)} 条历史消息")
+        client.fork(checkpoint_id)
+    return history[depth:]
+
+
+def system_prompt_text(messages: List[Any]) -> Optional[str]:
+    """OpenAI 格式消息中的系统提示词（多条时按顺序合并），没有时返回 None"""
+    parts = []
     for m in messages:
-        role = m.role if hasattr(m, 'role') else m.get('role', '')
-        if role != "user":
+        if m.role != "system":
             continue
-        content = m.content if hasattr(m, 'content') else m.get('content', '')
-        if isinstance(content, list):
-            # 对于包含图片的消息，只取文本部分
-            text_parts = [item.get('text', '') for item in content if item.get('type') == 'text']
-            content_str += f"{' '.join(text_parts)}|"
+        if isinstance(m.content, list):
+            parts.append(" ".join(item.get("text", "") for item in m.content if item.get("type") == "text"))
         else:
-            content_str += f"{content}|"
-    return hashlib.md5(content_str.encode()).hexdigest()
+            parts.append(m.content)
+    return "\n\n".join(part for part in parts if part) or None
 
 
-def is_continuation(current_messages: list, last_hash: str) -> bool:
-    """
-    判断当前请求是否是上一次对话的延续
+def wants_stream_usage(request: ChatCompletionRequest) -> bool:
+    """stream_options.include_usage：流式响应结束前发送一个用量块"""
+    return bool(request.stream_options and request.stream_options.get("include_usage"))
+
+
+def cached_chat_completion(request: ChatCompletionRequest, cached: Dict[str, Any], headers: Dict[str, str]):
+    """用缓存的回复构造 OpenAI 格式响应（流式时直接从内存输出）"""
+    completion_id = f"chatcmpl-{uuid.uuid4().hex[:8]}"
+    created_time = int(time.time())
+    reply_content = cached["text"]
+    usage = cached.get("usage") or tokens.usage(tokens.count_messages(request.messages), reply_content)
     
-    逻辑：
-    1. 如果消息列表中有 assistant 的回复，说明是延续对话
-    2. 或者如果消息数量 > 1，也认为是延续对话
-    3. 否则检查 hash 是否匹配
-    """
-    if not last_hash:
-        return False
+    if request.stream:
+        def generate_cached_stream():
+            encoder = OpenAIChunkEncoder(completion_id, created_time, request.model)
+            yield encoder.role()
+            for text in iter_cached_chunks(reply_content):
+                yield encoder.content(text)
+            yield encoder.finish()
+            if wants_stream_usage(request):
+                yield encoder.usage(usage)
+            yield DONE
+        
+        return StreamingResponse(
+            generate_cached_stream(),
+            media_type="text/event-stream",
+            headers={
+                "Cache-Control": "no-cache",
+                "Connection": "keep-alive",
+                "X-Accel-Buffering": "no",
+                **headers,
+            }
+        )
     
-    # 检查是否有 assistant 的回复（说明是延续对话）
-    has_assistant = any(
-        (m.role if hasattr(m, 'role') else m.get('role', '')) == "assistant"
-        for m in current_messages
+    response_data = ChatCompletionResponse(
+        id=completion_id,
+        created=created_time,
+        model=request.model,
+        choices=[ChatCompletionChoice(index=0, message={"role": "assistant", "content": reply_content}, finish_reason="stop")],
+        usage=Usage(**usage)
     )
+    return FastJSONResponse(
+        content=response_data.model_dump(),
+        headers={
+            "Cache-Control": "no-cache",
+            "X-Request-Id": completion_id,
+            **headers,
+        }
+    )
+
+
+def chat_flight_stream(
+    request: ChatCompletionRequest,
+    flight: Flight,
+    raw_request: Request,
+    authorization: str,
+    headers: Dict[str, str],
+    background: Optional[BackgroundTask] = None,
+):
+    """订阅 flight 的 OpenAI 格式流式响应（重放已输出的增量，然后实时转发）"""
+    encoder = OpenAIChunkEncoder(f"chatcmpl-{uuid.uuid4().hex[:8]}", int(time.time()), request.model)
     
-    if has_assistant:
-        return True
-    
-    # 如果消息数量 > 1，也认为是延续对话
-    if len(current_messages) > 1:
-        return True
-    
-    # 找到所有用户消息
-    user_indices = [i for i, m in enumerate(current_messages) 
-                    if (m.role if hasattr(m, 'role') else m.get('role', '')) == "user"]
-    
-    if len(user_indices) <= 1:
-        # 只有一条用户消息，且没有 assistant 回复，视为新对话
-        return False
-    
-    # 去掉最后一条用户消息，计算剩余消息的 hash
-    last_user_idx = user_indices[-1]
-    prev_messages = current_messages[:last_user_idx]
-    prev_hash = get_user_messages_hash(prev_messages)
+    async def generate_flight_stream():
+        streamed_chars = 0
+        # 窗口内连续到达的小增量合并成一块输出；长时间没有增量时输出心跳
+        deltas = heartbeat(coalesce(flight.subscribe(), SSE_FLUSH_WINDOW_MS / 1000), SSE_HEARTBEAT_INTERVAL)
+        try:
+            # 立即发送初始块（生成任务在此之后才开始解析图片、上传和请求上游）
+            yield encoder.role()
+            async for text in deltas:
+                # 客户端已断开时退订；所有订阅者都断开后上游生成会被取消
+                if await raw_request.is_disconnected():
+                    return
+                if text is None:
+                    yield PING
+                    continue
+                streamed_chars += len(text)
+                yield encoder.content(text)
+            # 发送结束标记
+            yield encoder.finish()
+            if wants_stream_usage(request):
+                yield encoder.usage(flight.usage or tokens.usage(tokens.count_messages(request.messages), flight.text))
+            yield DONE
+        except FlightCancelled:
+            return
+        except Exception as e:
+            detail = e.detail if isinstance(e, HTTPException) else str(e)
+            yield encoder.chunk({"content": f"错误: {detail}"}, "stop")
+            yield DONE
+        finally:
+            await deltas.aclose()
+            charge_output_chars(authorization, streamed_chars)
     
-    return prev_hash == last_hash
+    return StreamingResponse(
+        generate_flight_stream(),
+        media_type="text/event-stream",
+        headers={
+            "Cache-Control": "no-cache",
+            "Connection": "keep-alive",
+            "X-Accel-Buffering": "no",
+            **headers,
+        },
+        background=background,
+    )
+
+
+async def coalesced_chat_completion(
+    request: ChatCompletionRequest,
+    flight: Flight,
+    raw_request: Request,
+    authorization: str,
+    headers: Dict[str, str],
+):
+    """合并到进行中的相同请求：流式订阅增量，非流式等待完整结果"""
+    if request.stream:
+        return chat_flight_stream(request, flight, raw_request, authorization, headers)
+    try:
+        reply_content = await flight.result()
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    charge_output_chars(authorization, len(reply_content))
+    return cached_chat_completion(request, {"text": reply_content, "usage": flight.usage}, headers)
 
 
 @app.post("/v1/chat/completions")
-async def chat_completions(request: ChatCompletionRequest, authorization: str = Header(None)):
-    global _last_user_messages_hash
+async def chat_completions(
+    request: ChatCompletionRequest,
+    raw_request: Request,
+    authorization: str = Header(None),
+    x_priority: Optional[str] = Header(None),
+    cache_control: Optional[str] = Header(None),
+):
     verify_api_key(authorization)
     
     # 记录请求入参 (图片内容截断显示)
@@ -1033,46 +1724,65 @@ async def chat_completions(request: ChatCompletionRequest, authorization: str =
             msg_log["content"] = m.content
         request_log["messages"].append(msg_log)
     
+    # 按完整对话历史估算输入 token
+    prompt_tokens = tokens.count_messages(request.messages)
+    
+    # 按 API Key 限流（请求数 + 输入字符数）
+    rate_headers = check_rate_limit(
+        authorization, sum(count_content_chars(m.content) for m in request.messages)
+    )
+    
+    # 无状态单轮请求先查响应缓存，命中时不占用账号槽位、不请求上游（从快照继续的请求不是无状态的）
+    request_key = None if request.checkpoint_id is not None else stateless_request_key(
+        request.model,
+        [{"role": m.role, "content": m.content} for m in request.messages],
+        tools=request.tools,
+        temperature=request.temperature,
+        top_p=request.top_p,
+        max_tokens=request.max_tokens,
+        stop=request.stop,
+    )
+    cache_key = response_cache_key(cache_control, request_key)
+    if cache_key:
+        cached = get_response_cache().get(cache_key)
+        if cached is not None:
+            return cached_chat_completion(request, cached, {**rate_headers, "X-Cache": "HIT"})
+        rate_headers = {**rate_headers, "X-Cache": "MISS"}
+    
+    # 相同请求正在生成时直接订阅它的结果，不再向上游发起新的生成
+    inflight = join_inflight(request_key)
+    if inflight is not None:
+        return await coalesced_chat_completion(
+            request, inflight, raw_request, authorization, {**rate_headers, "X-Coalesced": "1"}
+        )
+    
+    flight = start_flight(request_key)
+    slot = None
+    stream_owns_slot = False  # 真流式时槽位交给生成任务，在流结束后释放
     try:
         client = get_client()
+        # 排队获取账号执行槽位（并发限制 + 优先级调度 + 准入控制）
+        slot = await acquire_account_slot(authorization, x_priority, request.model)
         
-        # 判断是否需要重置会话
-        # 关键：Gemini 通过 conversation_id 等维护上下文，不应该轻易重置
-        # 只有在明确是新对话时才重置（第一条消息且没有 conversation_id）
-        has_assistant = any(
-            (m.role if hasattr(m, 'role') else m.get('role', '')) == "assistant"
-            for m in request.messages
-        )
-        
-        # 检查请求中是否明确要求重置（通过特殊标记或第一条消息且没有历史）
-        # 只有在以下情况才重置：
-        # 1. 只有一条用户消息
-        # 2. 没有 assistant 回复
-        # 3. client 的 conversation_id 为空（说明是新对话，没有保存的历史）
-        # 4. 不是延续对话
-        # 5. 客户端没有保存的消息历史
-        should_reset = (
-            len(request.messages) == 1 and 
-            not has_assistant and 
-            not client.conversation_id and
-            len(client.messages) == 0 and  # 确保没有保存的历史
-            not is_continuation(request.messages, _last_user_messages_hash)
-        )
-        
-        if should_reset:
-            client.reset()
-        # 其他情况都保持上下文，不重置
-        # 如果客户端有 conversation_id 或消息历史，说明是延续对话，不应该重置
+        share_turn = False
+        if request.checkpoint_id is not None:
+            # 从指定的快照继续：只发送最后一条用户消息，不重放之前的历史
+            fork_conversation(client, request.checkpoint_id)
+            context = []
+        elif request_key is not None:
+            # 回复会写入缓存或分给合并进来的请求，必须在新对话中生成；本轮记入主会话的快照，下一轮可以接着继续
+            client, slot = await fresh_client(slot)
+            context = []
+            share_turn = True
+        else:
+            # 按消息历史匹配会话快照，只发送快照之后的消息
+            context = route_conversation(client, request.messages)
         
         # 处理消息，支持 OpenAI 格式的图片 (base64)
-        messages = []
-        for m in request.messages:
-            content = m.content
-            # 如果 content 是列表 (包含图片)，保持原样传递
-            if isinstance(content, list):
-                messages.append({"role": m.role, "content": content})
-            else:
-                messages.append({"role": m.role, "content": content})
+        # 之前的历史已由会话快照（及补发的 context）承载，只传系统提示词和最后一条用户消息
+        last_user = dialog_messages(request.messages)[-1:]
+        messages = [{"role": m.role, "content": m.content} for m in request.messages if m.role == "system"]
+        messages.extend(last_user)
         
         # 检查是否启用 URL 上下文
         url_context = False
@@ -1082,176 +1792,78 @@ async def chat_completions(request: ChatCompletionRequest, authorization: str =
                     url_context = True
                     break
         
-        response = client.chat(
-            messages=messages, 
-            model=request.model,
-            url_context=url_context,
-            tools=getattr(request, 'tools', None)
-        )
+        # 真流式直接转发上游流，不再先调用一次 client.chat（否则每个流式请求会生成两遍）
+        use_real_stream = bool(request.stream) and STREAMING_MODE == "real"
         
-        # 更新消息 hash（包含本次的完整用户消息）
-        _last_user_messages_hash = get_user_messages_hash(request.messages)
+        reply_content = ""
+        if not use_real_stream:
+            # 在线程池中执行阻塞的上游请求，避免阻塞事件循环（排队中的请求才能及时超时）
+            response = await run_in_threadpool(
+                client.chat,
+                messages=messages, 
+                model=request.model,
+                url_context=url_context,
+                tools=getattr(request, 'tools', None),
+                context=context,
+            )
+            # 原样返回响应内容，不做任何格式化处理
+            reply_content = response.choices[0].message.content
+            checkpoint_id = share_first_turn(client) if share_turn else client.head_checkpoint
+            charge_output_chars(authorization, len(reply_content))
+            usage = tokens.usage(prompt_tokens, reply_content)
+            if cache_key:
+                get_response_cache().put(cache_key, {"text": reply_content, "usage": usage})
+            # 发布给合并进来的相同请求
+            flight.publish(reply_content)
+            flight.finish(usage=usage)
         
-        # 原样返回响应内容，不做任何格式化处理
-        reply_content = response.choices[0].message.content
         completion_id = f"chatcmpl-{uuid.uuid4().hex[:8]}"
         created_time = int(time.time())
         
         # 处理流式响应
         if request.stream:
-            # 检查流式模式
-            use_real_stream = STREAMING_MODE == "real"
-            
             if use_real_stream:
-                # 真流式：实时转发 Gemini 流式响应
-                async def generate_real_stream():
-                    try:
-                        # 检查是否启用 URL 上下文
-                        url_context = False
-                        if hasattr(request, 'tools') and request.tools:
-                            for tool in request.tools:
-                                if "urlContext" in tool:
-                                    url_context = True
-                                    break
-                        
-                        # 获取最后一条用户消息
-                        last_message = request.messages[-1] if request.messages else None
-                        if not last_message:
-                            return
-                        
-                        text_content = ""
-                        if isinstance(last_message.content, str):
-                            text_content = last_message.content
-                        elif isinstance(last_message.content, list):
-                            for item in last_message.content:
-                                if item.get("type") == "text":
-                                    text_content = item.get("text", "")
-                        
-                        # 发送初始块
-                        chunk_data = {
-                            "id": completion_id,
-                            "object": "chat.completion.chunk",
-                            "created": created_time,
-                            "model": request.model,
-                            "choices": [{
-                                "index": 0,
-                                "delta": {"role": "assistant"},
-                                "finish_reason": None
-                            }]
-                        }
-                        yield f"data: {json.dumps(chunk_data)}\n\n"
-                        
-                        # 流式获取响应
-                        stream_gen = client._send_stream_request(
-                            text=text_content,
-                            images=None,
-                            model=request.model,
-                            url_context=url_context,
-                            tools=getattr(request, 'tools', None)
-                        )
-                        
-                        for chunk in stream_gen:
-                            chunk_data = {
-                                "id": completion_id,
-                                "object": "chat.completion.chunk",
-                                "created": created_time,
-                                "model": request.model,
-                                "choices": [{
-                                    "index": 0,
-                                    "delta": {"content": chunk},
-                                    "finish_reason": None
-                                }]
-                            }
-                            yield f"data: {json.dumps(chunk_data)}\n\n"
-                        
-                        # 发送结束标记
-                        chunk_data = {
-                            "id": completion_id,
-                            "object": "chat.completion.chunk",
-                            "created": created_time,
-                            "model": request.model,
-                            "choices": [{
-                                "index": 0,
-                                "delta": {},
-                                "finish_reason": "stop"
-                            }]
-                        }
-                        yield f"data: {json.dumps(chunk_data)}\n\n"
-                        yield "data: [DONE]\n\n"
-                    except Exception as e:
-                        error_chunk = {
-                            "id": completion_id,
-                            "object": "chat.completion.chunk",
-                            "created": created_time,
-                            "model": request.model,
-                            "choices": [{
-                                "index": 0,
-                                "delta": {"content": f"错误: {str(e)}"},
-                                "finish_reason": "stop"
-                            }]
-                        }
-                        yield f"data: {json.dumps(error_chunk)}\n\n"
-                        yield "data: [DONE]\n\n"
-                
-                return StreamingResponse(
-                    generate_real_stream(), 
-                    media_type="text/event-stream",
-                    headers={
-                        "Cache-Control": "no-cache",
-                        "Connection": "keep-alive",
-                        "X-Accel-Buffering": "no",
-                    }
+                # 真流式：生成任务把 Gemini 流式响应发布到 flight，本请求和合并进来的请求都订阅它
+                start_stream_producer(
+                    flight,
+                    client,
+                    slot,
+                    messages[-1]["content"],
+                    model=request.model,
+                    url_context=url_context,
+                    tools=getattr(request, 'tools', None),
+                    cache_key=cache_key,
+                    prompt_tokens=prompt_tokens,
+                    system=system_prompt_text(request.messages),
+                    context=context,
+                    share_turn=share_turn,
+                )
+                stream_owns_slot = True
+                return chat_flight_stream(
+                    request,
+                    flight,
+                    raw_request,
+                    authorization,
+                    rate_headers,
+                    background=BackgroundTask(abandon_unstarted_flight, flight, slot),
                 )
             else:
-                # 假流式：等待完整响应后模拟流式
+                # 假流式：完整响应已在内存中，按句子 / 单词边界切块立即输出（不再人为延迟）
                 async def generate_fake_stream():
+                    encoder = OpenAIChunkEncoder(completion_id, created_time, request.model)
                     # 发送角色信息
-                    chunk_data = {
-                        "id": completion_id,
-                        "object": "chat.completion.chunk",
-                        "created": created_time,
-                        "model": request.model,
-                        "choices": [{
-                            "index": 0,
-                            "delta": {"role": "assistant"},
-                            "finish_reason": None
-                        }]
-                    }
-                    yield f"data: {json.dumps(chunk_data)}\n\n"
+                    yield encoder.role()
                     
-                    # 将完整内容分块发送（模拟流式）
-                    chunk_size = 10  # 每次发送10个字符
-                    for i in range(0, len(reply_content), chunk_size):
-                        chunk_text = reply_content[i:i+chunk_size]
-                        chunk_data = {
-                            "id": completion_id,
-                            "object": "chat.completion.chunk",
-                            "created": created_time,
-                            "model": request.model,
-                            "choices": [{
-                                "index": 0,
-                                "delta": {"content": chunk_text},
-                                "finish_reason": None
-                            }]
-                        }
-                        yield f"data: {json.dumps(chunk_data)}\n\n"
-                        import asyncio
-                        await asyncio.sleep(0.05)  # 模拟延迟
+                    # 将完整内容分块发送（配置了 FAKE_STREAM_BYTES_PER_SEC 时按速率输出）
+                    chunks = split_chunks(reply_content, FAKE_STREAM_CHUNK_SIZE)
+                    async for text in pace(chunks, FAKE_STREAM_BYTES_PER_SEC):
+                        yield encoder.content(text)
                     
                     # 发送结束标记
-                    chunk_data = {
-                        "id": completion_id,
-                        "object": "chat.completion.chunk",
-                        "created": created_time,
-                        "model": request.model,
-                        "choices": [{
-                            "index": 0,
-                            "delta": {},
-                            "finish_reason": "stop"
-                        }]
-                    }
-                    yield f"data: {json.dumps(chunk_data)}\n\n"
-                    yield "data: [DONE]\n\n"
+                    yield encoder.finish()
+                    if wants_stream_usage(request):
+                        yield encoder.usage(usage)
+                    yield DONE
                 
                 return StreamingResponse(
                     generate_fake_stream(), 
@@ -1260,6 +1872,7 @@ async def chat_completions(request: ChatCompletionRequest, authorization: str =
                         "Cache-Control": "no-cache",
                         "Connection": "keep-alive",
                         "X-Accel-Buffering": "no",
+                        **rate_headers,
                     }
                 )
         
@@ -1268,21 +1881,25 @@ async def chat_completions(request: ChatCompletionRequest, authorization: str =
             created=created_time,
             model=request.model,
             choices=[ChatCompletionChoice(index=0, message={"role": "assistant", "content": reply_content}, finish_reason="stop")],
-            usage=Usage(prompt_tokens=response.usage.prompt_tokens, completion_tokens=response.usage.completion_tokens, total_tokens=response.usage.total_tokens)
+            usage=Usage(**usage)
         )
         
         # 记录完整响应
         log_api_call(request_log, response_data.model_dump())
         
         # 使用 JSONResponse 确保正确的 Content-Type 和响应头
-        return JSONResponse(
+        checkpoint_headers = {"X-Checkpoint-Id": str(checkpoint_id)} if checkpoint_id else {}
+        return FastJSONResponse(
             content=response_data.model_dump(),
             headers={
                 "Cache-Control": "no-cache",
                 "X-Request-Id": completion_id,
+                **checkpoint_headers,
+                **rate_headers,
             }
         )
-    except HTTPException:
+    except HTTPException as e:
+        flight.finish(error=e)
         raise
     except Exception as e:
         import traceback
@@ -1291,7 +1908,11 @@ async def chat_completions(request: ChatCompletionRequest, authorization: str =
         traceback.print_exc()
         # 记录错误日志
         log_api_call(request_log, None, error=error_msg)
+        flight.finish(error=e)
         raise HTTPException(status_code=500, detail=error_msg)
+    finally:
+        if slot is not None and not stream_owns_slot:
+            slot.release()
 
 
 @app.post("/v1/chat/completions/reset")
@@ -1303,6 +1924,53 @@ async def reset_context(authorization: str = Header(None)):
     return {"status": "ok"}
 
 
+class ForkRequest(BaseModel):
+    checkpoint_id: int  # 0 表示对话开头
+
+
+def fork_conversation(client, checkpoint_id: int):
+    """把会话切换到指定快照之后（0 为对话开头），快照不存在时返回 404"""
+    try:
+        client.fork(checkpoint_id or None)
+    except KeyError:
+        raise HTTPException(status_code=404, detail=f"快照不存在: {checkpoint_id}")
+
+
+def checkpoint_summary(checkpoint: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "id": checkpoint["id"],
+        "parent": checkpoint["parent"],
+        "created": checkpoint["created"],
+        "user": checkpoint["user"][:200],
+        "reply": checkpoint["reply"][:200],
+    }
+
+
+@app.get("/v1/conversation/checkpoints")
+async def list_checkpoints(authorization: str = Header(None)):
+    """当前会话每一轮的快照（树形，parent 为上一轮），head 为当前分支的最新一轮"""
+    verify_api_key(authorization)
+    client = get_client()
+    return {
+        "object": "list",
+        "head": client.head_checkpoint,
+        "data": [checkpoint_summary(c) for c in client.checkpoints],
+    }
+
+
+@app.post("/v1/conversation/fork")
+async def fork_checkpoint(request: ForkRequest, authorization: str = Header(None)):
+    """
+    把当前会话切换到某个快照之后，下一条消息从那里继续（不重放历史）
+
+    也可以直接在 /v1/chat/completions 请求中带上 checkpoint_id，切换和发送一次完成。
+    """
+    verify_api_key(authorization)
+    client = get_client()
+    fork_conversation(client, request.checkpoint_id)
+    return {"status": "ok", "head": client.head_checkpoint, "messages": client.get_history()}
+
+
 # ============ Gemini 原生 API ============
 
 class GeminiGenerateContentRequest(BaseModel):
@@ -1312,50 +1980,178 @@ class GeminiGenerateContentRequest(BaseModel):
     tools: Optional[List[Dict[str, Any]]] = None
     systemInstruction: Optional[Dict[str, Any]] = None
     safetySettings: Optional[List[Dict[str, Any]]] = None
+    cachedContent: Optional[str] = None  # 引用的上下文缓存（cachedContents/xxx）
+
+
+class GeminiCountTokensRequest(BaseModel):
+    model_config = ConfigDict(extra="ignore")
+    contents: List[Dict[str, Any]] = []
+    generateContentRequest: Optional[GeminiGenerateContentRequest] = None
+
+
+def gemini_contents_to_messages(contents: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Gemini 格式的 contents 转换为 OpenAI 格式的 messages（model 角色转成 assistant，inlineData 转成 data URL 图片）"""
+    messages = []
+    for content in contents:
+        role = content.get("role", "user")
+        parts = content.get("parts", [])
+        
+        message_content = []
+        for part in parts:
+            if "text" in part:
+                message_content.append({"type": "text", "text": part["text"]})
+            elif "inlineData" in part:
+                inline_data = part["inlineData"]
+                message_content.append({
+                    "type": "image_url",
+                    "image_url": {
+                        "url": f"data:{inline_data.get('mimeType', 'image/jpeg')};base64,{inline_data.get('data', '')}"
+                    }
+                })
+        
+        if len(message_content) == 1 and message_content[0].get("type") == "text":
+            messages.append({
+                "role": "user" if role == "user" else "assistant",
+                "content": message_content[0]["text"]
+            })
+        else:
+            messages.append({
+                "role": "user" if role == "user" else "assistant",
+                "content": message_content
+            })
+    return messages
+
+
+def system_instruction_text(system_instruction: Optional[Dict[str, Any]]) -> Optional[str]:
+    """Gemini systemInstruction 中的文本，没有时返回 None"""
+    if not system_instruction:
+        return None
+    return "\n".join(p["text"] for p in system_instruction.get("parts", []) if p.get("text")) or None
+
+
+def count_gemini_prompt(contents: List[Dict[str, Any]], system_instruction: Optional[Dict[str, Any]] = None) -> int:
+    """估算 Gemini 格式输入的 token 数（与 generateContent 的 promptTokenCount 一致）"""
+    total = tokens.count_messages({"content": content.get("parts")} for content in contents)
+    if system_instruction:
+        total += tokens.count_content(system_instruction.get("parts"))
+    return total
+
+
+def cached_gemini_response(cached: Dict[str, Any], is_stream: bool, headers: Dict[str, str]):
+    """用缓存的回复构造 Gemini 原生格式响应（流式时直接从内存输出）"""
+    reply_content = cached["text"]
+    
+    if is_stream:
+        def generate_cached_stream():
+            encoder = GeminiChunkEncoder()
+            yield encoder.START
+            for text in iter_cached_chunks(reply_content):
+                yield encoder.text(text)
+            yield encoder.finish(cached.get("usage"))
+            yield DONE
+        
+        return StreamingResponse(
+            generate_cached_stream(),
+            media_type="text/event-stream",
+            headers={
+                "Cache-Control": "no-cache",
+                "Connection": "keep-alive",
+                **headers,
+            }
+        )
+    
+    usage = cached.get("usage", {})
+    return FastJSONResponse(headers=headers, content={
+        "candidates": [{
+            "content": {
+                "parts": [{"text": reply_content}]
+            },
+            "finishReason": "STOP"
+        }],
+        "usageMetadata": {
+            "promptTokenCount": usage.get("prompt_tokens", 0),
+            "candidatesTokenCount": usage.get("completion_tokens", 0),
+            "totalTokenCount": usage.get("total_tokens", 0)
+        }
+    })
+
+
+def gemini_flight_stream(
+    flight: Flight,
+    raw_request: Request,
+    authorization: str,
+    headers: Dict[str, str],
+    background: Optional[BackgroundTask] = None,
+):
+    """订阅 flight 的 Gemini 原生格式流式响应"""
+    encoder = GeminiChunkEncoder()
+    
+    async def generate_stream():
+        streamed_chars = 0
+        deltas = heartbeat(coalesce(flight.subscribe(), SSE_FLUSH_WINDOW_MS / 1000), SSE_HEARTBEAT_INTERVAL)
+        try:
+            # 立即发送初始块（生成任务在此之后才开始上传和请求上游）
+            yield encoder.START
+            
+            # 流式输出，每个 chunk 已经是增量内容（在 client.py 中已处理）
+            async for chunk in deltas:
+                if await raw_request.is_disconnected():
+                    return
+                if chunk is None:
+                    yield PING
+                    continue
+                streamed_chars += len(chunk)
+                yield encoder.text(chunk)
+            
+            # 发送结束块
+            yield encoder.finish(flight.usage)
+            yield DONE
+        except FlightCancelled:
+            return
+        except Exception as e:
+            detail = e.detail if isinstance(e, HTTPException) else str(e)
+            yield encoder.error(detail)
+        finally:
+            await deltas.aclose()
+            charge_output_chars(authorization, streamed_chars)
+    
+    return StreamingResponse(
+        generate_stream(),
+        media_type="text/event-stream",
+        headers={
+            "Cache-Control": "no-cache",
+            "Connection": "keep-alive",
+            **headers,
+        },
+        background=background,
+    )
 
 
 @app.post("/v1beta/models/{model_name}:generateContent")
 async def gemini_generate_content(
     model_name: str,
     request: GeminiGenerateContentRequest,
+    raw_request: Request,
     authorization: str = Header(None),
-    alt: Optional[str] = None
+    alt: Optional[str] = None,
+    x_priority: Optional[str] = Header(None),
+    cache_control: Optional[str] = Header(None),
 ):
     """Gemini 原生 API - 生成内容"""
     verify_api_key(authorization)
     
+    rate_headers = check_rate_limit(
+        authorization,
+        sum(len(part.get("text", "")) for content in request.contents for part in content.get("parts", [])),
+    )
+    
+    slot = None
+    flight = None
+    stream_owns_slot = False
     try:
-        client = get_client()
-        
-        # 转换 Gemini 格式到 OpenAI 格式
-        messages = []
-        for content in request.contents:
-            role = content.get("role", "user")
-            parts = content.get("parts", [])
-            
-            message_content = []
-            for part in parts:
-                if "text" in part:
-                    message_content.append({"type": "text", "text": part["text"]})
-                elif "inlineData" in part:
-                    inline_data = part["inlineData"]
-                    message_content.append({
-                        "type": "image_url",
-                        "image_url": {
-                            "url": f"data:{inline_data.get('mimeType', 'image/jpeg')};base64,{inline_data.get('data', '')}"
-                        }
-                    })
-            
-            if len(message_content) == 1 and message_content[0].get("type") == "text":
-                messages.append({
-                    "role": "user" if role == "user" else "model",
-                    "content": message_content[0]["text"]
-                })
-            else:
-                messages.append({
-                    "role": "user" if role == "user" else "model",
-                    "content": message_content
-                })
+        # 转换 Gemini 格式到 OpenAI 格式（systemInstruction 在会话中只发送一次，内容变化时才重新发送）
+        messages = gemini_contents_to_messages(request.contents)
+        system = system_instruction_text(request.systemInstruction)
         
         # 检查是否启用 URL 上下文
         url_context = False
@@ -1368,81 +2164,714 @@ async def gemini_generate_content(
         # 检查是否流式
         is_stream = alt == "sse" or (request.generationConfig and request.generationConfig.get("stream", False))
         
+        prompt_tokens = count_gemini_prompt(request.contents, request.systemInstruction)
+        
+        # 引用上下文缓存时从缓存的会话快照分叉，缓存的前缀计入输入 token
+        cached_content = get_cached_content(request.cachedContent, model_name) if request.cachedContent else None
+        cached_tokens = cached_content["total_tokens"] if cached_content else 0
+        prompt_tokens += cached_tokens
+        
+        # 无状态单轮请求先查响应缓存，命中时不占用账号槽位、不请求上游
+        generation_config = {k: v for k, v in (request.generationConfig or {}).items() if k != "stream"}
+        request_key = stateless_request_key(
+            model_name.replace("models/", ""),
+            messages,
+            tools=request.tools,
+            generationConfig=generation_config or None,
+            systemInstruction=request.systemInstruction,
+            cachedContent=cached_content["name"] if cached_content else None,
+        )
+        cache_key = response_cache_key(cache_control, request_key)
+        if cache_key:
+            cached = get_response_cache().get(cache_key)
+            if cached is not None:
+                return cached_gemini_response(cached, is_stream, {**rate_headers, "X-Cache": "HIT"})
+            rate_headers = {**rate_headers, "X-Cache": "MISS"}
+        
+        # 相同请求正在生成时直接订阅它的结果
+        inflight = join_inflight(request_key)
+        if inflight is not None:
+            headers = {**rate_headers, "X-Coalesced": "1"}
+            if is_stream:
+                return gemini_flight_stream(inflight, raw_request, authorization, headers)
+            response_content = await inflight.result()
+            charge_output_chars(authorization, len(response_content))
+            return cached_gemini_response({"text": response_content, "usage": inflight.usage or {}}, False, headers)
+        
+        flight = start_flight(request_key)
+        client = get_client()
+        slot = await acquire_account_slot(authorization, x_priority, model_name)
+        share_turn = False
+        if cached_content is not None:
+            client, slot = await fork_client(slot, tuple(cached_content["checkpoint"]))
+            context = dialog_messages(messages)[:-1]
+        elif request_key is not None:
+            # 回复会写入缓存或分给合并进来的请求，必须在新对话中生成；本轮记入主会话的快照，下一轮可以接着继续
+            client, slot = await fresh_client(slot)
+            context = []
+            share_turn = True
+        else:
+            # 与 OpenAI 格式相同：按 contents 中的历史匹配会话快照，只发送快照之后的消息，本轮记入快照
+            context = route_conversation(client, messages)
+        last_user = dialog_messages(messages)[-1:]
+        if not last_user:
+            raise HTTPException(status_code=400, detail="contents 中没有用户消息")
+        
         if is_stream:
-            # 流式响应
-            async def generate_stream():
-                try:
-                    stream_gen = client._send_stream_request(
-                        text=messages[-1]["content"] if isinstance(messages[-1]["content"], str) else "",
-                        images=None,
-                        model=model_name.replace("models/", ""),
-                        url_context=url_context,
-                        tools=request.tools
-                    )
-                    
-                    # 发送初始块
-                    yield f"data: {json.dumps({'candidates': [{'content': {'parts': []}}]})}\n\n"
-                    
-                    # 流式输出，每个 chunk 已经是增量内容（在 client.py 中已处理）
-                    for chunk in stream_gen:
-                        if chunk:  # 只发送非空块
-                            yield f"data: {json.dumps({'candidates': [{'content': {'parts': [{'text': chunk}]}}]})}\n\n"
-                    
-                    # 发送结束块
-                    yield f"data: {json.dumps({'candidates': [{'finishReason': 'STOP'}]})}\n\n"
-                    yield "data: [DONE]\n\n"
-                except Exception as e:
-                    yield f"data: {json.dumps({'error': str(e)})}\n\n"
-            
-            return StreamingResponse(
-                generate_stream(),
-                media_type="text/event-stream",
-                headers={
-                    "Cache-Control": "no-cache",
-                    "Connection": "keep-alive",
-                }
+            # 流式响应：生成任务把上游增量发布到 flight，本请求和合并进来的请求都订阅它
+            start_stream_producer(
+                flight,
+                client,
+                slot,
+                last_user[0]["content"],
+                model=model_name.replace("models/", ""),
+                url_context=url_context,
+                tools=request.tools,
+                cache_key=cache_key,
+                prompt_tokens=prompt_tokens,
+                cached_tokens=cached_tokens,
+                system=system,
+                context=context,
+                share_turn=share_turn,
+            )
+            stream_owns_slot = True
+            return gemini_flight_stream(
+                flight,
+                raw_request,
+                authorization,
+                rate_headers,
+                background=BackgroundTask(abandon_unstarted_flight, flight, slot),
             )
         else:
             # 非流式响应
-            response = client.chat(
-                messages=messages,
+            response = await run_in_threadpool(
+                client.chat,
+                messages=([{"role": "system", "content": system}] if system else []) + last_user,
                 model=model_name.replace("models/", ""),
                 url_context=url_context,
-                tools=request.tools
+                tools=request.tools,
+                context=context,
             )
             
             # 获取响应内容
             response_content = response.choices[0].message.content
+            if share_turn:
+                share_first_turn(client)
+            charge_output_chars(authorization, len(response_content))
+            usage = tokens.usage(prompt_tokens, response_content, cached_tokens)
+            if cache_key:
+                get_response_cache().put(cache_key, {"text": response_content, "usage": usage})
+            flight.publish(response_content)
+            flight.finish(usage=usage)
             parts = [{"text": response_content}]
             
             # 转换回 Gemini 格式
-            return {
+            return FastJSONResponse(headers=rate_headers, content={
                 "candidates": [{
                     "content": {
                         "parts": parts
                     },
                     "finishReason": "STOP"
                 }],
-                "usageMetadata": {
-                    "promptTokenCount": response.usage.prompt_tokens,
-                    "candidatesTokenCount": response.usage.completion_tokens,
-                    "totalTokenCount": response.usage.total_tokens
-                }
-            }
+                "usageMetadata": usage_metadata(usage)
+            })
+    except HTTPException as e:
+        if flight is not None:
+            flight.finish(error=e)
+        raise
     except Exception as e:
+        if flight is not None:
+            flight.finish(error=e)
         raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        if slot is not None and not stream_owns_slot:
+            slot.release()
 
 
 @app.post("/v1beta/models/{model_name}:streamGenerateContent")
 async def gemini_stream_generate_content(
     model_name: str,
     request: GeminiGenerateContentRequest,
+    raw_request: Request,
     authorization: str = Header(None),
-    alt: Optional[str] = None
+    alt: Optional[str] = None,
+    x_priority: Optional[str] = Header(None),
+    cache_control: Optional[str] = Header(None),
 ):
     """Gemini 原生 API - 流式生成内容"""
     # 强制设置 alt=sse
-    return await gemini_generate_content(model_name, request, authorization, alt="sse")
+    return await gemini_generate_content(
+        model_name, request, raw_request, authorization,
+        alt="sse", x_priority=x_priority, cache_control=cache_control,
+    )
+
+
+@app.post("/v1beta/models/{model_name}:countTokens")
+async def gemini_count_tokens(
+    model_name: str,
+    request: GeminiCountTokensRequest,
+    authorization: str = Header(None),
+):
+    """Gemini 原生 API - 计算 token 数（本地估算，不请求上游，图片按每张固定 token 计）"""
+    verify_api_key(authorization)
+    if request.generateContentRequest is not None:
+        inner = request.generateContentRequest
+        total = count_gemini_prompt(inner.contents, inner.systemInstruction)
+    else:
+        total = count_gemini_prompt(request.contents)
+    return {"totalTokens": total}
+
+
+# ============ 上下文缓存 ============
+
+_cached_contents: Optional[CachedContentStore] = None
+
+# 预热时附在缓存内容之后的指令，让这一轮的回复尽量短
+CONTEXT_ACK_PROMPT = "以上是之后对话要用到的上下文，请记住这些内容，不需要总结。现在只回复“OK”。"
+
+
+class GeminiCachedContentRequest(BaseModel):
+    model_config = ConfigDict(extra="ignore")
+    model: str
+    contents: List[Dict[str, Any]] = []
+    systemInstruction: Optional[Dict[str, Any]] = None
+    displayName: str = ""
+    ttl: Optional[str] = None
+    expireTime: Optional[str] = None
+
+
+class GeminiCachedContentUpdate(BaseModel):
+    model_config = ConfigDict(extra="ignore")
+    ttl: Optional[str] = None
+    expireTime: Optional[str] = None
+
+
+def get_cached_contents() -> CachedContentStore:
+    global _cached_contents
+    if _cached_contents is None:
+        _cached_contents = CachedContentStore(CACHED_CONTENTS_FILE)
+    return _cached_contents
+
+
+def get_cached_content(name: str, model_name: Optional[str] = None) -> Dict[str, Any]:
+    """查找上下文缓存，不存在或已过期返回 404，模型不一致返回 400"""
+    entry = get_cached_contents().get(name)
+    if entry is None:
+        raise HTTPException(status_code=404, detail=f"上下文缓存不存在或已过期: {name}")
+    if model_name and entry["model"] != model_name.replace("models/", ""):
+        raise HTTPException(status_code=400, detail=f"上下文缓存 {entry['name']} 属于模型 {entry['model']}，与请求的模型不一致")
+    return entry
+
+
+def requested_expiry(ttl: Optional[str], expire_time: Optional[str]) -> Optional[float]:
+    """请求中 ttl / expireTime 对应的过期时间戳，都没有时返回 None"""
+    try:
+        if expire_time:
+            return parse_timestamp(expire_time)
+        seconds = parse_ttl(ttl)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return time.time() + seconds if seconds else None
+
+
+def build_context_prompt(contents: List[Dict[str, Any]], system_instruction: Optional[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """把系统指令和缓存内容合成一条用户消息（OpenAI 内容列表格式，图片保持原样）"""
+    parts = []
+    instruction = system_instruction_text(system_instruction)
+    if instruction:
+        parts.append({"type": "text", "text": f"【系统指令】\n{instruction}\n"})
+    for message in gemini_contents_to_messages(contents):
+        content = message["content"]
+        if isinstance(content, str):
+            content = [{"type": "text", "text": content}]
+        if message["role"] != "user":
+            parts.append({"type": "text", "text": "【模型】"})
+        parts.extend(content)
+    parts.append({"type": "text", "text": f"\n{CONTEXT_ACK_PROMPT}"})
+    return parts
+
+
+def warm_context(client, prompt: List[Dict[str, Any]], model: str) -> tuple:
+    """在新对话中发送缓存内容，返回这一轮之后的会话快照"""
+    client.reset()
+    client.chat(messages=[{"role": "user", "content": prompt}], model=model)
+    return client.checkpoint()
+
+
+@app.post("/v1beta/cachedContents")
+async def create_cached_content(
+    request: GeminiCachedContentRequest,
+    authorization: str = Header(None),
+    x_priority: Optional[str] = Header(None),
+):
+    """
+    Gemini 原生 API - 创建上下文缓存
+
+    缓存内容（systemInstruction + contents）作为一轮对话发给 Gemini 预热，之后在 generateContent 中
+    通过 "cachedContent": "cachedContents/xxx" 引用，只发送新的消息。内容完全相同的缓存直接复用已有快照。
+    """
+    verify_api_key(authorization)
+    if not request.contents and not request.systemInstruction:
+        raise HTTPException(status_code=400, detail="contents 和 systemInstruction 不能都为空")
+    model = request.model.replace("models/", "")
+    expire_time = requested_expiry(request.ttl, request.expireTime) or time.time() + CACHED_CONTENT_TTL
+    store = get_cached_contents()
+    
+    fingerprint = content_hash(model, request.contents, request.systemInstruction)
+    existing = store.find(fingerprint)
+    if existing is not None:
+        metrics.inc("gemini_cached_content_reused_total")
+        if expire_time > existing["expire_time"]:
+            existing = store.update_expiry(existing["name"], expire_time) or existing
+        return to_resource(existing)
+    
+    prompt = build_context_prompt(request.contents, request.systemInstruction)
+    check_rate_limit(authorization, count_content_chars(prompt))
+    slot = await acquire_account_slot(authorization, x_priority, model)
+    client = None
+    try:
+        client = await checkout_client()
+        checkpoint = await run_in_threadpool(warm_context, client, prompt, model)
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=502, detail=f"预热上下文失败: {e}")
+    finally:
+        if client is not None:
+            checkin_client(client)
+        slot.release()
+    if not checkpoint[0]:
+        raise HTTPException(status_code=502, detail="预热上下文失败: 未获取到会话 ID")
+    
+    entry = store.create(
+        model,
+        checkpoint,
+        total_tokens=count_gemini_prompt(request.contents, request.systemInstruction),
+        ttl=expire_time - time.time(),
+        display_name=request.displayName,
+        fingerprint=fingerprint,
+    )
+    print(f"[INFO] 已创建上下文缓存 {entry['name']}（约 {entry['total_tokens']} token）")
+    return to_resource(entry)
+
+
+@app.get("/v1beta/cachedContents")
+async def list_cached_contents(authorization: str = Header(None)):
+    verify_api_key(authorization)
+    return {"cachedContents": [to_resource(entry) for entry in get_cached_contents().list()]}
+
+
+@app.get("/v1beta/cachedContents/{cache_id}")
+async def get_cached_content_resource(cache_id: str, authorization: str = Header(None)):
+    verify_api_key(authorization)
+    return to_resource(get_cached_content(cache_id))
+
+
+@app.patch("/v1beta/cachedContents/{cache_id}")
+async def update_cached_content(cache_id: str, request: GeminiCachedContentUpdate, authorization: str = Header(None)):
+    """只能更新有效期（ttl 或 expireTime），与官方 API 一致"""
+    verify_api_key(authorization)
+    entry = get_cached_content(cache_id)
+    expire_time = requested_expiry(request.ttl, request.expireTime)
+    if expire_time is None:
+        raise HTTPException(status_code=400, detail="需要提供 ttl 或 expireTime")
+    return to_resource(get_cached_contents().update_expiry(entry["name"], expire_time) or entry)
+
+
+@app.delete("/v1beta/cachedContents/{cache_id}")
+async def delete_cached_content(cache_id: str, authorization: str = Header(None)):
+    verify_api_key(authorization)
+    entry = get_cached_content(cache_id)
+    get_cached_contents().delete(entry["name"])
+    return {}
+
+
+# ============ 批处理 ============
+
+_batch_engine: Optional[BatchEngine] = None
+
+
+def get_batch_engine() -> BatchEngine:
+    global _batch_engine
+    if _batch_engine is None:
+        _batch_engine = BatchEngine(
+            BatchStore(BATCH_DB),
+            execute_batch_item,
+            concurrency=BATCH_CONCURRENCY,
+            max_retries=BATCH_MAX_RETRIES,
+        )
+    return _batch_engine
+
+
+@app.on_event("startup")
+async def resume_batches():
+    """继续执行重启前未完成的批处理任务"""
+    if os.path.exists(BATCH_DB):
+        get_batch_engine().resume()
+
+
+def run_batch_chat(client, messages: List[Dict[str, Any]], model: str, tools):
+    """每条批处理请求都新开一个对话，最后一条用户消息之前的轮次随本轮补发"""
+    client.reset()
+    dialog = dialog_messages(messages)
+    system = [m for m in messages if m.get("role") == "system"]
+    return client.chat(
+        messages=system + dialog[-1:],
+        model=model,
+        url_context=has_url_context(tools),
+        tools=tools,
+        context=dialog[:-1],
+    )
+
+
+def has_url_context(tools) -> bool:
+    return any("urlContext" in tool for tool in tools or [])
+
+
+async def execute_batch_item(kind: str, model: str, request: Dict[str, Any], api_key: str = "") -> Dict[str, Any]:
+    """
+    执行批处理中的一条请求，返回响应体
+
+    kind 为 openai 时 request 是 chat.completions 请求体，为 gemini 时是 generateContent 请求体。
+    按 batch 优先级排队获取账号槽位，交互请求优先；按提交者的 API Key 排队和限流（超限时抛出 429，由批处理重试）。
+    """
+    if kind == "openai":
+        model = request.get("model") or model
+        messages = request.get("messages")
+        tools = request.get("tools")
+    else:
+        messages = gemini_contents_to_messages(request.get("contents") or [])
+        system = system_instruction_text(request.get("systemInstruction"))
+        if system:
+            messages.insert(0, {"role": "system", "content": system})
+        tools = request.get("tools")
+    if not isinstance(messages, list) or not any(m.get("role") == "user" for m in messages if isinstance(m, dict)):
+        raise BatchItemError("请求中没有用户消息")
+    
+    authorization = f"Bearer {api_key}" if api_key else None
+    check_rate_limit(authorization, sum(count_content_chars(m.get("content")) for m in messages if isinstance(m, dict)))
+    slot = await acquire_account_slot(authorization, x_priority="batch", model=model)
+    client = None
+    try:
+        client = await checkout_client()
+        response = await run_in_threadpool(run_batch_chat, client, messages, model, tools)
+    finally:
+        if client is not None:
+            checkin_client(client)
+        slot.release()
+    
+    reply_content = response.choices[0].message.content
+    charge_output_chars(authorization, len(reply_content))
+    if kind == "openai":
+        usage = tokens.usage(tokens.count_messages(messages), reply_content)
+        return ChatCompletionResponse(
+            id=f"chatcmpl-{uuid.uuid4().hex[:8]}",
+            created=int(time.time()),
+            model=model,
+            choices=[ChatCompletionChoice(index=0, message={"role": "assistant", "content": reply_content}, finish_reason="stop")],
+            usage=Usage(**usage),
+        ).model_dump()
+    usage = tokens.usage(count_gemini_prompt(request.get("contents") or [], request.get("systemInstruction")), reply_content)
+    return {
+        "candidates": [{"content": {"parts": [{"text": reply_content}], "role": "model"}, "finishReason": "STOP"}],
+        "usageMetadata": {
+            "promptTokenCount": usage["prompt_tokens"],
+            "candidatesTokenCount": usage["completion_tokens"],
+            "totalTokenCount": usage["total_tokens"],
+        },
+    }
+
+
+def openai_batch_object(batch: Dict[str, Any]) -> Dict[str, Any]:
+    """OpenAI Batch 对象"""
+    counts = batch["counts"]
+    status = batch["status"]
+    completed_at = int(batch["completed_at"]) if batch["completed_at"] else None
+    return {
+        "id": batch["id"],
+        "object": "batch",
+        "endpoint": batch["endpoint"],
+        "errors": None,
+        "input_file_id": None,
+        "completion_window": "24h",
+        "status": status,
+        "output_file_id": f"file-{batch['id']}",
+        "error_file_id": None,
+        "created_at": int(batch["created_at"]),
+        "in_progress_at": int(batch["created_at"]),
+        "completed_at": completed_at if status == "completed" else None,
+        "failed_at": completed_at if status == "failed" else None,
+        "cancelled_at": completed_at if status == "cancelled" else None,
+        "request_counts": {
+            "total": sum(counts.values()),
+            "completed": counts.get("succeeded", 0),
+            "failed": counts.get("failed", 0),
+        },
+        "metadata": batch["metadata"] or None,
+    }
+
+
+def batch_result_line(kind: str, result: Dict[str, Any]) -> Dict[str, Any]:
+    """一条结果（OpenAI 批处理输出格式 / Gemini inlinedResponses 格式）"""
+    if kind == "openai":
+        error = None
+        response = None
+        if result["status"] == "succeeded":
+            response = {"status_code": 200, "request_id": f"req_{result['index']}", "body": result["response"]}
+        else:
+            error = {"code": str(result["status_code"] or result["status"]), "message": result["error"] or result["status"]}
+        return {"id": f"batch_req_{result['index']}", "custom_id": result["custom_id"], "response": response, "error": error}
+    line = {"metadata": {"key": result["custom_id"]}}
+    if result["status"] == "succeeded":
+        line["response"] = result["response"]
+    else:
+        line["error"] = {"code": result["status_code"] or 500, "message": result["error"] or result["status"]}
+    return line
+
+
+def iter_batch_results(batch: Dict[str, Any]):
+    for result in get_batch_engine().results(batch["id"]):
+        yield jsoncodec.dumps_bytes(batch_result_line(batch["kind"], result)) + b"\n"
+
+
+def get_batch_or_404(batch_id: str) -> Dict[str, Any]:
+    batch = get_batch_engine().get(batch_id.replace("batches/", ""))
+    if batch is None:
+        raise HTTPException(status_code=404, detail="批处理任务不存在")
+    return batch
+
+
+@app.post("/v1/batches")
+async def create_batch(raw_request: Request, authorization: str = Header(None)):
+    """
+    创建 OpenAI 格式的批处理任务
+
+    请求体可以是:
+      - JSON: {"endpoint": "/v1/chat/completions", "input": "<JSONL 文本>" 或 "requests": [...], "metadata": {...}}
+      - 直接提交 JSONL 文本（每行 {"custom_id", "method", "url", "body"}）
+    """
+    verify_api_key(authorization)
+    raw = (await raw_request.body()).decode("utf-8")
+    options: Dict[str, Any] = {}
+    try:
+        try:
+            parsed = jsoncodec.loads(raw)
+        except jsoncodec.JSONDecodeError:
+            parsed = None
+        # 整个请求体是一个 JSON 对象且不是请求行时，按任务参数处理；否则按 JSONL 处理
+        if isinstance(parsed, dict) and "body" not in parsed:
+            options = parsed
+            lines = options.get("requests")
+            if lines is None:
+                if "input" not in options:
+                    raise ValueError("不支持 input_file_id（没有 /v1/files 上传），请在 input 字段中直接提交 JSONL 内容")
+                lines = parse_jsonl(options["input"] or "")
+        else:
+            lines = parse_jsonl(raw)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    endpoint = options.get("endpoint") or "/v1/chat/completions"
+    if endpoint != "/v1/chat/completions":
+        raise HTTPException(status_code=400, detail="批处理只支持 /v1/chat/completions")
+    if not lines:
+        raise HTTPException(status_code=400, detail="批处理请求为空")
+    if len(lines) > BATCH_MAX_REQUESTS:
+        raise HTTPException(status_code=400, detail=f"单个批次最多 {BATCH_MAX_REQUESTS} 条请求")
+    
+    items = []
+    for i, line in enumerate(lines):
+        body = line.get("body") if isinstance(line, dict) else None
+        if not isinstance(body, dict) or not body.get("messages"):
+            raise HTTPException(status_code=400, detail=f"第 {i + 1} 条请求缺少 body.messages")
+        if line.get("url", endpoint) != endpoint:
+            raise HTTPException(status_code=400, detail=f"第 {i + 1} 条请求的 url 与 endpoint 不一致")
+        items.append((str(line.get("custom_id") or f"request-{i + 1}"), body))
+    
+    model = items[0][1].get("model") or DEFAULT_MODELS[0]
+    batch = get_batch_engine().submit(
+        "openai", endpoint, model, items, options.get("metadata"), api_key=get_bearer_key(authorization)
+    )
+    return openai_batch_object(batch)
+
+
+@app.get("/v1/batches")
+async def list_batches(limit: int = 20, authorization: str = Header(None)):
+    verify_api_key(authorization)
+    batches = [openai_batch_object(b) for b in get_batch_engine().list(limit) if b["kind"] == "openai"]
+    return {"object": "list", "data": batches, "has_more": False}
+
+
+@app.get("/v1/batches/{batch_id}")
+async def retrieve_batch(batch_id: str, authorization: str = Header(None)):
+    verify_api_key(authorization)
+    return openai_batch_object(get_batch_or_404(batch_id))
+
+
+@app.post("/v1/batches/{batch_id}/cancel")
+async def cancel_batch(batch_id: str, authorization: str = Header(None)):
+    verify_api_key(authorization)
+    get_batch_or_404(batch_id)
+    return openai_batch_object(get_batch_engine().cancel(batch_id))
+
+
+@app.get("/v1/batches/{batch_id}/results")
+async def download_batch_results(batch_id: str, authorization: str = Header(None)):
+    """按 JSONL 下载已完成条目的结果（任务进行中也可以下载已完成的部分）"""
+    verify_api_key(authorization)
+    batch = get_batch_or_404(batch_id)
+    return StreamingResponse(iter_batch_results(batch), media_type="application/jsonl")
+
+
+@app.get("/v1/files/{file_id}/content")
+async def download_file_content(file_id: str, authorization: str = Header(None)):
+    """批处理的 output_file_id（file-<批次 ID>）对应的结果 JSONL"""
+    verify_api_key(authorization)
+    if not file_id.startswith("file-batch_"):
+        raise HTTPException(status_code=404, detail="文件不存在")
+    batch = get_batch_or_404(file_id[len("file-"):])
+    return StreamingResponse(iter_batch_results(batch), media_type="application/jsonl")
+
+
+GEMINI_BATCH_STATES = {
+    "in_progress": "BATCH_STATE_RUNNING",
+    "cancelling": "BATCH_STATE_RUNNING",
+    "completed": "BATCH_STATE_SUCCEEDED",
+    "failed": "BATCH_STATE_FAILED",
+    "cancelled": "BATCH_STATE_CANCELLED",
+}
+
+
+def gemini_batch_operation(batch: Dict[str, Any]) -> Dict[str, Any]:
+    """Gemini 批处理的 Operation 对象，结束后在 response 中内联全部结果"""
+    counts = batch["counts"]
+    total = sum(counts.values())
+    done = batch["status"] in FINAL_STATUSES
+    operation = {
+        "name": f"batches/{batch['id']}",
+        "metadata": {
+            "@type": "type.googleapis.com/google.ai.generativelanguage.v1beta.GenerateContentBatch",
+            "name": f"batches/{batch['id']}",
+            "displayName": batch["metadata"].get("displayName", ""),
+            "model": f"models/{batch['model']}",
+            "state": GEMINI_BATCH_STATES.get(batch["status"], "BATCH_STATE_PENDING"),
+            "createTime": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(batch["created_at"])),
+            "batchStats": {
+                "requestCount": str(total),
+                "successfulRequestCount": str(counts.get("succeeded", 0)),
+                "failedRequestCount": str(counts.get("failed", 0)),
+                "pendingRequestCount": str(counts.get("pending", 0) + counts.get("running", 0)),
+            },
+        },
+        "done": done,
+    }
+    if done:
+        operation["response"] = {
+            "@type": "type.googleapis.com/google.ai.generativelanguage.v1beta.GenerateContentBatchOutput",
+            "inlinedResponses": {
+                "inlinedResponses": [
+                    batch_result_line("gemini", result) for result in get_batch_engine().results(batch["id"])
+                ],
+            },
+        }
+    return operation
+
+
+@app.post("/v1beta/models/{model_name}:batchGenerateContent")
+async def gemini_batch_generate_content(model_name: str, raw_request: Request, authorization: str = Header(None)):
+    """
+    Gemini 原生 API - 创建批处理任务
+
+    请求体: {"batch": {"displayName": "...", "inputConfig": {"requests": {"requests": [{"request": {...}, "metadata": {"key": "..."}}]}}}}
+    """
+    verify_api_key(authorization)
+    try:
+        body = jsoncodec.loads(await raw_request.body())
+    except jsoncodec.JSONDecodeError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    spec = body.get("batch") or {}
+    input_config = spec.get("inputConfig") or spec.get("input_config") or {}
+    requests_field = input_config.get("requests") or {}
+    entries = requests_field.get("requests") if isinstance(requests_field, dict) else requests_field
+    if not entries:
+        raise HTTPException(status_code=400, detail="只支持内联请求: batch.inputConfig.requests.requests")
+    if len(entries) > BATCH_MAX_REQUESTS:
+        raise HTTPException(status_code=400, detail=f"单个批次最多 {BATCH_MAX_REQUESTS} 条请求")
+    
+    items = []
+    for i, entry in enumerate(entries):
+        request = entry.get("request") if isinstance(entry, dict) else None
+        if not isinstance(request, dict) or not request.get("contents"):
+            raise HTTPException(status_code=400, detail=f"第 {i + 1} 条请求缺少 request.contents")
+        key = (entry.get("metadata") or {}).get("key") or f"request-{i + 1}"
+        items.append((str(key), request))
+    
+    display_name = spec.get("displayName") or spec.get("display_name") or ""
+    model = model_name.replace("models/", "")
+    batch = get_batch_engine().submit(
+        "gemini", f"/v1beta/models/{model}:generateContent", model, items, {"displayName": display_name},
+        api_key=get_bearer_key(authorization),
+    )
+    return gemini_batch_operation(batch)
+
+
+@app.get("/v1beta/batches")
+async def gemini_list_batches(pageSize: int = 20, authorization: str = Header(None)):
+    verify_api_key(authorization)
+    return {"operations": [gemini_batch_operation(b) for b in get_batch_engine().list(pageSize) if b["kind"] == "gemini"]}
+
+
+@app.get("/v1beta/batches/{batch_id}")
+async def gemini_get_batch(batch_id: str, authorization: str = Header(None)):
+    verify_api_key(authorization)
+    return gemini_batch_operation(get_batch_or_404(batch_id))
+
+
+@app.post("/v1beta/batches/{batch_id}:cancel")
+async def gemini_cancel_batch(batch_id: str, authorization: str = Header(None)):
+    verify_api_key(authorization)
+    get_batch_or_404(batch_id)
+    get_batch_engine().cancel(batch_id)
+    return {}
+
+
+@app.get("/metrics")
+async def get_metrics(authorization: str = Header(None)):
+    """运行时指标（Prometheus 文本格式）：账号排队深度、等待时间等"""
+    verify_api_key(authorization)
+    return PlainTextResponse(metrics.render_prometheus())
+
+
+@app.post("/admin/models/reload")
+async def admin_reload_models(request: Request):
+    """重新加载 configs/models.json"""
+    if not verify_admin_session(request):
+        raise HTTPException(status_code=401, detail="未登录")
+    try:
+        count = _model_catalog.reload()
+    except Exception as e:
+        return {"success": False, "message": f"重新加载失败: {e}"}
+    return {"success": True, "message": f"已重新加载 {count} 个模型"}
+
+
+@app.get("/admin/metrics")
+async def admin_get_metrics(request: Request):
+    """运行时指标（JSON），用于后台查看账号池容量"""
+    if not verify_admin_session(request):
+        raise HTTPException(status_code=401, detail="未登录")
+    return {
+        "accounts": [limiter.snapshot() for limiter in _account_limiters.values()],
+        "models": [limiter.snapshot() for limiter in _model_limiters.values()],
+        # 各优先级类别的排队等待时间
+        "scheduler": {
+            name: {
+                "p50": metrics.quantile("gemini_scheduler_wait_seconds", 0.5, priority=name),
+                "p99": metrics.quantile("gemini_scheduler_wait_seconds", 0.99, priority=name),
+            }
+            for name in PRIORITY_CLASSES
+        },
+        "metrics": metrics.snapshot(),
+    }
 
 
 @app.get("/admin/server-info")
@@ -1450,6 +2879,7 @@ async def get_server_info(request: Request):
     """获取服务器信息"""
     if not verify_admin_session(request):
         raise HTTPException(status_code=401, detail="未登录")
+    import httpx
     import socket
     import subprocess
     
@@ -1506,11 +2936,10 @@ async def get_server_info(request: Request):
     return {"server_ip": server_ip, "port": PORT}
 
 
-load_config()
-
 if __name__ == "__main__":
     import socket
     import subprocess
+    import uvicorn
     
     # 获取本机 IP 地址（改进版）
     def get_local_ip():
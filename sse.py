@@ -0,0 +1,251 @@
+"""
+SSE 输出
+
+流式响应的每个块只有增量文本在变化（id / created / model 等在整个响应内不变），
+所以每个响应预先把块序列化成 "前缀 + 增量 + 后缀" 模板，之后每个增量只需转义文本本身。
+
+coalesce() 把短时间内连续到达的小增量合并成一块输出，减少写入次数和 SSE 帧开销。
+heartbeat() 在长时间没有增量时（上传图片、思考模型出字前）提示调用方输出 SSE 注释，避免代理按空闲超时断开。
+split_chunks() / pace() 用于把已经完整的回复（假流式、缓存命中）切块输出。
+"""
+
+import asyncio
+import re
+from typing import Any, AsyncIterator, Dict, Iterable, Iterator, Optional
+
+import jsoncodec
+
+DONE = b"data: [DONE]\n\n"
+PING = b": ping\n\n"
+
+# 模板中增量文本的占位符
+MARKER = "\x00sse-delta\x00"
+
+
+def event(payload: Any) -> bytes:
+    """序列化一个完整的 SSE 数据块"""
+    return b"data: " + jsoncodec.dumps_bytes(payload) + b"\n\n"
+
+
+class ChunkTemplate:
+    """只有一个字符串字段变化的 SSE 块（payload 中用 MARKER 标出该字段）"""
+
+    def __init__(self, payload: Any):
+        body = jsoncodec.dumps_bytes(payload)
+        prefix, suffix = body.split(jsoncodec.dumps_bytes(MARKER))
+        self.prefix = b"data: " + prefix
+        self.suffix = suffix + b"\n\n"
+
+    def render(self, text: str) -> bytes:
+        return self.prefix + jsoncodec.dumps_bytes(text) + self.suffix
+
+
+class OpenAIChunkEncoder:
+    """OpenAI chat.completion.chunk 格式"""
+
+    def __init__(self, completion_id: str, created: int, model: str):
+        self._base = {
+            "id": completion_id,
+            "object": "chat.completion.chunk",
+            "created": created,
+            "model": model,
+        }
+        self._content = ChunkTemplate(self._payload({"content": MARKER}))
+
+    def _payload(self, delta: Dict[str, Any], finish_reason: Optional[str] = None) -> Dict[str, Any]:
+        return {**self._base, "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]}
+
+    def chunk(self, delta: Dict[str, Any], finish_reason: Optional[str] = None) -> bytes:
+        """任意 delta 的块（不在热点路径上的角色块、结束块、错误块）"""
+        return event(self._payload(delta, finish_reason))
+
+    def role(self) -> bytes:
+        return self.chunk({"role": "assistant"})
+
+    def content(self, text: str) -> bytes:
+        return self._content.render(text)
+
+    def finish(self, finish_reason: str = "stop") -> bytes:
+        return self.chunk({}, finish_reason)
+
+    def usage(self, usage: Dict[str, int]) -> bytes:
+        """stream_options.include_usage 时在结束块之后发送的用量块（choices 为空）"""
+        return event({**self._base, "choices": [], "usage": usage})
+
+
+def usage_metadata(usage: Dict[str, Any]) -> Dict[str, int]:
+    """OpenAI 格式的 usage 转换为 Gemini 的 usageMetadata（含上下文缓存命中的 token 数）"""
+    metadata = {
+        "promptTokenCount": usage.get("prompt_tokens", 0),
+        "candidatesTokenCount": usage.get("completion_tokens", 0),
+        "totalTokenCount": usage.get("total_tokens", 0),
+    }
+    cached_tokens = (usage.get("prompt_tokens_details") or {}).get("cached_tokens")
+    if cached_tokens:
+        metadata["cachedContentTokenCount"] = cached_tokens
+    return metadata
+
+
+class GeminiChunkEncoder:
+    """Gemini streamGenerateContent (alt=sse) 格式"""
+
+    START = event({"candidates": [{"content": {"parts": []}}]})
+    FINISH = event({"candidates": [{"finishReason": "STOP"}]})
+    _text = ChunkTemplate({"candidates": [{"content": {"parts": [{"text": MARKER}]}}]})
+
+    def text(self, text: str) -> bytes:
+        return self._text.render(text)
+
+    def finish(self, usage: Optional[Dict[str, Any]] = None) -> bytes:
+        """结束块，带上 usageMetadata（usage 为 OpenAI 格式）"""
+        if not usage:
+            return self.FINISH
+        return event({"candidates": [{"finishReason": "STOP"}], "usageMetadata": usage_metadata(usage)})
+
+    def error(self, detail: Any) -> bytes:
+        return event({"error": detail})
+
+
+async def coalesce(deltas: AsyncIterator[str], window: float) -> AsyncIterator[str]:
+    """
+    合并 window 秒内连续到达的增量
+
+    第一个增量到达后最多再等 window 秒，期间到达的增量拼成一块输出；window <= 0 时原样输出。
+    上游出错时先输出已缓冲的内容再抛出异常。
+    """
+    if window <= 0:
+        try:
+            async for delta in deltas:
+                yield delta
+        finally:
+            await deltas.aclose()
+        return
+
+    loop = asyncio.get_running_loop()
+    pending: Optional[asyncio.Future] = None
+    buffer = []
+    deadline = 0.0
+    try:
+        while True:
+            if pending is None:
+                pending = asyncio.ensure_future(deltas.__anext__())
+            if buffer:
+                timeout = deadline - loop.time()
+                if timeout <= 0 and not pending.done():
+                    yield "".join(buffer)
+                    buffer = []
+                    continue
+                await asyncio.wait((pending,), timeout=max(timeout, 0))
+                if not pending.done():
+                    continue
+            else:
+                await asyncio.wait((pending,))
+            task, pending = pending, None
+            try:
+                delta = task.result()
+            except StopAsyncIteration:
+                break
+            except Exception:
+                if buffer:
+                    yield "".join(buffer)
+                raise
+            if not buffer:
+                deadline = loop.time() + window
+            buffer.append(delta)
+        if buffer:
+            yield "".join(buffer)
+    finally:
+        if pending is not None:
+            pending.cancel()
+            await asyncio.gather(pending, return_exceptions=True)
+        await deltas.aclose()
+
+
+async def heartbeat(deltas: AsyncIterator[str], interval: float) -> AsyncIterator[Optional[str]]:
+    """
+    超过 interval 秒没有新增量时输出 None（调用方写出 PING），收到增量后重新计时
+
+    interval <= 0 时原样输出。等待中的读取不会因为超时被取消。
+    """
+    if interval <= 0:
+        try:
+            async for delta in deltas:
+                yield delta
+        finally:
+            await deltas.aclose()
+        return
+
+    pending: Optional[asyncio.Future] = None
+    try:
+        while True:
+            if pending is None:
+                pending = asyncio.ensure_future(deltas.__anext__())
+            await asyncio.wait((pending,), timeout=interval)
+            if not pending.done():
+                yield None
+                continue
+            task, pending = pending, None
+            try:
+                delta = task.result()
+            except StopAsyncIteration:
+                break
+            yield delta
+    finally:
+        if pending is not None:
+            pending.cancel()
+            await asyncio.gather(pending, return_exceptions=True)
+        await deltas.aclose()
+
+
+# 切块时优先在句末断开，其次在空白 / 逗号处断开
+_SENTENCE_END = re.compile(r"[。！？；…\n]+|[.!?;]+(?=\s|$)")
+_WORD_END = re.compile(r"[\s，、,：:）)]+")
+
+
+def _last_boundary(pattern: "re.Pattern", text: str, start: int, end: int) -> int:
+    cut = 0
+    for m in pattern.finditer(text, start, end):
+        cut = m.end()
+    return cut
+
+
+def split_chunks(text: str, size: int) -> Iterator[str]:
+    """
+    把完整文本切成约 size 个字符的块，尽量在句子或单词边界断开
+
+    只在块的后半段寻找边界，找不到时按 size 硬切，保证块不会过小。
+    """
+    size = max(1, size)
+    start = 0
+    n = len(text)
+    while n - start > size:
+        end = start + size
+        cut = (
+            _last_boundary(_SENTENCE_END, text, start + size // 2, end)
+            or _last_boundary(_WORD_END, text, start + size // 2, end)
+        )
+        if cut:
+            end = cut
+        yield text[start:end]
+        start = end
+    if start < n:
+        yield text[start:]
+
+
+async def pace(chunks: Iterable[str], bytes_per_sec: float = 0) -> AsyncIterator[str]:
+    """
+    按 bytes_per_sec（UTF-8 字节）限速输出；<= 0 时不等待，立即输出全部块
+    """
+    if bytes_per_sec <= 0:
+        for chunk in chunks:
+            yield chunk
+        return
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+    sent = 0
+    for chunk in chunks:
+        delay = started + sent / bytes_per_sec - loop.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        yield chunk
+        sent += len(chunk.encode("utf-8"))
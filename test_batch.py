@@ -0,0 +1,252 @@
+"""
+批处理引擎测试（无需启动服务）
+
+运行: python -m pytest -q test_batch.py
+"""
+
+import asyncio
+import os
+import sqlite3
+import tempfile
+
+import server
+from batch import BatchEngine, BatchItemError, BatchStore, parse_jsonl
+from client import ChatCompletionChoice, ChatCompletionResponse, GeminiClient, Message
+
+
+def _store():
+    return BatchStore(os.path.join(tempfile.mkdtemp(), "batches.db"))
+
+
+async def _wait(engine, batch_id):
+    while engine.get(batch_id)["status"] not in ("completed", "cancelled", "failed"):
+        await asyncio.sleep(0.01)
+    return engine.get(batch_id)
+
+
+def test_parse_jsonl():
+    assert parse_jsonl('{"a": 1}\n\n{"b": 2}\n') == [{"a": 1}, {"b": 2}]
+    try:
+        parse_jsonl('{"a": 1}\nnot json')
+    except ValueError as e:
+        assert "第 2 行" in str(e)
+    else:
+        raise AssertionError("应当报错")
+
+
+def test_runs_with_bounded_concurrency_and_keeps_order():
+    running = []
+    peak = []
+
+    async def execute(kind, model, request, api_key):
+        running.append(1)
+        peak.append(len(running))
+        await asyncio.sleep(0.01 * (5 - request["n"] % 5))
+        running.pop()
+        return {"echo": request["n"]}
+
+    async def run():
+        engine = BatchEngine(_store(), execute, concurrency=3)
+        batch = engine.submit("openai", "/v1/chat/completions", "m", [(f"r{i}", {"n": i}) for i in range(10)])
+        batch = await _wait(engine, batch["id"])
+        return batch, list(engine.results(batch["id"]))
+
+    batch, results = asyncio.run(run())
+    assert batch["status"] == "completed"
+    assert batch["counts"] == {"succeeded": 10}
+    assert max(peak) == 3
+    # 结果按提交顺序输出，而不是完成顺序
+    assert [r["custom_id"] for r in results] == [f"r{i}" for i in range(10)]
+    assert [r["response"]["echo"] for r in results] == list(range(10))
+
+
+def test_retries_transient_errors_only():
+    calls = {}
+
+    async def execute(kind, model, request, api_key):
+        calls[request["n"]] = calls.get(request["n"], 0) + 1
+        if request["n"] == 0 and calls[0] < 3:
+            raise RuntimeError("上游超时")
+        if request["n"] == 1:
+            raise BatchItemError("缺少用户消息")
+        if request["n"] == 2:
+            raise RuntimeError("一直失败")
+        return {"ok": True}
+
+    async def run():
+        engine = BatchEngine(_store(), execute, concurrency=2, max_retries=2, retry_delay=0.001)
+        batch = engine.submit("openai", "/v1/chat/completions", "m", [(f"r{i}", {"n": i}) for i in range(3)])
+        batch = await _wait(engine, batch["id"])
+        return batch, list(engine.results(batch["id"]))
+
+    batch, results = asyncio.run(run())
+    assert calls == {0: 3, 1: 1, 2: 3}
+    assert batch["counts"] == {"succeeded": 1, "failed": 2}
+    assert results[1]["status_code"] == 400 and results[1]["error"] == "缺少用户消息"
+    assert results[2]["status_code"] == 500
+
+
+def test_backoff_releases_concurrency_slot():
+    """重试前的退避等待不占用并发名额，其他批次的条目可以先执行"""
+    events = []
+
+    async def execute(kind, model, request, api_key):
+        events.append(request["name"])
+        if request["name"] == "a" and events.count("a") == 1:
+            raise RuntimeError("上游超时")
+        return {}
+
+    async def run():
+        engine = BatchEngine(_store(), execute, concurrency=1, retry_delay=0.2)
+        first = engine.submit("openai", "/v1/chat/completions", "m", [("a", {"name": "a"})])
+        await asyncio.sleep(0.05)
+        second = engine.submit("openai", "/v1/chat/completions", "m", [("b", {"name": "b"})])
+        await _wait(engine, second["id"])
+        assert events == ["a", "b"]
+        return await _wait(engine, first["id"])
+
+    batch = asyncio.run(run())
+    assert batch["counts"] == {"succeeded": 1} and events == ["a", "b", "a"]
+
+
+def test_cancel_stops_pending_items():
+    async def execute(kind, model, request, api_key):
+        await asyncio.sleep(0.02)
+        return {}
+
+    async def run():
+        engine = BatchEngine(_store(), execute, concurrency=1)
+        batch = engine.submit("gemini", "/v1beta/models/m:generateContent", "m", [(str(i), {}) for i in range(20)])
+        await asyncio.sleep(0.03)
+        engine.cancel(batch["id"])
+        return await _wait(engine, batch["id"])
+
+    batch = asyncio.run(run())
+    assert batch["status"] == "cancelled"
+    assert batch["counts"]["cancelled"] > 10
+    assert batch["counts"].get("succeeded", 0) >= 1
+
+
+def test_resume_after_restart():
+    store = _store()
+    # 模拟重启前：一条已完成，一条执行到一半
+    batch_id = store.create("openai", "/v1/chat/completions", "m", [(f"r{i}", {"n": i}) for i in range(3)])
+    store.mark_running(batch_id, 0, 1)
+    store.finish_item(batch_id, 0, "succeeded", status_code=200, response={"n": 0})
+    store.mark_running(batch_id, 1, 1)
+    executed = []
+
+    async def execute(kind, model, request, api_key):
+        executed.append(request["n"])
+        return {"n": request["n"]}
+
+    async def run():
+        engine = BatchEngine(store, execute)
+        assert engine.resume() == 1
+        return await _wait(engine, batch_id)
+
+    batch = asyncio.run(run())
+    assert executed == [1, 2]
+    assert batch["status"] == "completed" and batch["counts"] == {"succeeded": 3}
+
+
+def _sent_envelope(messages):
+    """用 run_batch_chat 执行一条请求，返回发给上游的 f.req（在发送处截断，不请求 Gemini）"""
+    client = GeminiClient(secure_1psid="psid", snlm0e="token", bl="bl", session_file=None)
+    client.conversation_id = "c_old"
+    sent = {}
+
+    def post(url, params=None, data=None, headers=None, **kwargs):
+        sent.update(data)
+        raise RuntimeError("已截获请求")
+
+    client.session.post = post
+    client._log_gemini_call = lambda *args, **kwargs: None  # 不写 api_logs.json
+    try:
+        server.run_batch_chat(client, messages, "gemini-3.0-flash", None)
+    except Exception:
+        pass
+    assert client.conversation_id == ""
+    return sent["f.req"]
+
+
+def test_multi_turn_items_send_earlier_turns():
+    """每条请求新开对话，之前的轮次随最后一条用户消息补发"""
+    envelope = _sent_envelope([
+        {"role": "system", "content": "简短回答"},
+        {"role": "user", "content": "我叫小明"},
+        {"role": "assistant", "content": "你好，小明"},
+        {"role": "user", "content": "我叫什么？"},
+    ])
+    assert "简短回答" in envelope and "我叫小明" in envelope and "你好，小明" in envelope
+    assert envelope.index("你好，小明") < envelope.index("我叫什么？")
+
+    # Gemini 格式的 contents（model 角色）同样补发
+    messages = server.gemini_contents_to_messages([
+        {"role": "user", "parts": [{"text": "记住数字 42"}]},
+        {"role": "model", "parts": [{"text": "好的，记住了"}]},
+        {"role": "user", "parts": [{"text": "是哪个数字？"}]},
+    ])
+    envelope = _sent_envelope(messages)
+    assert "记住数字 42" in envelope and "好的，记住了" in envelope and "是哪个数字？" in envelope
+
+
+def test_items_run_under_submitter_key(monkeypatch):
+    """批次记住提交者的 API Key，每条请求按该 Key 限流、排队并扣减输出额度"""
+    path = os.path.join(tempfile.mkdtemp(), "batches.db")
+    # 旧版本的数据库没有 api_key 列
+    conn = sqlite3.connect(path)
+    conn.execute(
+        "CREATE TABLE batches (id TEXT PRIMARY KEY, kind TEXT NOT NULL, endpoint TEXT NOT NULL, model TEXT NOT NULL, "
+        "status TEXT NOT NULL, created_at REAL NOT NULL, completed_at REAL, metadata TEXT NOT NULL, error TEXT)"
+    )
+    conn.close()
+    store = BatchStore(path)
+    assert store.get(store.create("openai", "/v1/chat/completions", "m", []))["api_key"] == ""
+
+    seen = []
+
+    class Slot:
+        def release(self):
+            pass
+
+    async def acquire_account_slot(authorization=None, x_priority=None, model=None):
+        seen.append(("slot", authorization, x_priority))
+        return Slot()
+
+    def run_batch_chat(client, messages, model, tools):
+        return ChatCompletionResponse(
+            id="chatcmpl-test",
+            choices=[ChatCompletionChoice(index=0, message=Message(role="assistant", content="好的"))],
+        )
+
+    monkeypatch.setattr(server, "check_rate_limit", lambda authorization, chars: seen.append(("rate", authorization, chars)))
+    monkeypatch.setattr(server, "charge_output_chars", lambda authorization, chars: seen.append(("charge", authorization, chars)))
+    monkeypatch.setattr(server, "acquire_account_slot", acquire_account_slot)
+    monkeypatch.setattr(server, "run_batch_chat", run_batch_chat)
+    monkeypatch.setattr(server, "_isolated_clients", [object()])
+
+    async def run():
+        engine = BatchEngine(store, server.execute_batch_item, max_retries=0)
+        body = {"model": "m", "messages": [{"role": "user", "content": "你好"}]}
+        batch = engine.submit("openai", "/v1/chat/completions", "m", [("r1", body)], api_key="sk-a")
+        return await _wait(engine, batch["id"])
+
+    batch = asyncio.run(run())
+    assert batch["api_key"] == "sk-a" and batch["counts"] == {"succeeded": 1}
+    assert seen == [("rate", "Bearer sk-a", 2), ("slot", "Bearer sk-a", "batch"), ("charge", "Bearer sk-a", 2)]
+
+
+if __name__ == "__main__":
+    import pytest
+
+    test_parse_jsonl()
+    test_runs_with_bounded_concurrency_and_keeps_order()
+    test_retries_transient_errors_only()
+    test_backoff_releases_concurrency_slot()
+    test_cancel_stops_pending_items()
+    test_resume_after_restart()
+    test_multi_turn_items_send_earlier_turns()
+    with pytest.MonkeyPatch.context() as mp:
+        test_items_run_under_submitter_key(mp)
+    print("✅ 全部通过")
@@ -0,0 +1,73 @@
+"""
+响应缓存测试（无需启动服务）
+
+运行: python -m pytest -q test_cache.py
+"""
+
+from cache import ResponseCache, make_cache_key
+
+
+def test_key_normalization():
+    as_text = make_cache_key("m", [{"role": "user", "content": "hi "}])
+    as_parts = make_cache_key("m", [{"role": "user", "content": [{"type": "text", "text": "hi"}]}])
+    assert as_text == as_parts
+    assert as_text != make_cache_key("other", [{"role": "user", "content": "hi"}])
+    assert as_text != make_cache_key("m", [{"role": "user", "content": "hi"}], temperature=0.5)
+    # None 参数不影响键
+    assert as_text == make_cache_key("m", [{"role": "user", "content": "hi"}], tools=None)
+
+
+def test_key_hashes_images():
+    def key(url):
+        return make_cache_key("m", [{"role": "user", "content": [
+            {"type": "text", "text": "describe"},
+            {"type": "image_url", "image_url": {"url": url}},
+        ]}])
+
+    assert key("data:image/png;base64,AAAA") == key("data:image/png;base64,AAAA")
+    assert key("data:image/png;base64,AAAA") != key("data:image/png;base64,BBBB")
+
+
+def test_ttl_and_lru():
+    cache = ResponseCache(max_entries=2, ttl=10)
+    cache.put("a", {"text": "1"}, now=0)
+    cache.put("b", {"text": "2"}, now=0)
+    assert cache.get("a", now=1) == {"text": "1"}
+    # b 最久未使用，被淘汰
+    cache.put("c", {"text": "3"}, now=1)
+    assert cache.get("b", now=1) is None
+    assert cache.get("a", now=1) is not None
+    # 过期
+    assert cache.get("a", now=11) is None
+    assert len(cache) == 1
+
+
+def test_memory_cap():
+    cache = ResponseCache(max_entries=100, max_bytes=200, ttl=60)
+    for i in range(10):
+        cache.put(f"k{i}", {"text": "x" * 40}, now=0)
+    assert cache.size_bytes <= 200
+    assert cache.get("k9", now=0) is not None
+    assert cache.get("k0", now=0) is None
+
+
+def test_disk_tier(tmp_path):
+    path = str(tmp_path / "cache.db")
+    first = ResponseCache(ttl=60, db_path=path)
+    first.put("k", {"text": "cached"}, now=0)
+    # 新实例（模拟重启 / 另一个 worker）从磁盘层读取
+    second = ResponseCache(ttl=60, db_path=path)
+    assert second.get("k", now=1) == {"text": "cached"}
+    assert len(second) == 1
+    assert second.get("k", now=61) is None
+
+
+if __name__ == "__main__":
+    import pathlib
+    import tempfile
+    test_key_normalization()
+    test_key_hashes_images()
+    test_ttl_and_lru()
+    test_memory_cap()
+    test_disk_tier(pathlib.Path(tempfile.mkdtemp()))
+    print("✅ 全部通过")
@@ -0,0 +1,111 @@
+"""
+模型目录测试（无需启动服务）
+
+运行: python -m pytest -q test_catalog.py
+"""
+
+import json
+import os
+
+import catalog
+from catalog import ModelCatalog
+from client import GeminiClient
+
+
+def _write(path, names):
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump({"models": [{"name": f"models/{n}"} for n in names]}, f)
+
+
+def test_prebuilt_bodies(tmp_path):
+    path = tmp_path / "models.json"
+    _write(path, ["a", "b"])
+    models = ModelCatalog(str(path))
+    body, etag = models.openai_body()
+    assert [m["id"] for m in json.loads(body)["data"]] == ["a", "b"]
+    # 未修改时返回同一个对象，不重新序列化
+    assert models.openai_body()[0] is body
+    assert json.loads(models.gemini_body()[0])["models"][1]["name"] == "models/b"
+    assert models.get("models/a")["name"] == "models/a"
+    assert etag.startswith('"')
+
+
+def test_reload_on_mtime_change(tmp_path, monkeypatch):
+    monkeypatch.setattr(catalog, "CHECK_INTERVAL", 0)
+    path = tmp_path / "models.json"
+    _write(path, ["a"])
+    models = ModelCatalog(str(path))
+    _, etag = models.openai_body()
+    _write(path, ["a", "c"])
+    stat = os.stat(path)
+    os.utime(path, (stat.st_atime, stat.st_mtime + 10))
+    body, new_etag = models.openai_body()
+    assert new_etag != etag
+    assert models.get("c") is not None
+
+
+def test_etag_stable_without_content_change(tmp_path, monkeypatch):
+    monkeypatch.setattr(catalog, "CHECK_INTERVAL", 0)
+    path = tmp_path / "models.json"
+    _write(path, ["a"])
+    models = ModelCatalog(str(path))
+    body, etag = models.openai_body()
+    # 重启后（新的目录对象）ETag 不变
+    assert ModelCatalog(str(path)).openai_body()[1] == etag
+    # touch 文件、手动重新加载：内容没变，ETag 和 created 不变，客户端仍可得到 304
+    stat = os.stat(path)
+    os.utime(path, (stat.st_atime, stat.st_mtime + 10))
+    models.reload()
+    assert models.openai_body() == (body, etag)
+
+
+def test_fallback_when_missing(tmp_path):
+    fallback = ["x"]
+    models = ModelCatalog(str(tmp_path / "missing.json"), fallback=lambda: fallback)
+    assert json.loads(models.openai_body()[0])["data"][0]["id"] == "x"
+    fallback.append("y")
+    models.invalidate()
+    assert len(json.loads(models.openai_body()[0])["data"]) == 2
+
+
+def test_routing_fields(tmp_path):
+    path = tmp_path / "models.json"
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump({"models": [
+            {"name": "models/pro", "upstreamId": "e6fa609c3fa255c0", "maxConcurrency": 2, "inputTokenLimit": 1048576},
+            {"name": "models/flash"},
+        ]}, f)
+    models = ModelCatalog(str(path))
+    assert models.upstream_ids() == {"pro": "e6fa609c3fa255c0"}
+    assert models.token_limits() == {"pro": 1048576}
+    assert models.max_concurrency("models/pro") == 2
+    assert models.max_concurrency("flash") == 0
+    # 路由字段不出现在 /v1beta/models 响应中
+    assert "upstreamId" not in json.loads(models.gemini_body()[0])["models"][0]
+
+
+def test_client_model_header():
+    client = GeminiClient.__new__(GeminiClient)
+    client.debug = False
+    client.set_model_ids({"gemini-3.0-pro": "e6fa609c3fa255c0"})
+    headers = client._model_headers_for("models/gemini-3.0-pro")
+    assert headers == {
+        "x-goog-ext-525001261-jspb": b'[1,null,null,null,"e6fa609c3fa255c0",null,null,0,[4],null,null,2]'
+    }
+    # 按模型缓存
+    assert client._model_headers_for("models/gemini-3.0-pro") is headers
+    assert client._model_headers_for("unknown") is None
+    assert client._model_headers_for(None) is None
+
+
+if __name__ == "__main__":
+    import pathlib
+    import tempfile
+    test_prebuilt_bodies(pathlib.Path(tempfile.mkdtemp()))
+    import pytest
+    with pytest.MonkeyPatch.context() as mp:
+        test_etag_stable_without_content_change(pathlib.Path(tempfile.mkdtemp()), mp)
+    test_fallback_when_missing(pathlib.Path(tempfile.mkdtemp()))
+    test_routing_fields(pathlib.Path(tempfile.mkdtemp()))
+    test_client_model_header()
+    print("✅ 全部通过")
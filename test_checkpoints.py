@@ -0,0 +1,84 @@
+"""
+会话快照与分支对话测试（无需启动服务，不请求 Gemini）
+
+运行: python -m pytest -q test_checkpoints.py
+"""
+
+import os
+import tempfile
+
+import pytest
+
+from client import GeminiClient
+
+
+def _client(session_file=None):
+    return GeminiClient(secure_1psid="psid", snlm0e="token", bl="bl", session_file=session_file)
+
+
+def _turn(client, n, user, reply):
+    """模拟一轮对话：上游返回新的 response_id / choice_id 后记录本轮"""
+    client.conversation_id = "c_1"
+    client.response_id = f"r_{n}"
+    client.choice_id = f"rc_{n}"
+    client.record_turn(user, reply)
+
+
+def test_fork_restores_state_and_history():
+    client = _client()
+    for n in (1, 2, 3):
+        _turn(client, n, f"q{n}", f"a{n}")
+    assert client.head_checkpoint == 3
+
+    # 重新生成第 3 轮：回到第 2 轮之后，只发送第 3 条用户消息
+    client.fork(2)
+    assert client.checkpoint() == ("c_1", "r_2", "rc_2")
+    assert [m["content"] for m in client.get_history()] == ["q1", "a1", "q2", "a2"]
+
+    _turn(client, 4, [{"type": "text", "text": "q3'"}, {"type": "image_url", "image_url": {"url": "x"}}], "a3'")
+    branch = client.get_checkpoint(4)
+    assert branch["parent"] == 2 and branch["user"] == "q3'"
+    # 原来的第 3 轮仍然保留，可以切回去
+    assert [c["id"] for c in client.checkpoint_path(3)] == [1, 2, 3]
+    assert [c["id"] for c in client.checkpoint_path(4)] == [1, 2, 4]
+
+
+def test_fork_to_start_and_missing_checkpoint():
+    client = _client()
+    _turn(client, 1, "q1", "a1")
+    client.fork(None)
+    assert client.checkpoint() == ("", "", "") and len(client.messages) == 0
+    _turn(client, 2, "q1 edited", "a1'")
+    assert client.get_checkpoint(2)["parent"] is None
+    with pytest.raises(KeyError):
+        client.fork(99)
+
+
+def test_checkpoints_persist_and_are_bounded():
+    path = os.path.join(tempfile.mkdtemp(), "conversation_state.json")
+    client = _client(path)
+    client.max_checkpoints = 3
+    for n in range(1, 6):
+        _turn(client, n, f"q{n}", f"a{n}")
+    assert [c["id"] for c in client.checkpoints] == [3, 4, 5]
+    # 更早的快照已淘汰，路径从能找到的最早一轮开始
+    assert [c["id"] for c in client.checkpoint_path(5)] == [3, 4, 5]
+
+    reloaded = _client(path)
+    assert reloaded.head_checkpoint == 5
+    reloaded.fork(4)
+    assert reloaded.checkpoint() == ("c_1", "r_4", "rc_4")
+    assert _client(path).head_checkpoint == 4
+
+    # 快照 ID 计数器随会话状态保存，重置后也不回退
+    reloaded.reset()
+    _turn(reloaded, 1, "新的问题", "新的回答")
+    assert [c["id"] for c in _client(path).checkpoints] == [6]
+    assert _client(path).next_checkpoint_id == 7
+
+
+if __name__ == "__main__":
+    test_fork_restores_state_and_history()
+    test_fork_to_start_and_missing_checkpoint()
+    test_checkpoints_persist_and_are_bounded()
+    print("✅ 全部通过")
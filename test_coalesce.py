@@ -0,0 +1,100 @@
+"""
+相同请求合并测试（无需启动服务）
+
+运行: python -m pytest -q test_coalesce.py
+"""
+
+import asyncio
+
+import pytest
+
+from coalesce import FlightCancelled, SingleFlight
+
+
+def test_followers_share_result():
+    async def scenario():
+        registry = SingleFlight()
+        flight = registry.start("k")
+        assert registry.get("k") is flight
+        waiters = [asyncio.ensure_future(registry.get("k").result()) for _ in range(3)]
+        await asyncio.sleep(0)
+        flight.publish("hello ")
+        flight.publish("world")
+        flight.finish(usage={"total_tokens": 11})
+        results = await asyncio.gather(*waiters)
+        # 结束后注销，新的相同请求重新生成
+        assert registry.get("k") is None
+        return results
+
+    assert asyncio.run(scenario()) == ["hello world"] * 3
+
+
+def test_late_joiner_replays_then_follows():
+    async def scenario():
+        registry = SingleFlight()
+        flight = registry.start("k")
+
+        async def producer(flight):
+            for chunk in ["a", "b", "c", "d"]:
+                flight.publish(chunk)
+                await asyncio.sleep(0.01)
+
+        flight.set_producer(producer)
+
+        async def collect(delay):
+            await asyncio.sleep(delay)
+            return [chunk async for chunk in registry.get("k").subscribe()]
+
+        return await asyncio.gather(collect(0), collect(0.025))
+
+    first, late = asyncio.run(scenario())
+    assert first == late == ["a", "b", "c", "d"]
+
+
+def test_error_propagates_to_followers():
+    async def scenario():
+        registry = SingleFlight()
+        flight = registry.start("k")
+        waiter = asyncio.ensure_future(registry.get("k").result())
+        await asyncio.sleep(0)
+        flight.finish(error=RuntimeError("boom"))
+        await waiter
+
+    with pytest.raises(RuntimeError):
+        asyncio.run(scenario())
+
+
+def test_cancel_only_when_all_subscribers_leave():
+    cancelled = []
+
+    async def scenario():
+        registry = SingleFlight()
+        flight = registry.start("k")
+
+        async def producer(flight):
+            flight.on_abandon(lambda: cancelled.append(True))
+            for i in range(100):
+                flight.publish(str(i))
+                await asyncio.sleep(0.01)
+
+        flight.set_producer(producer)
+        first = flight.subscribe()
+        second = flight.subscribe()
+        await first.__anext__()
+        await second.__anext__()
+        await first.aclose()
+        assert not cancelled and not flight.done
+        await second.__anext__()
+        await second.aclose()
+        assert cancelled
+        assert isinstance(flight.error, FlightCancelled)
+        assert registry.get("k") is None
+
+    asyncio.run(scenario())
+
+
+if __name__ == "__main__":
+    test_followers_share_result()
+    test_late_joiner_replays_then_follows()
+    test_cancel_only_when_all_subscribers_leave()
+    print("✅ 全部通过")
@@ -0,0 +1,113 @@
+"""
+响应压缩测试（无需启动服务）
+
+运行: python -m pytest -q test_compression.py
+"""
+
+import asyncio
+import zlib
+
+import httpx
+from fastapi import FastAPI
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+
+from compression import CompressionMiddleware, negotiate_encoding
+
+
+def _app(sse_policy="flush"):
+    app = FastAPI()
+    app.add_middleware(CompressionMiddleware, minimum_size=100, sse_policy=sse_policy)
+
+    @app.get("/big")
+    async def big():
+        return JSONResponse({"text": "回答" * 500})
+
+    @app.get("/small")
+    async def small():
+        return PlainTextResponse("ok")
+
+    @app.get("/sse")
+    async def sse():
+        async def events():
+            for i in range(3):
+                yield f"data: {{\"n\": {i}}}\n\n"
+        return StreamingResponse(events(), media_type="text/event-stream")
+
+    return app
+
+
+def _get(app, path, accept="gzip"):
+    async def run():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://t") as client:
+            response = await client.get(path, headers={"Accept-Encoding": accept})
+            return response, await response.aread()
+    return asyncio.run(run())
+
+
+def test_negotiate():
+    assert negotiate_encoding("gzip, deflate") == "gzip"
+    assert negotiate_encoding("identity") is None
+    assert negotiate_encoding("gzip;q=0") is None
+    assert negotiate_encoding("*") in ("br", "gzip")
+    assert negotiate_encoding("") is None
+
+
+def test_large_json_compressed():
+    response, _ = _get(_app(), "/big")
+    assert response.headers["content-encoding"] == "gzip"
+    assert "accept-encoding" in response.headers["vary"].lower()
+    assert int(response.headers["content-length"]) < len("回答" * 500)
+    assert response.json() == {"text": "回答" * 500}
+
+
+def test_small_or_unaccepted_not_compressed():
+    response, _ = _get(_app(), "/small")
+    assert "content-encoding" not in response.headers
+    response, _ = _get(_app(), "/big", accept="identity")
+    assert "content-encoding" not in response.headers
+
+
+def test_sse_flushes_each_event():
+    sent = []
+
+    async def run():
+        app = _app()
+        scope = {
+            "type": "http", "method": "GET", "path": "/sse", "raw_path": b"/sse", "query_string": b"",
+            "headers": [(b"accept-encoding", b"gzip")], "http_version": "1.1", "scheme": "http",
+            "server": ("t", 80), "client": ("c", 1), "root_path": "",
+        }
+
+        async def receive():
+            await asyncio.sleep(1)
+            return {"type": "http.disconnect"}
+
+        async def send(message):
+            sent.append(message)
+
+        await app(scope, receive, send)
+
+    asyncio.run(run())
+    headers = dict(sent[0]["headers"])
+    assert headers[b"content-encoding"] == b"gzip"
+    assert b"content-length" not in headers
+    # 每个事件单独刷新：逐块解压即可得到完整事件，不需要等待后续数据
+    decoder = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    events = [decoder.decompress(m["body"]) for m in sent[1:] if m["body"]]
+    assert events[:3] == [f"data: {{\"n\": {i}}}\n\n".encode() for i in range(3)]
+
+
+def test_sse_off_policy():
+    response, body = _get(_app(sse_policy="off"), "/sse")
+    assert "content-encoding" not in response.headers
+    assert body.count(b"data:") == 3
+
+
+if __name__ == "__main__":
+    test_negotiate()
+    test_large_json_compressed()
+    test_small_or_unaccepted_not_compressed()
+    test_sse_flushes_each_event()
+    test_sse_off_policy()
+    print("✅ 全部通过")
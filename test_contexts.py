@@ -0,0 +1,62 @@
+"""
+上下文缓存存储测试（无需启动服务）
+
+运行: python -m pytest -q test_contexts.py
+"""
+
+import os
+import tempfile
+import time
+
+from contexts import CachedContentStore, content_hash, parse_timestamp, parse_ttl, to_resource
+
+
+def test_parse_ttl_and_timestamp():
+    assert parse_ttl("3600s") == 3600
+    assert parse_ttl("1.5s") == 1.5
+    assert parse_ttl(None) is None
+    for bad in ("3600", "-1s", "abc"):
+        try:
+            parse_ttl(bad)
+        except ValueError:
+            continue
+        raise AssertionError(f"{bad} 应当报错")
+    assert parse_timestamp("2025-01-01T00:00:00Z") == 1735689600
+
+
+def test_create_get_and_persist():
+    path = os.path.join(tempfile.mkdtemp(), "cached_contents.json")
+    store = CachedContentStore(path)
+    fingerprint = content_hash("m", [{"role": "user", "parts": [{"text": "doc"}]}], None)
+    entry = store.create("m", ("c_1", "r_1", "rc_1"), total_tokens=1200, ttl=60, fingerprint=fingerprint)
+    short_id = entry["name"].split("/", 1)[1]
+
+    # 重启后仍然可以按完整名称或短 ID 找到快照
+    reloaded = CachedContentStore(path)
+    assert reloaded.get(short_id)["checkpoint"] == ["c_1", "r_1", "rc_1"]
+    assert reloaded.find(fingerprint)["name"] == entry["name"]
+    assert reloaded.find(content_hash("m", [], None)) is None
+
+    resource = to_resource(reloaded.get(entry["name"]))
+    assert resource["model"] == "models/m"
+    assert resource["usageMetadata"] == {"totalTokenCount": 1200}
+    assert resource["expireTime"].endswith("Z")
+
+    assert reloaded.delete(entry["name"])
+    assert reloaded.get(entry["name"]) is None
+    assert not reloaded.delete(entry["name"])
+
+
+def test_expiry():
+    store = CachedContentStore(None)
+    entry = store.create("m", ("c", "r", "rc"), total_tokens=1, ttl=60)
+    store.update_expiry(entry["name"], time.time() - 1)
+    assert store.get(entry["name"]) is None
+    assert store.list() == []
+
+
+if __name__ == "__main__":
+    test_parse_ttl_and_timestamp()
+    test_create_get_and_persist()
+    test_expiry()
+    print("✅ 全部通过")
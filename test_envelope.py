@@ -0,0 +1,46 @@
+"""
+f.req 预编译模板测试（无需启动服务）
+
+运行: python -m pytest -q test_envelope.py
+"""
+
+import json
+
+import pytest
+
+from client import build_request_envelope, encode_request_envelope
+
+
+def _reference(*fields) -> str:
+    """原实现：内层、外层各 json.dumps 一次"""
+    inner_json = json.dumps(build_request_envelope(*fields), ensure_ascii=False, separators=(',', ':'))
+    return json.dumps([None, inner_json], ensure_ascii=False, separators=(',', ':'))
+
+
+CASES = [
+    ("你好", None, "", "", "", "AT:123", "A1B2-C3", [1700000000, 123000000]),
+    ('引号 " 反斜杠 \\ 换行\n制表\t', None, "c_1", "r_2", "rc_3", "AT", "S", [1, 0]),
+    ("控制字符 \x00\x1f 和 emoji 😀 以及  ", None, "c", "r", "rc", None, "S", [0, 0]),
+    ("看图", [[["/contrib_service/ttl_1d/abc", 1, None, "image/png"], "image_1.png"]], "", "", "", "AT", "S", [2, 5]),
+    ("__ENVELOPE_FIELD_3__ 看起来像标记", None, '"', "\\", "", "AT", "S", [3, 4]),
+]
+
+
+@pytest.mark.parametrize("fields", CASES)
+def test_byte_identical(fields):
+    assert encode_request_envelope(*fields) == _reference(*fields)
+
+
+def test_round_trip():
+    fields = CASES[1]
+    inner = json.loads(json.loads(encode_request_envelope(*fields))[1])
+    assert inner[0][0] == fields[0]
+    assert inner[2][:3] == list(fields[2:5])
+    assert inner[-1] == fields[7]
+
+
+if __name__ == "__main__":
+    for case in CASES:
+        test_byte_identical(case)
+    test_round_trip()
+    print("✅ 全部通过")
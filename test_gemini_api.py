@@ -0,0 +1,283 @@
+"""
+Gemini 原生接口测试（无需启动服务，不请求 Gemini：客户端替换为假客户端）
+
+运行: python -m pytest -q test_gemini_api.py
+"""
+
+import asyncio
+import time
+
+import httpx
+
+import server
+import tokens
+from cache import ResponseCache
+from client import ChatCompletionChoice, ChatCompletionResponse, GeminiClient, Message, StreamHandle
+
+AUTH = {"Authorization": f"Bearer {server.API_KEY}"}
+
+
+class FakeClient:
+    """记录收到的请求；回复内容取决于会话中已有的轮数（模拟上游的会话上下文）"""
+
+    conversation_id = ""
+    head_checkpoint = None
+    checkpoints = []
+    debug = False
+
+    def __init__(self, name):
+        self.name = name
+        self.turns = 0
+        self.resets = 0
+        self.calls = []
+        self.delay = 0.0
+
+    def reset(self):
+        self.resets += 1
+        self.turns = 0
+
+    def fork(self, checkpoint_id=None):
+        self.turns = 0
+
+    def chat(self, messages, model=None, url_context=False, tools=None, context=None):
+        self.calls.append({"messages": messages, "context": context})
+        time.sleep(self.delay)
+        self.turns += 1
+        reply = f"{self.name} 第 {self.turns} 轮"
+        return ChatCompletionResponse(
+            id="chatcmpl-test",
+            choices=[ChatCompletionChoice(index=0, message=Message(role="assistant", content=reply))],
+        )
+
+
+def _setup(monkeypatch, cache=True):
+    """主客户端已处于另一段对话中；独立客户端每次新建"""
+    main = FakeClient("main")
+    main.turns = 5
+    isolated = []
+
+    def new_isolated_client():
+        client = FakeClient(f"isolated-{len(isolated)}")
+        client.delay = 0.3
+        client.turns = 3  # 复用前的旧会话，取出后应被重置
+        isolated.append(client)
+        return client
+
+    monkeypatch.setattr(server, "get_client", lambda: main)
+    monkeypatch.setattr(server, "new_isolated_client", new_isolated_client)
+    monkeypatch.setattr(server, "_isolated_clients", [])
+    monkeypatch.setattr(server, "RESPONSE_CACHE", cache)
+    monkeypatch.setattr(server, "_response_cache", ResponseCache(max_entries=16))
+    return main, isolated
+
+
+def _post(path, body):
+    async def run():
+        transport = httpx.ASGITransport(app=server.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as http:
+            return await http.post(path, json=body, headers=AUTH)
+    return asyncio.run(run())
+
+
+def _generate(body, headers=None, concurrent=1):
+    """发送 concurrent 个同时到达的相同请求，返回响应（只有一个时直接返回该响应）"""
+    async def run():
+        transport = httpx.ASGITransport(app=server.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as http:
+            return await asyncio.gather(*(
+                http.post(
+                    "/v1beta/models/gemini-3.0-flash:generateContent", json=body, headers={**AUTH, **(headers or {})}
+                )
+                for _ in range(concurrent)
+            ))
+    responses = asyncio.run(run())
+    return responses[0] if concurrent == 1 else responses
+
+
+def _text(response):
+    return response.json()["candidates"][0]["content"]["parts"][0]["text"]
+
+
+def test_cacheable_request_runs_in_fresh_conversation(monkeypatch):
+    main, isolated = _setup(monkeypatch)
+    body = {"contents": [{"role": "user", "parts": [{"text": "把这句话翻译成英文：你好"}]}]}
+
+    first = _generate(body)
+    assert first.status_code == 200 and first.headers["X-Cache"] == "MISS"
+    # 在重置过的独立客户端上生成，不受主会话影响，也不推进主会话
+    assert _text(first) == "isolated-0 第 1 轮"
+    assert isolated[0].resets == 1 and main.calls == [] and main.turns == 5
+
+    second = _generate(body)
+    assert second.headers["X-Cache"] == "HIT" and _text(second) == _text(first)
+    assert len(isolated[0].calls) == 1
+
+
+def test_coalesced_requests_share_fresh_conversation(monkeypatch):
+    main, isolated = _setup(monkeypatch, cache=False)
+    body = {"contents": [{"role": "user", "parts": [{"text": "今天是星期几？"}]}]}
+
+    first, second = _generate(body, concurrent=2)
+    assert first.status_code == second.status_code == 200
+    assert "X-Coalesced" not in first.headers and second.headers["X-Coalesced"] == "1"
+    # 只生成一次，且订阅者拿到的是新对话中的回复，而不是主会话第 6 轮的回复
+    assert _text(first) == _text(second) == "isolated-0 第 1 轮"
+    assert len(isolated) == 1 and len(isolated[0].calls) == 1
+    assert main.calls == [] and main.turns == 5
+
+
+def test_count_tokens_matches_generate_content(monkeypatch):
+    _setup(monkeypatch, cache=False)
+    image = {"inlineData": {"mimeType": "image/png", "data": "iVBORw0KGgo="}}
+    contents = [
+        {"role": "user", "parts": [{"text": "这张图里有什么？"}, image]},
+        {"role": "model", "parts": [{"text": "一只猫。"}]},
+        {"role": "user", "parts": [{"text": "What color is it?"}]},
+    ]
+    system = {"parts": [{"text": "用中文简短回答。"}]}
+    path = "/v1beta/models/gemini-3.0-flash:countTokens"
+
+    plain = _post(path, {"contents": contents}).json()["totalTokens"]
+    with_system = _post(path, {"generateContentRequest": {"contents": contents, "systemInstruction": system}})
+    assert with_system.status_code == 200
+    assert with_system.json()["totalTokens"] == plain + tokens.count_content(system["parts"])
+
+    # 每张图片按 258 token 计
+    no_image = [{**contents[0], "parts": contents[0]["parts"][:1]}] + contents[1:]
+    assert plain - _post(path, {"contents": no_image}).json()["totalTokens"] == tokens.IMAGE_TOKENS == 258
+
+    # 与 generateContent 返回的 promptTokenCount 一致
+    generated = _generate({"contents": contents, "systemInstruction": system})
+    assert generated.json()["usageMetadata"]["promptTokenCount"] == with_system.json()["totalTokens"]
+    single = [{"role": "user", "parts": [{"text": "你好"}, image]}]
+    generated = _generate({"contents": single})
+    assert generated.json()["usageMetadata"]["promptTokenCount"] == _post(path, {"contents": single}).json()["totalTokens"]
+
+
+def test_stream_turns_are_recorded_on_shared_client(monkeypatch):
+    """不可缓存的流式请求在主会话上生成：本轮记入快照，带着完整历史的下一轮直接从快照继续"""
+    monkeypatch.setattr(server, "REQUEST_COALESCING", False)
+    monkeypatch.setattr(server, "RESPONSE_CACHE", False)
+    monkeypatch.setattr(server, "_conversation_trie", server.ConversationTrie())
+    main = GeminiClient(secure_1psid="psid", snlm0e="token", bl="bl", session_file=None)
+    monkeypatch.setattr(server, "get_client", lambda: main)
+    sent = []
+
+    def open_stream(**kwargs):
+        sent.append(kwargs)
+        main.conversation_id = "c_1"
+        main.response_id = main.choice_id = f"r_{len(sent)}"
+        return StreamHandle(), iter([f"回复{len(sent)}"])
+
+    monkeypatch.setattr(main, "open_stream", open_stream)
+
+    def stream(contents):
+        async def run():
+            transport = httpx.ASGITransport(app=server.app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://test") as http:
+                return await http.post(
+                    "/v1beta/models/gemini-3.0-flash:streamGenerateContent", json={"contents": contents}, headers=AUTH
+                )
+        return asyncio.run(run())
+
+    q1 = {"role": "user", "parts": [{"text": "问题一"}]}
+    assert "回复1" in stream([q1]).text
+    assert len(main.checkpoints) == 1 and main.checkpoints[0]["reply"] == "回复1"
+
+    q2 = {"role": "user", "parts": [{"text": "问题二"}]}
+    assert "回复2" in stream([q1, {"role": "model", "parts": [{"text": "回复1"}]}, q2]).text
+    # 历史与快照完全匹配：只发送最后一条用户消息，不补发
+    assert sent[1]["text"] == "问题二" and not sent[1]["context"]
+    assert [c["parent"] for c in main.checkpoints] == [None, 1]
+
+
+def _conversation_clients(monkeypatch):
+    """主客户端和独立客户端都是真实的 GeminiClient，只替换上游请求；新对话的第一次请求分配新的 conversation_id"""
+    monkeypatch.setattr(server, "REQUEST_COALESCING", True)
+    monkeypatch.setattr(server, "RESPONSE_CACHE", False)
+    monkeypatch.setattr(server, "_conversation_trie", server.ConversationTrie())
+    monkeypatch.setattr(server, "_isolated_clients", [])
+    sent = []
+
+    def new_client():
+        client = GeminiClient(secure_1psid="psid", snlm0e="token", bl="bl", session_file=None)
+
+        def upstream(text, context):
+            sent.append({"client": client, "text": text, "context": context})
+            if not client.conversation_id:
+                client.conversation_id = f"c_{len(sent)}"
+            client.response_id = client.choice_id = f"r_{len(sent)}"
+            return f"回复{len(sent)}"
+
+        def open_stream(text, context=None, **kwargs):
+            return StreamHandle(), iter([upstream(text, context)])
+
+        def send_request(text, images, model, url_context, tools, system=None, context=None):
+            reply = upstream(text, context)
+            client.record_turn(text, reply, context)
+            return ChatCompletionResponse(
+                id="chatcmpl-test",
+                choices=[ChatCompletionChoice(index=0, message=Message(role="assistant", content=reply))],
+            )
+
+        monkeypatch.setattr(client, "open_stream", open_stream)
+        monkeypatch.setattr(client, "_send_request", send_request)
+        return client
+
+    main = new_client()
+    monkeypatch.setattr(server, "get_client", lambda: main)
+    monkeypatch.setattr(server, "new_isolated_client", new_client)
+    return main, sent
+
+
+def test_fresh_first_turn_continues_on_shared_conversation(monkeypatch):
+    """单条消息的请求在新对话中生成，这一轮记入主会话的快照：下一轮从那段对话继续，不重发第一轮"""
+    for stream in (False, True):
+        main, sent = _conversation_clients(monkeypatch)
+        path = "/v1beta/models/gemini-3.0-flash:" + ("streamGenerateContent" if stream else "generateContent")
+        q1 = {"role": "user", "parts": [{"text": "问题一"}]}
+        assert "回复1" in _post(path, {"contents": [q1]}).text
+        assert sent[0]["client"] is not main and main.head_checkpoint is None
+        assert [(c["parent"], c["state"][0], c["reply"]) for c in main.checkpoints] == [(None, "c_1", "回复1")]
+
+        q2 = {"role": "user", "parts": [{"text": "问题二"}]}
+        assert "回复2" in _post(path, {"contents": [q1, {"role": "model", "parts": [{"text": "回复1"}]}, q2]}).text
+        assert sent[1]["client"] is main and sent[1]["text"] == "问题二" and not sent[1]["context"]
+        assert main.conversation_id == "c_1" and [c["parent"] for c in main.checkpoints] == [None, 1]
+
+
+def test_openai_stateless_request_runs_in_fresh_conversation(monkeypatch):
+    """OpenAI 格式的单条消息请求同样不在主会话已打开的对话中生成，返回的快照 ID 指向主会话"""
+    main, sent = _conversation_clients(monkeypatch)
+    main.conversation_id = "c_open"
+    main.record_turn("别人的问题", "别人的回答")
+
+    first = _post("/v1/chat/completions", {"model": "gemini-3.0-flash", "messages": [{"role": "user", "content": "问题一"}]})
+    assert first.json()["choices"][0]["message"]["content"] == "回复1"
+    assert sent[0]["client"] is not main and main.head_checkpoint == 1
+    assert first.headers["X-Checkpoint-Id"] == "2" and main.get_checkpoint(2)["state"][0] == "c_1"
+
+    second = _post("/v1/chat/completions", {"model": "gemini-3.0-flash", "messages": [
+        {"role": "user", "content": "问题一"},
+        {"role": "assistant", "content": "回复1"},
+        {"role": "user", "content": "问题二"},
+    ]})
+    assert second.json()["choices"][0]["message"]["content"] == "回复2"
+    assert sent[1]["client"] is main and sent[1]["text"] == "问题二" and not sent[1]["context"]
+    assert main.conversation_id == "c_1" and second.headers["X-Checkpoint-Id"] == "3"
+
+
+if __name__ == "__main__":
+    import pytest
+
+    for test in (
+        test_cacheable_request_runs_in_fresh_conversation,
+        test_coalesced_requests_share_fresh_conversation,
+        test_count_tokens_matches_generate_content,
+        test_stream_turns_are_recorded_on_shared_client,
+        test_fresh_first_turn_continues_on_shared_conversation,
+        test_openai_stateless_request_runs_in_fresh_conversation,
+    ):
+        with pytest.MonkeyPatch.context() as mp:
+            test(mp)
+    print("✅ 全部通过")
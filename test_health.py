@@ -0,0 +1,70 @@
+"""
+账号健康状态测试（无需启动服务，不请求 Gemini）
+
+运行: python -m pytest -q test_health.py
+"""
+
+import httpx
+
+from client import GeminiClient
+from health import CREDENTIAL_EXPIRED, CREDENTIAL_OK, CREDENTIAL_UNKNOWN, HealthMonitor, account_label, health
+
+
+def test_passive_signals():
+    monitor = HealthMonitor()
+    assert monitor.snapshot("a1")["credential"] == CREDENTIAL_UNKNOWN
+    assert monitor.snapshot("a1")["last_success"] is None
+
+    monitor.record_success("a1")
+    snapshot = monitor.snapshot("a1")
+    assert snapshot["credential"] == CREDENTIAL_OK and snapshot["last_success_age_seconds"] < 5
+
+    # 网络错误不改变凭证状态，401 / 403 标记失效
+    monitor.record_failure("a1", "连接超时")
+    assert monitor.snapshot("a1")["credential"] == CREDENTIAL_OK
+    assert monitor.snapshot("a1")["last_error"] == "连接超时"
+    monitor.record_failure("a1", "HTTP 401", credential_expired=True)
+    assert monitor.snapshot("a1")["credential"] == CREDENTIAL_EXPIRED
+    # 其他账号互不影响
+    assert monitor.snapshot("a2")["credential"] == CREDENTIAL_UNKNOWN
+
+
+def test_probe_skipped_after_recent_success():
+    monitor = HealthMonitor()
+    assert monitor.needs_probe("a1", 60)
+    monitor.record_success("a1")
+    assert not monitor.needs_probe("a1", 60)
+    assert monitor.needs_probe("a1", 0)
+
+    # 探测无法判断（None）时只记录时间
+    monitor.record_probe("a2", None, "网络错误")
+    assert monitor.snapshot("a2")["credential"] == CREDENTIAL_UNKNOWN
+    assert not monitor.needs_probe("a2", 60)
+    monitor.record_probe("a2", CREDENTIAL_EXPIRED)
+    assert monitor.snapshot("a2")["credential"] == CREDENTIAL_EXPIRED
+
+    monitor.forget("a2")
+    assert monitor.snapshot("a2")["credential"] == CREDENTIAL_UNKNOWN
+
+
+def test_client_records_generation_results():
+    client = GeminiClient(secure_1psid="psid-health", snlm0e="token", bl="bl", session_file=None)
+    assert client.account == account_label("psid-health")
+    request = httpx.Request("POST", "https://gemini.google.com")
+
+    client.session.post = lambda *args, **kwargs: httpx.Response(401, request=request)
+    client._log_gemini_call = lambda *args, **kwargs: None  # 不写 api_logs.json
+    try:
+        client.chat(messages=[{"role": "user", "content": "你好"}])
+    except Exception:
+        pass
+    snapshot = health.snapshot(client.account)
+    assert snapshot["credential"] == CREDENTIAL_EXPIRED and "401" in snapshot["last_error"]
+    health.forget(client.account)
+
+
+if __name__ == "__main__":
+    test_passive_signals()
+    test_probe_skipped_after_recent_success()
+    test_client_records_generation_results()
+    print("✅ 全部通过")
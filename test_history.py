@@ -0,0 +1,81 @@
+"""
+消息历史窗口测试（无需启动服务）
+
+运行: python -m pytest -q test_history.py
+"""
+
+import os
+import tempfile
+
+import tokens
+from client import GeminiClient, Message
+from history import SUMMARY_PREFIX, MessageHistory, extractive_summary, message_cost
+
+
+def _turns(history, n, reply="回复"):
+    for i in range(n):
+        history.append(Message(role="user", content=f"问题 {i}"))
+        history.append(Message(role="assistant", content=f"{reply} {i}"))
+
+
+def test_evicts_whole_turns_and_tracks_tokens():
+    history = MessageHistory(Message, max_messages=5)
+    _turns(history, 4)
+    # 超出条数时成对淘汰，不留下开头孤立的助手回复
+    assert [m.content for m in history] == ["问题 2", "回复 2", "问题 3", "回复 3"]
+    assert history.tokens == sum(message_cost(m) for m in history)
+    assert history.tokens + tokens.REPLY_OVERHEAD == tokens.count_messages(list(history))
+    assert history[-1].content == "回复 3" and history[0].content == "问题 2"
+
+
+def test_token_budget_keeps_latest_message():
+    history = MessageHistory(Message, max_messages=100)
+    _turns(history, 10, reply="很长的回复" * 20)
+    total = history.tokens
+    history.max_tokens = total // 2
+    history.trim()
+    assert history.tokens <= total // 2 and history[0].role == "user"
+    # 单条消息本身超出预算时仍然保留
+    history.append(Message(role="user", content="超长" * 10000))
+    assert len(history) == 1 and history.tokens > history.max_tokens
+
+
+def test_summarized_eviction_survives_reload():
+    history = MessageHistory(Message, max_messages=4, summarize=extractive_summary)
+    _turns(history, 3)
+    assert history[0].role == "system" and history.summary == "用户：问题 0\n助手：回复 0"
+    assert [m.content for m in history][1:] == ["问题 1", "回复 1", "问题 2", "回复 2"]
+    assert history.tokens == sum(message_cost(m) for m in history)
+
+    restored = MessageHistory(Message, max_messages=4, summarize=extractive_summary)
+    restored.replace(list(history))
+    assert restored.summary == history.summary and len(restored) == len(history)
+    assert list(history)[0].content.startswith(SUMMARY_PREFIX)
+
+
+def test_client_budget_per_model():
+    path = os.path.join(tempfile.mkdtemp(), "conversation_state.json")
+    client = GeminiClient(secure_1psid="psid", snlm0e="token", bl="bl", session_file=path)
+    client.history_token_limits = {"small": 40}
+    for i in range(10):
+        client.record_turn(f"问题 {i}", "回复" * 10)
+    assert len(client.messages) == 20
+    client._apply_history_budget("models/small")
+    assert client.messages.tokens <= 40 and len(client.messages) < 20
+    client._apply_history_budget("unknown")
+    assert client.messages.max_tokens is None
+
+    client.max_history_messages = 2
+    assert [m.content for m in client.messages] == ["问题 9", "回复" * 10]
+    # 会话状态文件中保存的是最后一轮结束时的历史，恢复时重新计算 token 数
+    reloaded = GeminiClient(secure_1psid="psid", snlm0e="token", bl="bl", session_file=path)
+    assert len(reloaded.messages) == 20
+    assert reloaded.messages.tokens + tokens.REPLY_OVERHEAD == tokens.count_messages(list(reloaded.messages))
+
+
+if __name__ == "__main__":
+    test_evicts_whole_turns_and_tracks_tokens()
+    test_token_budget_keeps_latest_message()
+    test_summarized_eviction_survives_reload()
+    test_client_budget_per_model()
+    print("✅ 全部通过")
@@ -0,0 +1,42 @@
+"""
+JSON 编解码测试（无需启动服务）
+
+运行: python -m pytest -q test_jsoncodec.py
+"""
+
+import json
+
+import pytest
+
+import jsoncodec
+
+
+def test_round_trip():
+    obj = {"text": "你好 \"引号\" \n", "n": [1, 2.5, None, True]}
+    assert jsoncodec.loads(jsoncodec.dumps(obj)) == obj
+    assert jsoncodec.loads(jsoncodec.dumps_bytes(obj)) == obj
+    # 紧凑格式、不转义中文
+    assert jsoncodec.dumps({"a": "中"}) == '{"a":"中"}'
+
+
+def test_decode_error_type():
+    with pytest.raises(json.JSONDecodeError):
+        jsoncodec.loads("[1,")
+
+
+def test_fallback_types():
+    # orjson 不支持非字符串键，回退到标准库
+    assert json.loads(jsoncodec.dumps_bytes({1: "a"})) == {"1": "a"}
+
+
+def test_stdlib_backend_matches():
+    obj = {"choices": [{"delta": {"content": "😀"}}]}
+    assert jsoncodec._stdlib_dumps(obj) == json.dumps(obj, ensure_ascii=False, separators=(",", ":"))
+    assert jsoncodec._stdlib_loads(b'{"a":1}') == {"a": 1}
+
+
+if __name__ == "__main__":
+    test_round_trip()
+    test_fallback_types()
+    test_stdlib_backend_matches()
+    print("✅ 全部通过")
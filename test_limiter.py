@@ -0,0 +1,209 @@
+"""
+账号并发限制器 / 优先级调度测试（无需启动服务）
+
+运行: python -m pytest -q test_limiter.py
+"""
+
+import asyncio
+
+import pytest
+
+from limiter import AccountLimiter, AdmissionError, SlotGroup
+from metrics import metrics
+from scheduler import FairQueue
+
+
+def test_fifo_handoff():
+    """槽位释放后按 FIFO 顺序转交给等待者"""
+    async def run():
+        limiter = AccountLimiter("t1", max_concurrency=1, max_queue=4, queue_timeout=5)
+        order = []
+        first = await limiter.acquire()
+
+        async def worker(name):
+            slot = await limiter.acquire()
+            order.append(name)
+            slot.release()
+
+        tasks = [asyncio.create_task(worker(n)) for n in ("a", "b", "c")]
+        await asyncio.sleep(0)
+        assert limiter.queue_depth == 3
+        first.release()
+        await asyncio.gather(*tasks)
+        assert order == ["a", "b", "c"]
+        assert limiter.active == 0
+        assert limiter.queue_depth == 0
+
+    asyncio.run(run())
+
+
+def test_queue_full_rejects_fast():
+    async def run():
+        limiter = AccountLimiter("t2", max_concurrency=1, max_queue=1, queue_timeout=5)
+        slot = await limiter.acquire()
+        waiter = asyncio.create_task(limiter.acquire())
+        await asyncio.sleep(0)
+        with pytest.raises(AdmissionError) as exc:
+            await limiter.acquire()
+        assert exc.value.reason == "queue_full"
+        assert exc.value.retry_after >= 1
+        slot.release()
+        (await waiter).release()
+
+    asyncio.run(run())
+
+
+def test_queue_timeout():
+    async def run():
+        limiter = AccountLimiter("t3", max_concurrency=1, max_queue=4, queue_timeout=0.05)
+        slot = await limiter.acquire()
+        with pytest.raises(AdmissionError) as exc:
+            await limiter.acquire()
+        assert exc.value.reason == "timeout"
+        assert limiter.queue_depth == 0
+        slot.release()
+        assert limiter.active == 0
+        assert metrics.get("gemini_account_rejected_total", account="t3", reason="timeout") == 1
+
+    asyncio.run(run())
+
+
+def test_cancelled_waiter_does_not_leak_slot():
+    async def run():
+        limiter = AccountLimiter("t4", max_concurrency=1, max_queue=4, queue_timeout=5)
+        slot = await limiter.acquire()
+        waiter = asyncio.create_task(limiter.acquire())
+        await asyncio.sleep(0)
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+        slot.release()
+        slot.release()  # 重复释放无副作用
+        assert limiter.active == 0
+        again = await limiter.acquire()
+        again.release()
+
+    asyncio.run(run())
+
+
+def test_priority_order():
+    """高优先级请求先于已排队的低优先级请求执行"""
+    async def run():
+        limiter = AccountLimiter("t5", max_concurrency=1, max_queue=8, queue_timeout=5)
+        order = []
+        first = await limiter.acquire()
+
+        async def worker(name, priority):
+            slot = await limiter.acquire(priority=priority, key=name)
+            order.append(name)
+            slot.release()
+
+        tasks = [asyncio.create_task(worker("batch", "batch"))]
+        await asyncio.sleep(0)
+        tasks.append(asyncio.create_task(worker("agent", "agent")))
+        await asyncio.sleep(0)
+        tasks.append(asyncio.create_task(worker("chat", "interactive")))
+        await asyncio.sleep(0)
+        first.release()
+        await asyncio.gather(*tasks)
+        assert order == ["chat", "agent", "batch"]
+
+    asyncio.run(run())
+
+
+def test_fair_queue_interleaves_keys():
+    """同一优先级内，多个 API Key 轮流获得执行机会"""
+    queue = FairQueue()
+    for i in range(4):
+        queue.push(object(), "batch", "heavy")
+    queue.push(object(), "batch", "light")
+    queue.push(object(), "batch", "light")
+    order = []
+    while len(queue):
+        order.append(queue._pop_head().key)
+    assert order[:4] == ["heavy", "light", "heavy", "light"]
+
+
+def test_weighted_fair_queue():
+    queue = FairQueue(weights={"gold": 2.0})
+    for i in range(4):
+        queue.push(object(), "batch", "gold")
+        queue.push(object(), "batch", "std")
+    order = [queue._pop_head().key for _ in range(6)]
+    assert order.count("gold") == 4
+
+
+def test_preempt_low_priority_when_full():
+    async def run():
+        limiter = AccountLimiter("t6", max_concurrency=1, max_queue=1, queue_timeout=5)
+        slot = await limiter.acquire()
+        low = asyncio.create_task(limiter.acquire(priority="batch"))
+        await asyncio.sleep(0)
+        high = asyncio.create_task(limiter.acquire(priority="interactive"))
+        await asyncio.sleep(0)
+        with pytest.raises(AdmissionError) as exc:
+            await low
+        assert exc.value.reason == "preempted"
+        slot.release()
+        (await high).release()
+        assert limiter.active == 0
+        assert metrics.quantile("gemini_scheduler_wait_seconds", 0.5, priority="interactive") >= 0
+
+    asyncio.run(run())
+
+
+def test_slot_group_releases_all():
+    """模型 + 账号槽位一起释放，重复释放无副作用"""
+    async def run():
+        model = AccountLimiter("model:pro", max_concurrency=1)
+        account = AccountLimiter("t9", max_concurrency=2)
+        group = SlotGroup(await model.acquire(), await account.acquire())
+        assert model.active == 1 and account.active == 1
+        group.release()
+        group.release()
+        assert group.released
+        assert model.active == 0 and account.active == 0
+
+    asyncio.run(run())
+
+
+def test_resize_wakes_waiters():
+    """调大上限后立即放行排队中的请求；调小后释放的槽位不再转交，直到降到新上限以内"""
+    async def run():
+        limiter = AccountLimiter("t10", max_concurrency=1, max_queue=4, queue_timeout=5)
+        first = await limiter.acquire()
+        tasks = [asyncio.create_task(limiter.acquire()) for _ in range(3)]
+        await asyncio.sleep(0)
+        assert limiter.queue_depth == 3
+
+        limiter.resize(3)
+        assert limiter.active == 3 and limiter.queue_depth == 1
+        slots = [first, await tasks[0], await tasks[1]]
+        assert not tasks[2].done()
+
+        limiter.resize(1)
+        slots[0].release()
+        slots[1].release()
+        await asyncio.sleep(0)
+        assert limiter.active == 1 and limiter.queue_depth == 1
+        slots[2].release()
+        await asyncio.sleep(0)
+        assert limiter.active == 1 and limiter.queue_depth == 0
+        (await tasks[-1]).release()
+        assert limiter.active == 0
+
+    asyncio.run(run())
+
+
+if __name__ == "__main__":
+    test_fifo_handoff()
+    test_queue_full_rejects_fast()
+    test_queue_timeout()
+    test_cancelled_waiter_does_not_leak_slot()
+    test_priority_order()
+    test_fair_queue_interleaves_keys()
+    test_weighted_fair_queue()
+    test_preempt_low_priority_when_full()
+    test_slot_group_releases_all()
+    test_resize_wakes_waiters()
+    print("✅ 全部通过")
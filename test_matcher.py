@@ -0,0 +1,125 @@
+"""
+对话前缀匹配测试（无需启动服务，不请求 Gemini）
+
+运行: python -m pytest -q test_matcher.py
+"""
+
+from client import GeminiClient
+from matcher import ConversationTrie, Match, checkpoint_keys, dialog_messages, message_key
+
+
+def _keys(*pairs):
+    return [message_key(role, content) for role, content in pairs]
+
+
+def _client():
+    return GeminiClient(secure_1psid="psid", snlm0e="token", bl="bl", session_file=None)
+
+
+def _turn(client, n, user, reply, context=None):
+    """模拟一轮对话：上游返回新的 response_id / choice_id 后记录本轮"""
+    client.conversation_id = "c_1"
+    client.response_id = f"r_{n}"
+    client.choice_id = f"rc_{n}"
+    client.record_turn(user, reply, context)
+
+
+def test_longest_prefix():
+    trie = ConversationTrie()
+    trie.add(1, None, _keys(("user", "q1"), ("assistant", "a1")))
+    trie.add(2, 1, _keys(("user", "q2"), ("assistant", "a2")))
+    trie.add(3, 1, _keys(("user", "q2 改"), ("assistant", "a2'")))
+
+    assert trie.match(_keys(("user", "q1"), ("assistant", "a1"), ("user", "q2"), ("assistant", "a2"))) == Match(2, 4)
+    assert trie.match(_keys(("user", "q1"), ("assistant", "a1"), ("user", "q2 改"), ("assistant", "a2'"))) == Match(3, 4)
+    # 部分匹配：停在最深的快照，之后的消息需要补发
+    assert trie.match(_keys(("user", "q1"), ("assistant", "a1"), ("user", "q2"), ("assistant", "别的回复"))) == Match(1, 2)
+    # 首尾空白、内容列表中的文本与字符串等价
+    assert trie.match(_keys(("user", [{"type": "text", "text": "q1"}]), ("assistant", " a1\n"))) == Match(1, 2)
+    assert trie.match(_keys(("user", "无关"), ("assistant", "a1"))) == Match(None, 0)
+    assert trie.match([]) == Match(None, 0)
+
+
+def test_sync_adds_new_and_drops_evicted():
+    client = _client()
+    client.max_checkpoints = 3
+    trie = ConversationTrie()
+    for n in (1, 2):
+        _turn(client, n, f"q{n}", f"a{n}")
+    assert trie.sync(client.checkpoints) == 2 and trie.sync(client.checkpoints) == 0
+
+    for n in (3, 4, 5):
+        _turn(client, n, f"q{n}", f"a{n}")
+    assert trie.sync(client.checkpoints) == 3
+    assert len(trie) == 3 and 2 not in trie and 5 in trie
+    # 淘汰的快照不再匹配，但它之后的快照仍然可以通过完整历史匹配
+    history = _keys(*[(r, f"{p}{n}") for n in range(1, 6) for r, p in (("user", "q"), ("assistant", "a"))])
+    assert trie.match(history[:4]) == Match(None, 0)
+    assert trie.match(history) == Match(5, 10)
+
+    # 会话被重置后快照 ID 继续递增，旧快照全部丢弃
+    client.reset()
+    _turn(client, 1, "新的问题", "新的回答")
+    assert client.checkpoints[-1]["id"] == 6
+    assert trie.sync(client.checkpoints) == 1
+    assert len(trie) == 1 and trie.match(_keys(("user", "新的问题"), ("assistant", "新的回答"))) == Match(6, 2)
+    assert trie.match(history) == Match(None, 0)
+
+
+def test_reset_does_not_reuse_checkpoint_ids():
+    """重置后的第一轮不能沿用旧对话第一轮的 ID，否则旧历史会被路由到新对话上"""
+    client = _client()
+    trie = ConversationTrie()
+    _turn(client, 1, "q1", "a1")
+    trie.sync(client.checkpoints)
+
+    client.reset()
+    _turn(client, 1, "另一个问题", "另一个回答")
+    assert trie.sync(client.checkpoints) == 1
+    assert trie.match(_keys(("user", "q1"), ("assistant", "a1"))) == Match(None, 0)
+    assert trie.match(_keys(("user", "另一个问题"), ("assistant", "另一个回答"))) == Match(2, 2)
+
+
+def test_context_is_recorded_and_replayed():
+    client = _client()
+    calls = []
+    client._send_request = lambda text, images, model, url_context, tools, system=None, context=None: calls.append(
+        client._apply_context(text, client._context_messages(context))
+    )
+    context = [{"role": "user", "content": "早先的问题"}, {"role": "assistant", "content": "早先的回答"}]
+    client.chat(messages=[{"role": "user", "content": "现在的问题"}], context=context)
+    assert "用户：早先的问题\n助手：早先的回答" in calls[0] and calls[0].endswith("现在的问题")
+    assert [m.content for m in client.messages] == ["早先的问题", "早先的回答", "现在的问题"]
+
+    # 补发的历史记入快照，之后带着完整历史的请求可以直接匹配
+    client.messages.clear()
+    _turn(client, 1, "现在的问题", "现在的回答", context)
+    checkpoint = client.checkpoints[-1]
+    assert checkpoint["context"] == context
+    assert checkpoint_keys(checkpoint) == _keys(
+        ("user", "早先的问题"), ("assistant", "早先的回答"), ("user", "现在的问题"), ("assistant", "现在的回答")
+    )
+    client.fork(1)
+    assert [m["content"] for m in client.get_history()] == ["早先的问题", "早先的回答", "现在的问题", "现在的回答"]
+
+
+def test_dialog_messages():
+    messages = [
+        {"role": "system", "content": "规则"},
+        {"role": "user", "content": "q1"},
+        {"role": "assistant", "content": "a1"},
+        {"role": "tool", "content": "结果"},
+        {"role": "user", "content": "q2"},
+        {"role": "assistant", "content": "预填的回复"},
+    ]
+    assert [m["content"] for m in dialog_messages(messages)] == ["q1", "a1", "q2"]
+    assert dialog_messages([{"role": "system", "content": "规则"}]) == []
+
+
+if __name__ == "__main__":
+    test_longest_prefix()
+    test_sync_adds_new_and_drops_evicted()
+    test_reset_does_not_reuse_checkpoint_ids()
+    test_context_is_recorded_and_replayed()
+    test_dialog_messages()
+    print("✅ 全部通过")
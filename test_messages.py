@@ -0,0 +1,48 @@
+"""
+消息与响应对象测试（无需启动服务）
+
+运行: python -m pytest -q test_messages.py
+"""
+
+import dataclasses
+import json
+import sys
+
+import pytest
+
+from client import ChatCompletionChoice, ChatCompletionResponse, Message, Usage
+
+
+def test_message_is_compact_and_immutable():
+    role = json.loads('{"role": "user"}')["role"]
+    message = Message(role=role, content="你好")
+    # 从 JSON 解析出来的 role 驻留后与字面量是同一个对象
+    assert role is not sys.intern("user") and message.role is sys.intern("user")
+    assert not hasattr(message, "__dict__")
+    with pytest.raises(dataclasses.FrozenInstanceError):
+        message.content = "改写"
+    assert message == Message(role="user", content="你好")
+
+
+def test_response_to_dict():
+    response = ChatCompletionResponse(
+        id="chatcmpl-1",
+        created=1,
+        model="m",
+        choices=[ChatCompletionChoice(index=0, message=Message(role="assistant", content="hi"))],
+        usage=Usage(prompt_tokens=3, completion_tokens=1, total_tokens=4),
+    )
+    assert response.to_dict() == {
+        "id": "chatcmpl-1",
+        "object": "chat.completion",
+        "created": 1,
+        "model": "m",
+        "choices": [{"index": 0, "message": {"role": "assistant", "content": "hi"}, "finish_reason": "stop"}],
+        "usage": {"prompt_tokens": 3, "completion_tokens": 1, "total_tokens": 4},
+    }
+
+
+if __name__ == "__main__":
+    test_message_is_compact_and_immutable()
+    test_response_to_dict()
+    print("✅ 全部通过")
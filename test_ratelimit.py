@@ -0,0 +1,75 @@
+"""
+API Key 令牌桶限流测试（无需启动服务）
+
+运行: python -m pytest -q test_ratelimit.py
+"""
+
+import pytest
+
+from ratelimit import MemoryBackend, RateLimiter, RateLimitExceeded, SQLiteBackend
+
+
+def _limiters(tmp_path):
+    return [
+        RateLimiter(MemoryBackend()),
+        RateLimiter(SQLiteBackend(str(tmp_path / "ratelimit.db"))),
+    ]
+
+
+def test_requests_bucket(tmp_path):
+    for limiter in _limiters(tmp_path):
+        now = 1000.0
+        for i in range(3):
+            result = limiter.check("k", rpm=3, cpm=1000, chars=10, now=now)
+        assert result.remaining_requests == 0
+        with pytest.raises(RateLimitExceeded) as exc:
+            limiter.check("k", rpm=3, cpm=1000, chars=10, now=now)
+        headers = exc.value.result.headers()
+        assert headers["x-ratelimit-limit-requests"] == "3"
+        assert int(headers["Retry-After"]) >= 1
+        # 20 秒后补充 1 个请求
+        limiter.check("k", rpm=3, cpm=1000, chars=10, now=now + 20)
+
+
+def test_chars_bucket_and_charge(tmp_path):
+    for limiter in _limiters(tmp_path):
+        now = 2000.0
+        limiter.check("k", rpm=100, cpm=600, chars=100, now=now)
+        limiter.charge("k", cpm=600, chars=450, now=now)
+        with pytest.raises(RateLimitExceeded):
+            limiter.check("k", rpm=100, cpm=600, chars=100, now=now)
+        # 拒绝时不扣减请求数
+        result = limiter.check("k", rpm=100, cpm=600, chars=10, now=now)
+        assert result.remaining_requests == 98
+        # 每秒补充 10 个字符
+        limiter.check("k", rpm=100, cpm=600, chars=100, now=now + 10)
+
+
+def test_keys_are_isolated(tmp_path):
+    for limiter in _limiters(tmp_path):
+        limiter.check("a", rpm=1, cpm=100, now=3000.0)
+        with pytest.raises(RateLimitExceeded):
+            limiter.check("a", rpm=1, cpm=100, now=3000.0)
+        limiter.check("b", rpm=1, cpm=100, now=3000.0)
+
+
+def test_sqlite_shared_between_instances(tmp_path):
+    """两个进程（这里用两个实例模拟）共享同一个数据库文件中的限额"""
+    path = str(tmp_path / "shared.db")
+    first = RateLimiter(SQLiteBackend(path))
+    second = RateLimiter(SQLiteBackend(path))
+    first.check("k", rpm=2, cpm=100, now=4000.0)
+    second.check("k", rpm=2, cpm=100, now=4000.0)
+    with pytest.raises(RateLimitExceeded):
+        first.check("k", rpm=2, cpm=100, now=4000.0)
+
+
+if __name__ == "__main__":
+    import pathlib
+    import tempfile
+    tmp = pathlib.Path(tempfile.mkdtemp())
+    test_requests_bucket(tmp)
+    test_chars_bucket_and_charge(tmp)
+    test_keys_are_isolated(tmp)
+    test_sqlite_shared_between_instances(tmp)
+    print("✅ 全部通过")
@@ -0,0 +1,143 @@
+"""
+SSE 输出测试（无需启动服务）
+
+运行: python -m pytest -q test_sse.py
+"""
+
+import asyncio
+import json
+import time
+
+import pytest
+
+from sse import DONE, GeminiChunkEncoder, OpenAIChunkEncoder, coalesce, heartbeat, pace, split_chunks
+
+
+def _data(chunk: bytes):
+    assert chunk.startswith(b"data: ") and chunk.endswith(b"\n\n")
+    return json.loads(chunk[6:-2])
+
+
+def test_openai_template_matches_full_serialization():
+    encoder = OpenAIChunkEncoder("chatcmpl-1", 1700000000, "gemini-3.0-flash")
+    text = '你好 "引号" \\ \n\t 😀 \x00'
+    assert _data(encoder.content(text)) == {
+        "id": "chatcmpl-1",
+        "object": "chat.completion.chunk",
+        "created": 1700000000,
+        "model": "gemini-3.0-flash",
+        "choices": [{"index": 0, "delta": {"content": text}, "finish_reason": None}],
+    }
+    assert _data(encoder.role())["choices"][0]["delta"] == {"role": "assistant"}
+    assert _data(encoder.finish())["choices"][0]["finish_reason"] == "stop"
+    assert DONE == b"data: [DONE]\n\n"
+
+
+def test_gemini_template():
+    encoder = GeminiChunkEncoder()
+    assert _data(encoder.text("hi"))["candidates"][0]["content"]["parts"] == [{"text": "hi"}]
+    assert _data(encoder.FINISH) == {"candidates": [{"finishReason": "STOP"}]}
+
+
+async def _deltas(schedule, error=None):
+    for delay, text in schedule:
+        await asyncio.sleep(delay)
+        yield text
+    if error is not None:
+        raise error
+
+
+def _collect(deltas, window):
+    async def run():
+        return [chunk async for chunk in coalesce(deltas, window)]
+    return asyncio.run(run())
+
+
+def test_coalesce_merges_within_window():
+    schedule = [(0, "a"), (0, "b"), (0.001, "c"), (0.1, "d"), (0, "e")]
+    assert _collect(_deltas(schedule), 0.05) == ["abc", "de"]
+
+
+def test_coalesce_disabled():
+    schedule = [(0, "a"), (0, "b")]
+    assert _collect(_deltas(schedule), 0) == ["a", "b"]
+
+
+def test_coalesce_flushes_before_error():
+    chunks = []
+
+    async def run():
+        async for chunk in coalesce(_deltas([(0, "a"), (0, "b")], RuntimeError("boom")), 0.05):
+            chunks.append(chunk)
+
+    with pytest.raises(RuntimeError):
+        asyncio.run(run())
+    assert chunks == ["ab"]
+
+
+def test_coalesce_close_closes_source():
+    closed = []
+
+    async def source():
+        try:
+            yield "a"
+            await asyncio.sleep(10)
+            yield "b"
+        finally:
+            closed.append(True)
+
+    async def run():
+        deltas = coalesce(source(), 0.01)
+        assert await deltas.__anext__() == "a"
+        await deltas.aclose()
+
+    asyncio.run(run())
+    assert closed
+
+
+def test_heartbeat_while_idle():
+    async def run():
+        schedule = [(0.12, "a"), (0, "b")]
+        return [chunk async for chunk in heartbeat(_deltas(schedule), 0.05)]
+
+    chunks = asyncio.run(run())
+    # 第一个增量到达前输出心跳，读取不会因为心跳被打断
+    assert chunks[:2] == [None, None]
+    assert [c for c in chunks if c is not None] == ["a", "b"]
+
+
+def test_split_chunks_aligned():
+    text = "Hello world, this is a test. 这是一个测试句子。再来一句！" * 5
+    chunks = list(split_chunks(text, 32))
+    assert "".join(chunks) == text
+    assert all(len(c) <= 32 for c in chunks)
+    # 在句末或单词边界断开
+    assert all(c[-1] in ".。！, " for c in chunks[:-1])
+    # 没有边界时按长度硬切
+    assert list(split_chunks("a" * 70, 30)) == ["a" * 30, "a" * 30, "a" * 10]
+    assert list(split_chunks("", 30)) == []
+
+
+def test_pace():
+    async def collect(rate):
+        return [chunk async for chunk in pace(["ab"] * 5, rate)]
+
+    start = time.perf_counter()
+    assert asyncio.run(collect(0)) == ["ab"] * 5
+    assert time.perf_counter() - start < 0.05
+    start = time.perf_counter()
+    asyncio.run(collect(100))
+    # 第 5 块要等前 8 字节按 100 B/s 发完
+    assert time.perf_counter() - start >= 0.07
+
+
+if __name__ == "__main__":
+    test_openai_template_matches_full_serialization()
+    test_gemini_template()
+    test_coalesce_merges_within_window()
+    test_coalesce_disabled()
+    test_coalesce_close_closes_source()
+    test_heartbeat_while_idle()
+    test_split_chunks_aligned()
+    test_pace()
+    print("✅ 全部通过")
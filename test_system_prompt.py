@@ -0,0 +1,63 @@
+"""
+系统提示词只发送一次的测试（无需启动服务，不请求 Gemini）
+
+运行: python -m pytest -q test_system_prompt.py
+"""
+
+from client import GeminiClient, system_prompt_hash
+
+
+def _client():
+    return GeminiClient(secure_1psid="psid", snlm0e="token", bl="bl", session_file=None)
+
+
+def test_sent_on_new_conversation_and_when_changed():
+    client = _client()
+    text, system_hash = client._apply_system_prompt("你好", "你是翻译助手")
+    assert "你是翻译助手" in text and text.endswith("你好")
+    assert system_hash == system_prompt_hash("你是翻译助手")
+
+    # 本轮成功后会话记住了系统提示词，之后的轮次只发送用户消息
+    client.conversation_id, client.system_hash = "c_1", system_hash
+    assert client._apply_system_prompt("第二轮", "你是翻译助手") == ("第二轮", system_hash)
+
+    # 内容变化时重新发送
+    text, new_hash = client._apply_system_prompt("第三轮", "你是代码助手")
+    assert "你是代码助手" in text and new_hash != system_hash
+
+    # 没有系统提示词时不改变会话状态
+    assert client._apply_system_prompt("第四轮", None) == ("第四轮", system_hash)
+
+
+def test_chat_passes_system_messages():
+    client = _client()
+    calls = []
+    client._send_request = lambda text, images, model, url_context, tools, system=None, context=None: calls.append((text, system))
+    client.chat(messages=[
+        {"role": "system", "content": "规则一"},
+        {"role": "system", "content": [{"type": "text", "text": "规则二"}]},
+        {"role": "user", "content": "问题"},
+    ])
+    assert calls == [("问题", "规则一\n\n规则二")]
+    # 系统提示词不进入消息历史
+    assert [m.role for m in client.messages] == ["user"]
+
+
+def test_fork_restores_system_hash():
+    client = _client()
+    client.conversation_id, client.response_id, client.choice_id = "c_1", "r_1", "rc_1"
+    client.system_hash = system_prompt_hash("旧提示词")
+    client.record_turn("q1", "a1")
+    client.system_hash = system_prompt_hash("新提示词")
+    client.record_turn("q2", "a2")
+    client.fork(1)
+    assert client.system_hash == system_prompt_hash("旧提示词")
+    client.fork(None)
+    assert client.system_hash == ""
+
+
+if __name__ == "__main__":
+    test_sent_on_new_conversation_and_when_changed()
+    test_chat_passes_system_messages()
+    test_fork_restores_system_hash()
+    print("✅ 全部通过")
@@ -0,0 +1,67 @@
+"""
+Token 估算测试（无需启动服务）
+
+运行: python -m pytest -q test_tokens.py
+"""
+
+import tokens
+
+
+def test_count_text_by_script():
+    assert tokens.count_text("") == 0
+    # 英文约 4 个字符 1 个 token，而不是按字符数计
+    english = "The quick brown fox jumps over the lazy dog. " * 10
+    assert len(english) / 5 < tokens.count_text(english) < len(english) / 3
+    # 中文约 1.5 个字符 1 个 token
+    chinese = "今天天气很好，我们去公园散步吧。" * 10
+    assert tokens.count_text(chinese) == 107
+    assert tokens.count_text("Привет") == 3
+    # 韩文音节按中日韩比率；泰文、天城文、韩文字母（jamo）虽然也是 3 字节 UTF-8，按其他文字计
+    assert tokens.count_text("안녕하세요") == 4
+    assert tokens.count_text("สวัสดีครับ") == 5
+    assert tokens.count_text("नमस्ते") == 3
+    assert tokens.count_text("\u1112\u1161\u11ab") == 2
+
+
+def test_cache_is_bounded(monkeypatch):
+    monkeypatch.setattr(tokens, "CACHE_SIZE", 8)
+    tokens.clear_cache()
+    long_text = "很长的提示词" * 100000
+    assert tokens.count_text(long_text) == 400000
+    for i in range(20):
+        tokens.count_text(f"第 {i} 条")
+    # 缓存只保存 token 数，条数不超过上限
+    assert len(tokens._cache) == 8
+    assert all(isinstance(count, int) for count in tokens._cache.values())
+    assert tokens.count_text(long_text) == 400000
+
+
+def test_count_content_and_messages():
+    content = [
+        {"type": "text", "text": "describe"},
+        {"type": "image_url", "image_url": {"url": "data:image/png;base64,AAAA"}},
+    ]
+    assert tokens.count_content(content) == 2 + tokens.IMAGE_TOKENS
+    assert tokens.count_content([{"text": "hi"}, {"inlineData": {"data": "AAAA"}}]) == 1 + tokens.IMAGE_TOKENS
+    messages = [
+        {"role": "user", "content": "hello there"},
+        {"role": "assistant", "content": "hi"},
+        {"role": "user", "content": content},
+    ]
+    # 完整历史都计入，而不只是最后一条用户消息
+    expected = tokens.REPLY_OVERHEAD + 3 * tokens.MESSAGE_OVERHEAD + 3 + 1 + 2 + tokens.IMAGE_TOKENS
+    assert tokens.count_messages(messages) == expected
+
+
+def test_usage():
+    assert tokens.usage(10, "abcdefgh") == {"prompt_tokens": 10, "completion_tokens": 2, "total_tokens": 12}
+
+
+if __name__ == "__main__":
+    test_count_text_by_script()
+    import pytest
+    with pytest.MonkeyPatch.context() as mp:
+        test_cache_is_bounded(mp)
+    test_count_content_and_messages()
+    test_usage()
+    print("✅ 全部通过")
@@ -0,0 +1,175 @@
+"""
+上游流取消测试（无需启动服务）
+
+运行: python -m pytest -q test_upstream.py
+"""
+
+import asyncio
+import threading
+
+import upstream as upstream_module
+from client import StreamHandle
+from metrics import metrics
+from upstream import UpstreamStream
+
+
+class FakeClient:
+    """模拟 GeminiClient 的流式接口"""
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.handles = []
+        self.closed = False
+
+    @property
+    def cancelled(self):
+        return any(handle.cancelled for handle in self.handles)
+
+    def open_stream(self, **kwargs):
+        handle = StreamHandle()
+        self.handles.append(handle)
+        return handle, self._send_stream_request(**kwargs)
+
+    def _send_stream_request(self, **kwargs):
+        try:
+            for chunk in self.chunks:
+                yield chunk
+        finally:
+            self.closed = True
+
+
+class FakeRequest:
+    """第 n 次检查后报告客户端已断开"""
+
+    def __init__(self, disconnect_after):
+        self.checks = 0
+        self.disconnect_after = disconnect_after
+
+    async def is_disconnected(self):
+        self.checks += 1
+        return self.checks > self.disconnect_after
+
+
+async def _collect(upstream):
+    received = []
+    try:
+        async for chunk in upstream:
+            received.append(chunk)
+    finally:
+        upstream.close()
+    return received
+
+
+def test_full_stream():
+    client = FakeClient(["a", "b", "c"])
+    upstream = UpstreamStream(client, FakeRequest(disconnect_after=100), text="hi")
+    assert asyncio.run(_collect(upstream)) == ["a", "b", "c"]
+    assert not upstream.cancelled
+    assert not client.cancelled
+    assert client.closed
+
+
+def test_disconnect_cancels_upstream():
+    metrics.reset()
+    client = FakeClient(["a", "b", "c", "d"])
+    upstream = UpstreamStream(client, FakeRequest(disconnect_after=2), text="hi")
+    assert asyncio.run(_collect(upstream)) == ["a", "b"]
+    assert upstream.cancelled
+    assert client.cancelled
+    assert client.closed
+    assert metrics.get("gemini_stream_cancelled_total") == 1
+
+
+def test_close_before_finish():
+    client = FakeClient(["a", "b"])
+    upstream = UpstreamStream(client, text="hi")
+
+    async def first_only():
+        chunk = await upstream.__anext__()
+        upstream.close()
+        upstream.close()
+        return chunk
+
+    assert asyncio.run(first_only()) == "a"
+    assert upstream.cancelled
+    assert client.closed
+
+
+def test_cancel_only_affects_own_stream():
+    """同一客户端上的两个并发流：取消一个不影响另一个"""
+    client = FakeClient(["a", "b", "c"])
+    first = UpstreamStream(client, text="1")
+    second = UpstreamStream(client, text="2")
+
+    async def run():
+        await first.__anext__()
+        await second.__anext__()
+        first.close()
+        return [chunk async for chunk in second]
+
+    assert asyncio.run(run()) == ["b", "c"]
+    assert first.cancelled and client.handles[0].cancelled
+    assert not second.cancelled and not client.handles[1].cancelled
+
+
+def test_client_stream_handles_are_independent():
+    """GeminiClient 每个流各自的取消状态，取消一个流只关闭它自己的上游响应"""
+    from client import GeminiClient
+
+    gemini = GeminiClient(secure_1psid="psid", snlm0e="token", bl="bl", session_file=None)
+    first, _ = gemini.open_stream(text="1")
+    second, _ = gemini.open_stream(text="2")
+
+    class Response:
+        closed = False
+
+        def close(self):
+            self.closed = True
+
+    first.response, second.response = Response(), Response()
+    first.cancel()
+    assert first.cancelled and first.response.closed
+    assert not second.cancelled and not second.response.closed
+
+
+def test_cancelled_stream_does_not_update_average(monkeypatch):
+    """取消时读取仍在工作线程中进行，随后读到流结束：平均耗时和耗时分布都不记录这次被截断的流"""
+    release = threading.Event()
+
+    class BlockingClient(FakeClient):
+        def _send_stream_request(self, **kwargs):
+            yield "a"
+            release.wait(5)
+
+    monkeypatch.setattr(upstream_module, "_avg_stream_seconds", 30.0)
+    metrics.reset()
+    stream = UpstreamStream(BlockingClient([]), text="hi")
+
+    async def run():
+        assert await stream.__anext__() == "a"
+        pending = asyncio.ensure_future(stream.__anext__())
+        await asyncio.sleep(0.05)
+        stream.cancel()
+        release.set()
+        try:
+            await pending
+        except StopAsyncIteration:
+            pass
+
+    asyncio.run(run())
+    assert stream.cancelled
+    assert upstream_module._avg_stream_seconds == 30.0
+    assert "gemini_stream_duration_seconds" not in metrics.render_prometheus()
+
+
+if __name__ == "__main__":
+    import pytest
+
+    test_full_stream()
+    test_disconnect_cancels_upstream()
+    test_close_before_finish()
+    test_cancel_only_affects_own_stream()
+    test_client_stream_handles_are_independent()
+    with pytest.MonkeyPatch.context() as mp:
+        test_cancelled_stream_does_not_update_average(mp)
+    print("✅ 全部通过")
@@ -0,0 +1,113 @@
+"""
+Token 估算
+
+网页版不返回 token 用量，这里按文字类别估算（与 Gemini 的 SentencePiece 分词大致相当）:
+  - ASCII（英文、代码、数字）: 约 4 个字符 1 个 token
+  - 中日韩文字（汉字、假名、韩文音节及全角标点，按码位范围判断）: 约 1.5 个字符 1 个 token
+  - 其他非 ASCII 字符（西里尔字母、泰文、天城文、emoji 等）: 约 2 个字符 1 个 token
+  - 每张图片固定 IMAGE_TOKENS 个 token，每条消息另加 MESSAGE_OVERHEAD 个 token（角色、分隔符）
+
+文字类别由正则替换统计（C 实现，不在 Python 中逐字符循环），长文本也只需几微秒。
+
+单段文本的结果有缓存：多轮对话每次都带着完整历史，旧消息不会重复计算。
+缓存以 (hash, 长度) 为键，只保存 token 数，不持有原文，几 MB 的长提示词也不会一直占用内存。
+"""
+
+import math
+import re
+from typing import Any, Dict, Iterable, List, Tuple, Union
+
+ASCII_CHARS_PER_TOKEN = 4.0
+CJK_CHARS_PER_TOKEN = 1.5
+OTHER_CHARS_PER_TOKEN = 2.0
+IMAGE_TOKENS = 258
+MESSAGE_OVERHEAD = 4
+# 回复开头的固定开销（模型角色标记）
+REPLY_OVERHEAD = 3
+# 缓存的文本段数
+CACHE_SIZE = 4096
+
+# 按中日韩比率计数的码位：CJK 标点、假名、汉字（含扩展 A / 兼容汉字 / 扩展 B 之后）、韩文音节、全角字符
+_CJK_RE = re.compile(
+    "[\u3000-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff\uff00-\uffef\U00020000-\U0003134f]+"
+)
+
+# (hash, 长度) -> token 数；按插入顺序淘汰最早的（dict 单步操作在 GIL 下是原子的，并发时最多重复计算一次）
+_cache: Dict[Tuple[int, int], int] = {}
+
+
+def count_text(text: str) -> int:
+    """估算一段文本的 token 数"""
+    if not text:
+        return 0
+    if text.isascii():
+        return math.ceil(len(text) / ASCII_CHARS_PER_TOKEN)
+    key = (hash(text), len(text))
+    count = _cache.get(key)
+    if count is None:
+        count = _cache[key] = _count_mixed(text)
+        if len(_cache) > CACHE_SIZE:
+            try:
+                del _cache[next(iter(_cache))]
+            except (KeyError, RuntimeError, StopIteration):
+                pass
+    return count
+
+
+def clear_cache():
+    _cache.clear()
+
+
+def _count_mixed(text: str) -> int:
+    ascii_chars = len(text.encode("ascii", "ignore"))
+    non_ascii = len(text) - ascii_chars
+    cjk_chars = len(text) - len(_CJK_RE.sub("", text))
+    other_chars = non_ascii - cjk_chars
+    return math.ceil(
+        ascii_chars / ASCII_CHARS_PER_TOKEN
+        + cjk_chars / CJK_CHARS_PER_TOKEN
+        + other_chars / OTHER_CHARS_PER_TOKEN
+    )
+
+
+def count_content(content: Union[str, List[Dict[str, Any]], None]) -> int:
+    """
+    估算一条消息内容的 token 数
+
+    支持纯文本、OpenAI 格式的内容列表（text / image_url）和 Gemini 格式的 parts（text / inlineData / fileData）
+    """
+    if not content:
+        return 0
+    if isinstance(content, str):
+        return count_text(content)
+    total = 0
+    for part in content:
+        if not isinstance(part, dict):
+            total += count_text(str(part))
+        elif "text" in part:
+            total += count_text(part["text"] or "")
+        elif part.get("type") == "image_url" or "inlineData" in part or "fileData" in part:
+            total += IMAGE_TOKENS
+    return total
+
+
+def count_messages(messages: Iterable[Any]) -> int:
+    """估算完整对话历史的 token 数（消息可以是 dict 或带 content 属性的对象）"""
+    total = REPLY_OVERHEAD
+    for message in messages:
+        content = message.get("content") if isinstance(message, dict) else getattr(message, "content", None)
+        total += MESSAGE_OVERHEAD + count_content(content)
+    return total
+
+
+def usage(prompt_tokens: int, reply: str, cached_tokens: int = 0) -> Dict[str, Any]:
+    """OpenAI 格式的 usage，cached_tokens 为命中上下文缓存的输入 token 数（已计入 prompt_tokens）"""
+    completion_tokens = count_text(reply)
+    result: Dict[str, Any] = {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": prompt_tokens + completion_tokens,
+    }
+    if cached_tokens:
+        result["prompt_tokens_details"] = {"cached_tokens": cached_tokens}
+    return result
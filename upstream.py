@@ -0,0 +1,108 @@
+"""
+上游流式响应转发
+
+在线程池中逐块读取 GeminiClient._send_stream_request（同步生成器），不阻塞事件循环；
+下游 SSE 客户端断开或响应任务被取消时，立即关闭上游 httpx 连接，释放账号槽位。
+"""
+
+import asyncio
+import time
+
+from fastapi.concurrency import run_in_threadpool
+
+from metrics import metrics
+
+
+# 完整流式生成的平均耗时（秒，指数滑动平均），用于估算取消后节省的上游生成时间
+_avg_stream_seconds = 0.0
+
+
+class UpstreamStream:
+    """
+    可取消的上游流
+
+    用法:
+        upstream = UpstreamStream(client, raw_request, text=..., model=...)
+        try:
+            async for chunk in upstream:
+                ...
+        finally:
+            upstream.close()
+    """
+
+    def __init__(self, client, raw_request=None, **kwargs):
+        """
+        Args:
+            client: GeminiClient
+            raw_request: starlette Request，用于检测客户端断开（可选）
+            **kwargs: 透传给 client.open_stream
+        """
+        self.client = client
+        self.raw_request = raw_request
+        self.cancelled = False
+        # 取消状态属于这个流（同一客户端上可能有多个并发的流）
+        self._handle, self._gen = client.open_stream(**kwargs)
+        self._done = False
+        self._started = time.monotonic()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> str:
+        if self._done:
+            raise StopAsyncIteration
+        if self.raw_request is not None and await self.raw_request.is_disconnected():
+            self.cancel()
+            raise StopAsyncIteration
+        try:
+            chunk = await run_in_threadpool(next, self._gen, None)
+        except asyncio.CancelledError:
+            # 响应任务被取消（客户端断开），关闭上游连接让工作线程尽快结束
+            self.cancel()
+            raise
+        except BaseException:
+            self._done = True
+            raise
+        if chunk is None:
+            self._finish()
+            raise StopAsyncIteration
+        return chunk
+
+    @property
+    def elapsed(self) -> float:
+        return time.monotonic() - self._started
+
+    def _finish(self):
+        global _avg_stream_seconds
+        self._done = True
+        if self.cancelled:
+            # 取消后工作线程中的读取仍可能正常返回，被截断的流不计入平均耗时
+            return
+        elapsed = self.elapsed
+        if _avg_stream_seconds:
+            _avg_stream_seconds = _avg_stream_seconds * 0.8 + elapsed * 0.2
+        else:
+            _avg_stream_seconds = elapsed
+        metrics.observe("gemini_stream_duration_seconds", elapsed)
+
+    def cancel(self):
+        """取消上游生成：关闭 httpx 连接，会话上下文由客户端回滚"""
+        if self._done:
+            return
+        self._done = True
+        self.cancelled = True
+        self._handle.cancel()
+        try:
+            self._gen.close()
+        except ValueError:
+            # 生成器仍在工作线程中执行，连接关闭后读取会立即失败并自行结束
+            pass
+        saved = max(0.0, _avg_stream_seconds - self.elapsed)
+        metrics.inc("gemini_stream_cancelled_total")
+        metrics.inc("gemini_stream_saved_seconds_total", saved)
+        print(f"[INFO] 客户端已断开，取消上游生成（已运行 {self.elapsed:.1f}s，预计节省 {saved:.1f}s）")
+
+    def close(self):
+        """流未正常结束时取消上游生成（可重复调用）"""
+        if not self._done:
+            self.cancel()